@@ -1,13 +1,39 @@
 import os
-
-from flask import Flask, render_template, request, flash, redirect, session, g
+from collections import Counter
+from hashlib import sha1
+from itertools import chain
+from uuid import uuid4
+
+import click
+from flask import (Flask, render_template, request, flash, redirect, session, g,
+                   abort, jsonify, Response)
 from flask_debugtoolbar import DebugToolbarExtension
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, TimeoutError as PoolTimeout
+from sqlalchemy.orm import object_session
 
+from assets import assets
+from cache import LRUCache
+from follow_graph import follow_graph
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from fragments import message_cards
+from images import image_proxy
+from jobs import jobs, on_commit
+from models import (db, connect_db, User, Message, MessageTerm, TimelineEntry,
+                    Likes, Follows, shards, user_change_listeners,
+                    users_changed)
+from pagination import paginate, merge_pages
+from passwords import hasher, PasswordHasherBusy
+from pools import pools
+from pubsub import broker, format_event
+from routing import read_only, router
+from search import user_search, message_search
+from seeding import DEFAULT_CHUNK_SIZE, load as load_seed_data
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_STAMP_KEY = "curr_user_stamp"
+USERS_PER_PAGE = 24
+STREAM_KEEPALIVE = 25
+API_MAX_IDS = 100
 
 app = Flask(__name__)
 
@@ -20,10 +46,37 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['CURRENT_USER_CACHE_SIZE'] = 10000
+app.config['CURRENT_USER_CACHE_TTL'] = 60
 toolbar = DebugToolbarExtension(app)
+hasher.init_app(app)
+follow_graph.init_app(app)
+message_cards.init_app(app)
+assets.init_app(app)
+image_proxy.init_app(app)
+broker.init_app(app)
+jobs.init_app(app)
+router.init_app(app)
+shards.init_app(app)
+pools.init_app(app)
 
 connect_db(app)
 
+# Snapshots of logged-in users, so most requests don't have to look the
+# current user up: user id -> (session stamp, User.snapshot())
+current_users = LRUCache(maxsize=app.config['CURRENT_USER_CACHE_SIZE'],
+                         ttl=app.config['CURRENT_USER_CACHE_TTL'])
+
+
+def forget_current_users(user_ids):
+    """Drop cached snapshots of users whose rows just changed."""
+
+    for user_id in user_ids:
+        current_users.delete(user_id)
+
+
+user_change_listeners.append(forget_current_users)
+
 
 ##############################################################################
 # User signup/login/logout
@@ -34,16 +87,40 @@ def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_current_user(session[CURR_USER_KEY],
+                                   session.get(CURR_USER_STAMP_KEY))
 
     else:
         g.user = None
 
 
+def load_current_user(user_id, stamp):
+    """Get the logged-in user, from the snapshot cache if we can.
+
+    Snapshots are only used if they were cached under the same session
+    stamp. Changes committed in this process drop the user's snapshot;
+    changing the stamp (see do_login) makes other processes miss too, and
+    anything else expires after CURRENT_USER_CACHE_TTL.
+    """
+
+    if stamp is None:
+        return User.query.get(user_id)
+
+    cached = current_users.get(user_id)
+    if cached is not None and cached[0] == stamp:
+        return User.from_snapshot(cached[1])
+
+    user = User.query.get(user_id)
+    if user:
+        current_users.set(user_id, (stamp, user.snapshot()))
+    return user
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_STAMP_KEY] = uuid4().hex
 
 
 def do_logout():
@@ -52,6 +129,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_STAMP_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -99,12 +178,18 @@ def login():
         user = User.authenticate(form.username.data,
                                  form.password.data)
 
-        if user:
+        if user and jobs.exists(deletion_key(user.id)):
+            flash("That account is being deleted.", 'danger')
+
+        elif user:
+            # saves the password hash if authenticate upgraded it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
 
-        flash("Invalid credentials.", 'danger')
+        else:
+            flash("Invalid credentials.", 'danger')
 
     return render_template('users/login.html', form=form)
 
@@ -121,23 +206,38 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_only
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by username, bio or
+    location, and a 'page' param to page through the results.
     """
 
     search = request.args.get('q')
+    page = request.args.get('page', 1, type=int)
+
+    if page < 1:
+        abort(400)
 
     if not search:
-        users = User.query.all()
+        users = (User
+                 .query
+                 .order_by(User.id)
+                 .offset((page - 1) * USERS_PER_PAGE)
+                 .limit(USERS_PER_PAGE + 1)
+                 .all())
+        has_more = len(users) > USERS_PER_PAGE
+        users = users[:USERS_PER_PAGE]
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_more = user_search.search(search, page, USERS_PER_PAGE)
 
-    return render_template('users/index.html', users=users)
+    return render_template('users/index.html', users=users, search=search,
+                           page=page, has_more=has_more)
 
 
 @app.route('/users/<int:user_id>')
+@read_only
 def users_show(user_id):
     """Show user profile."""
 
@@ -145,16 +245,27 @@ def users_show(user_id):
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = paginate_messages(
+        Message
+        .query
+        .options(db.selectinload(Message.user))
+        .filter(Message.user_id == user_id),
+        Message.timestamp, Message.id, [shards.shard_for(user_id)])
+
+    # the profile's counters change with every follow, like and post; its
+    # cards have no hearts, but there's the viewer's follow button
+    following = g.user.is_following(user) if g.user else None
+    unchanged = not_modified('user', user.snapshot(),
+                             [m.id for m in messages], following)
+    if unchanged:
+        return unchanged
+
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
+@read_only
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -163,10 +274,17 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    followed_users = (User
+                      .query
+                      .filter(User.id.in_(user.following_ids()))
+                      .order_by(User.id)
+                      .all())
+    return render_template('users/following.html', user=user,
+                           followed_users=followed_users)
 
 
 @app.route('/users/<int:user_id>/followers')
+@read_only
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -175,9 +293,16 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    followers = (User
+                 .query
+                 .filter(User.id.in_(user.follower_ids()))
+                 .order_by(User.id)
+                 .all())
+    return render_template('users/followers.html', user=user,
+                           followers=followers)
 
 @app.route('/users/<int:user_id>/likes')
+@read_only
 def users_likes(user_id):
     """Show messages liked by this user."""
 
@@ -186,9 +311,22 @@ def users_likes(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    messages = [msg for msg in user.likes]
-    likes = [m.id for m in g.user.likes]
-    return render_template('users/likes.html', user=user, messages=messages, likes=likes)
+
+    liked = db.session.query(Likes.message_id).filter(Likes.user_id == user_id)
+    if shards.sharded:
+        # the likes are on the liker's shard, the messages on their authors'
+        liked = [message_id for (message_id,) in
+                 liked.with_session(shards.session_for(user_id))]
+
+    messages, next_cursor = paginate_messages(
+        Message
+        .query
+        .options(db.selectinload(Message.user))
+        .filter(Message.id.in_(liked)),
+        Message.timestamp, Message.id)
+    likes = g.user.liked_message_ids(m.id for m in messages)
+    return render_template('users/likes.html', user=user, messages=messages,
+                           likes=likes, next_cursor=next_cursor)
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
@@ -199,8 +337,16 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    shards.session_for(g.user.id).add(
+        Follows(user_following_id=g.user.id,
+                user_being_followed_id=followed_user.id))
+    User.update_counters([g.user.id], following_count=1)
+    User.update_counters([followed_user.id], followers_count=1)
+    # timelines are only materialized without shards (see homepage)
+    if not shards.sharded:
+        backfill_timeline.enqueue(g.user.id, followed_user.id)
     db.session.commit()
+    follow_graph.add(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -212,20 +358,43 @@ def add_like(msg_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get_or_404(msg_id)
+    msg = get_message_or_404(msg_id)
     if msg.user_id == g.user.id:
         return redirect("/")
 
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
-    else:
-        g.user.likes.append(msg)
+    if not g.user.unlike(msg.id):
+        g.user.like(msg.id)
 
     db.session.commit()
 
     return redirect("/")
 
 
+@app.route('/users/likes/<int:msg_id>', methods=['PUT', 'DELETE'])
+def set_like(msg_id):
+    """Like (PUT) or unlike (DELETE) a message; responds with JSON.
+
+    Repeating either is harmless, so the page's script can send the state
+    a button should end up in without worrying about double clicks.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    msg = get_message_or_404(msg_id)
+    if msg.user_id == g.user.id:
+        return jsonify(error="You can't like your own warbles."), 403
+
+    if request.method == 'PUT':
+        g.user.like(msg.id)
+    else:
+        g.user.unlike(msg.id)
+
+    db.session.commit()
+
+    return jsonify(message_id=msg.id, liked=request.method == 'PUT')
+
+
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
@@ -234,9 +403,19 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    followed_user = User.query.get_or_404(follow_id)
+    unfollowed = (shards.session_for(g.user.id)
+                  .query(Follows)
+                  .filter_by(user_following_id=g.user.id,
+                             user_being_followed_id=followed_user.id)
+                  .delete(synchronize_session=False))
+    if unfollowed:
+        if not shards.sharded:
+            TimelineEntry.remove_author(g.user.id, followed_user.id)
+        User.update_counters([g.user.id], following_count=-1)
+        User.update_counters([followed_user.id], followers_count=-1)
     db.session.commit()
+    follow_graph.remove(g.user.id, followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -253,9 +432,9 @@ def profile():
 
     if form.validate_on_submit():
         try:
-            user = User.query.get(g.user.id)
+            user = g.user
 
-            if not User.authenticate(user.username, form.password.data):
+            if not user.check_password(form.password.data):
                 flash("Access unauthorized.", "danger")
                 return render_template("users/edit.html", form=form)
 
@@ -271,6 +450,9 @@ def profile():
             db.session.add(user)
             db.session.commit()
 
+            # so every process reloads the user, not just this one
+            do_login(user)
+
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template("users/edit.html", form=form)
@@ -291,7 +473,8 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # a big account takes a while to take apart (see delete_account)
+    delete_account.enqueue(g.user.id, key=deletion_key(g.user.id))
     db.session.commit()
 
     return redirect("/signup")
@@ -314,8 +497,13 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        message_session = shards.session_for(g.user.id)
+        message_session.add(msg)
+        message_session.flush()
+        MessageTerm.index_message(msg)
+        User.update_counters([g.user.id], messages_count=1)
+        fan_out_message.enqueue(msg.id)
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -323,11 +511,56 @@ def messages_add():
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+@read_only
+def messages_search():
+    """Search messages.
+
+    Takes a 'q' param with the words to find (see search.py for the
+    syntax), an optional 'author' username to limit results to, and a
+    'before' cursor for older pages.
+    """
+
+    search = request.args.get('q', '')
+    author = request.args.get('author')
+
+    messages, next_cursor = [], None
+
+    author_id = None
+    shard_keys = None
+    if author:
+        author_user = User.query.filter_by(username=author).first()
+        author_id = author_user.id if author_user else -1
+        if author_user:
+            shard_keys = [shards.shard_for(author_id)]
+
+    query = message_search(search, author_id=author_id)
+
+    if query is not None:
+        messages, next_cursor = paginate_messages(
+            query.options(db.selectinload(Message.user)),
+            Message.timestamp, Message.id, shard_keys)
+
+    return render_template('messages/search.html', messages=messages,
+                           search=search, author=author,
+                           next_cursor=next_cursor)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_only
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = get_message_or_404(message_id)
+
+    # messages never change, but their author's name, picture and follow
+    # button can
+    following = g.user.is_following(msg.user) if g.user else None
+    unchanged = not_modified('message', msg.id, msg.user.snapshot(),
+                             following)
+    if unchanged:
+        return unchanged
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -339,21 +572,296 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = get_message_or_404(message_id)
     if msg.user_id != g.user.id:
         flash("Access unauthorized.", "danger")
         return redirect("/")
-    db.session.delete(msg)
+
+    # likes are on the likers' shards
+    message_likes = Likes.query.filter_by(message_id=msg.id)
+    likers = [user_id for user_ids in shards.scatter(
+                  lambda session: [user_id for (user_id,) in message_likes
+                                   .with_session(session)
+                                   .with_entities(Likes.user_id)])
+              for user_id in user_ids]
+
+    if shards.sharded:
+        # there are no foreign keys across shards to cascade to them
+        shards.scatter(lambda session: message_likes
+                       .with_session(session)
+                       .delete(synchronize_session=False))
+    else:
+        TimelineEntry.remove_message(msg.id)
+    MessageTerm.remove_message(msg)
+    User.update_counters([g.user.id], messages_count=-1)
+    User.update_counters(likers, likes_count=-1)
+    message_cards.forget(msg)
+    object_session(msg).delete(msg)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
 
+@app.route('/stream')
+def stream():
+    """Server-sent events about new warbles in the user's timeline.
+
+    The homepage listens to this to offer new warbles without reloading.
+    Nothing here holds a database connection while the stream is open.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    subscription = broker.subscribe(g.user.id)
+
+    def events():
+        try:
+            # how long browsers wait before reconnecting, in ms
+            yield "retry: 5000\n\n"
+            while True:
+                event = subscription.get(timeout=STREAM_KEEPALIVE)
+                if event is None:
+                    # keep proxies from closing an idle connection
+                    yield ": keepalive\n\n"
+                else:
+                    yield format_event('message', event, id=event['id'])
+        finally:
+            broker.unsubscribe(subscription)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+
+
+##############################################################################
+# JSON API
+#
+# Batch reads for clients that show many users or messages at once: each
+# takes up to API_MAX_IDS ids (?ids=1,2,3) and answers in one request,
+# in the order asked, leaving out ids that don't exist.
+
+
+def requested_ids():
+    """The ids in the 'ids' query parameter, in order, without repeats."""
+
+    try:
+        ids = [int(part) for part in request.args.get('ids', '').split(',')
+               if part.strip()]
+    except ValueError:
+        abort(api_error("ids must be a comma-separated list of integers."))
+
+    if len(ids) > API_MAX_IDS:
+        abort(api_error(f"At most {API_MAX_IDS} ids at a time."))
+
+    return list(dict.fromkeys(ids))
+
+
+def api_error(message, status=400):
+    resp = jsonify(error=message)
+    resp.status_code = status
+    return resp
+
+
+def in_request_order(ids, records):
+    by_id = {record['id']: record for record in records}
+    return [by_id[id] for id in ids if id in by_id]
+
+
+@app.route('/api/users')
+@read_only
+def api_users():
+    """Users as JSON, with their counts and how they relate to the viewer."""
+
+    ids = requested_ids()
+    users = User.query.filter(User.id.in_(ids)).all() if ids else []
+
+    records = []
+    for user in users:
+        record = {
+            'id': user.id,
+            'username': user.username,
+            'image_url': user.image_url,
+            'header_image_url': user.header_image_url,
+            'bio': user.bio,
+            'location': user.location,
+            'messages_count': user.messages_count,
+            'following_count': user.following_count,
+            'followers_count': user.followers_count,
+            'likes_count': user.likes_count,
+        }
+        # one query each for the viewer's follows, however many users
+        if g.user:
+            record['following'] = g.user.is_following(user)
+            record['follows_you'] = g.user.is_followed_by(user)
+        records.append(record)
+
+    return jsonify(users=in_request_order(ids, records))
+
+
+@app.route('/api/messages')
+@read_only
+def api_messages():
+    """Messages as JSON, with their authors, like counts and the viewer's like.
+
+    All in one query: authors are joined in, counts and the viewer's like
+    are subqueries.
+    """
+
+    ids = requested_ids()
+    if not ids:
+        return jsonify(messages=[])
+
+    if shards.sharded:
+        return jsonify(messages=in_request_order(ids, gather_messages(ids)))
+
+    likes_count = (db.session
+                   .query(db.func.count(Likes.id))
+                   .filter(Likes.message_id == Message.id)
+                   .label('likes_count'))
+    columns = [Message, likes_count]
+
+    if g.user:
+        columns.append(
+            db.session
+            .query(Likes.id)
+            .filter(Likes.message_id == Message.id,
+                    Likes.user_id == g.user.id)
+            .exists()
+            .label('liked'))
+
+    rows = (db.session
+            .query(*columns)
+            .options(db.joinedload(Message.user))
+            .filter(Message.id.in_(ids)))
+
+    records = []
+    for msg, count, *liked in rows:
+        record = message_record(msg, count)
+        if liked:
+            record['liked'] = bool(liked[0])
+        records.append(record)
+
+    return jsonify(messages=in_request_order(ids, records))
+
+
+def gather_messages(ids):
+    """api_messages' records, from the shards.
+
+    Messages are on their authors' shards and likes on their likers', so
+    this asks every shard for both, in parallel.
+    """
+
+    def find_messages(session):
+        return (session
+                .query(Message)
+                .filter(Message.id.in_(ids))
+                .all())
+
+    def count_likes(session):
+        return (session
+                .query(Likes.message_id, db.func.count(Likes.id))
+                .filter(Likes.message_id.in_(ids))
+                .group_by(Likes.message_id)
+                .all())
+
+    likes_counts = Counter()
+    for counts in shards.scatter(count_likes):
+        likes_counts.update(dict(counts))
+
+    liked = g.user.liked_message_ids(ids) if g.user else None
+
+    messages = list(chain.from_iterable(shards.scatter(find_messages)))
+    load_authors(messages)
+
+    records = []
+    for msg in messages:
+        record = message_record(msg, likes_counts[msg.id])
+        if liked is not None:
+            record['liked'] = msg.id in liked
+        records.append(record)
+    return records
+
+
+def message_record(msg, likes_count):
+    return {
+        'id': msg.id,
+        'text': msg.text,
+        'timestamp': msg.timestamp.isoformat(),
+        'user': {
+            'id': msg.user.id,
+            'username': msg.user.username,
+            'image_url': msg.user.image_url,
+        },
+        'likes_count': likes_count,
+    }
+
+
 ##############################################################################
 # Homepage and error pages
 
 
+def paginate_messages(query, timestamp_column, id_column, shard_keys=None):
+    """Get the page of messages that the 'before' cursor asks for.
+
+    Queries should selectinload Message.user, since the templates show each
+    message's author; that way a page costs the same number of queries
+    however many different people wrote it. (With shards, load_authors does
+    that instead.)
+
+    The query runs on each shard in `shard_keys` (default: all of them) at
+    once, and their pages are merged.
+
+    Returns (messages, next_cursor); a garbled cursor is a 400.
+    """
+
+    cursor = request.args.get('before')
+    if shards.sharded:
+        query = query.options(db.lazyload(Message.user))
+
+    try:
+        messages, next_cursor = merge_pages(shards.scatter(
+            lambda session: paginate(query.with_session(session),
+                                     timestamp_column, id_column,
+                                     cursor=cursor),
+            shard_keys))
+    except ValueError:
+        abort(400)
+
+    if shards.sharded:
+        load_authors(messages)
+    return messages, next_cursor
+
+
+def load_authors(messages):
+    """Load sharded messages' authors, in one query for all of them.
+
+    A shard can't join its messages to users, which are in the main
+    database, so selectinload(Message.user) doesn't work there. This puts
+    the authors in each message's session, where msg.user finds them.
+    """
+
+    author_ids = {msg.user_id for msg in messages}
+    if not author_ids:
+        return
+
+    authors = User.query.filter(User.id.in_(author_ids)).all()
+    for message_session in {object_session(msg) for msg in messages}:
+        # the identity map only holds them weakly; keep them for the request
+        message_session.info.setdefault('authors', []).extend(
+            message_session.merge(author, load=False) for author in authors)
+
+
+def get_message_or_404(message_id):
+    """The message with this id, from whichever shard has it."""
+
+    msg = shards.get(Message, message_id)
+    if msg is None:
+        abort(404)
+    return msg
+
+
 @app.route('/')
+@read_only
 def homepage():
     """Show homepage:
 
@@ -363,36 +871,322 @@ def homepage():
 
     if g.user:
 
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
+        if shards.sharded:
+            # a timeline would span shards, so they aren't materialized;
+            # gather the newest messages by the user and everyone they
+            # follow from each shard they're on, and merge them
+            author_ids = set(g.user.following_ids()) | {g.user.id}
+            messages, next_cursor = paginate_messages(
+                Message.query.filter(Message.user_id.in_(author_ids)),
+                Message.timestamp, Message.id, shards.group(author_ids))
+
+        else:
+            # timelines are materialized when messages are posted
+            # (see TimelineEntry), so we don't need the follow list here
+            messages, next_cursor = paginate_messages(
+                Message
+                .query
+                .options(db.selectinload(Message.user))
+                .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                .filter(TimelineEntry.user_id == g.user.id),
+                TimelineEntry.timestamp, TimelineEntry.message_id)
+
+        # the page's messages are the timeline's watermark, and which of
+        # them the viewer likes decides the hearts
+        likes = g.user.liked_message_ids(m.id for m in messages)
+        unchanged = not_modified(
+            'home', [(m.id, m.user.profile_version) for m in messages],
+            sorted(likes))
+        if unchanged:
+            return unchanged
+
+        return render_template('home.html', messages=messages, likes=likes,
+                               next_cursor=next_cursor)
 
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+    else:
+        return render_template('home-anon.html')
+
+
+##############################################################################
+# Error pages
+
+
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(error):
+    """Too many logins/signups are waiting on password hashing."""
 
-        likes = [m.id for m in g.user.likes]
+    return ("We're very busy right now, please try again in a moment.", 503,
+            {'Retry-After': '1'})
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    """Every database connection stayed in use for SQLALCHEMY_POOL_TIMEOUT."""
+
+    return ("We're very busy right now, please try again in a moment.", 503,
+            {'Retry-After': '1'})
+
+
+##############################################################################
+# Monitoring
 
-        return render_template('home.html', messages=messages, likes=likes)
+
+@app.route('/metrics')
+def metrics():
+    """This process's caches, streams, jobs, replica use and pools, as JSON.
+
+    Each worker process answers for itself; `worker` says which one.
+    """
+
+    return jsonify(worker=os.getpid(), caches={
+        'current_users': current_users.stats(),
+        'message_cards': message_cards.cache.stats(),
+    }, streams=broker.stats(), jobs=jobs.stats(),
+                   replicas=router.stats(), pools=pools.stats())
+
+
+##############################################################################
+# Background jobs (see jobs.py)
+
+
+@jobs.task()
+def fan_out_message(message_id):
+    """Put a new message in its followers' timelines, and tell them."""
+
+    msg = shards.get(Message, message_id)
+    if msg is None:
+        return  # deleted already
+
+    if shards.sharded:
+        # no timelines to fill (see homepage)
+        follower_ids = list(msg.user.follower_ids())
 
     else:
-        return render_template('home-anon.html')
+        # a retry after an earlier run committed has nothing left to do
+        if TimelineEntry.query.get((msg.user_id, msg.id)):
+            return
+
+        follower_ids = TimelineEntry.fan_out(msg)
+
+    # tell followers with their timeline open (see stream)
+    event = {'id': msg.id, 'user_id': msg.user_id}
+    on_commit(lambda: broker.publish(follower_ids, event))
+
+
+@jobs.task()
+def backfill_timeline(user_id, followed_user_id):
+    """Copy recent messages into a user's timeline after a follow."""
+
+    still_following = Follows.query.get((followed_user_id, user_id))
+    if still_following:
+        TimelineEntry.backfill(user_id, followed_user_id)
+
+
+@jobs.task()
+def delete_account(user_id):
+    """Delete a user and everything of theirs."""
+
+    if User.query.get(user_id) is not None:
+        if not shards.sharded:
+            TimelineEntry.remove_user(user_id)
+
+        # nothing cascades across shards, nor on SQLite (which doesn't
+        # enforce foreign keys), so take their rows apart ourselves
+        affected_ids = take_apart_account(user_id)
+
+        (User.query
+         .filter(User.id == user_id)
+         .delete(synchronize_session=False))
+        users_changed([user_id])
+        User.recount_counters(affected_ids)
+
+    on_commit(lambda: follow_graph.remove_user(user_id))
+
+
+def deletion_key(user_id):
+    """The key of the job deleting this user's account."""
+
+    return f"delete-account:{user_id}"
+
+
+def take_apart_account(user_id):
+    """Delete a user's rows from every shard; returns whose counters change.
+
+    Their own messages, likes and follows are on their shard; follows of
+    them and likes of their messages are on everyone else's. Unsharded,
+    the main database is the only shard.
+    """
+
+    own_session = shards.session_for(user_id)
+    authored = (own_session
+                .query(Message.id)
+                .filter(Message.user_id == user_id))
+    if shards.sharded:
+        # other shards can't select from this one
+        authored = [message_id for (message_id,) in authored]
+    affected_ids = {followed_id for (followed_id,) in own_session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id)}
+
+    def remove_references(session):
+        followers = session.query(Follows).filter(
+            Follows.user_being_followed_id == user_id)
+        likes = session.query(Likes).filter(Likes.message_id.in_(authored))
+
+        referrers = {id for (id,) in followers.with_entities(
+            Follows.user_following_id)}
+        referrers |= {id for (id,) in likes.with_entities(Likes.user_id)}
+        likes.delete(synchronize_session=False)
+        followers.delete(synchronize_session=False)
+        return referrers
+
+    affected_ids = affected_ids.union(*shards.scatter(remove_references))
+    shards.delete_user_rows(user_id, own_session)
+
+    return affected_ids - {user_id}
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
+# Maintenance commands
+
+
+@app.cli.command('repair-counters')
+def repair_counters():
+    """Recompute every user's cached message/follow/like counts."""
+
+    User.recount_counters()
+    db.session.commit()
+
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True,
+              help="Run the jobs that are due, then stop.")
+def run_jobs(once):
+    """Run background jobs (see jobs.py)."""
+
+    if once:
+        click.echo(f"Ran {jobs.run_pending()} jobs.")
+    else:
+        jobs.work()
+
+
+@app.cli.command('seed')
+@click.option('--data-dir', default='generator', show_default=True,
+              help="Directory holding users.csv, messages.csv, etc.")
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True,
+              help="Rows per transaction.")
+@click.option('--resume', is_flag=True,
+              help="Carry on with an interrupted load.")
+def seed(data_dir, chunk_size, resume):
+    """Replace the database's contents with CSV seed data."""
+
+    if shards.sharded:
+        raise click.UsageError(
+            "Seeding loads the main database only; unset SQLALCHEMY_SHARDS.")
+
+    load_seed_data(data_dir, chunk_size=chunk_size, resume=resume,
+                   echo=click.echo)
+
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress static files (see assets.py)."""
+
+    manifest = assets.build()
+    click.echo(f"Built {len(manifest)} assets.")
+
+
+@app.cli.command('build-follow-graph')
+def build_follow_graph():
+    """Rebuild the follow graph snapshot (see follow_graph.py)."""
+
+    if not follow_graph.path:
+        raise click.UsageError("FOLLOW_GRAPH_PATH is not set.")
+
+    follows = db.session.query(Follows.user_following_id,
+                               Follows.user_being_followed_id)
+    follow_graph.rebuild(chain.from_iterable(
+        follows.with_session(shards.session(key)).yield_per(10000)
+        for key in shards.keys))
+
+
+@app.cli.command('create-shard-tables')
+def create_shard_tables():
+    """Create the sharded tables on every shard that hasn't got them."""
+
+    if not shards.sharded:
+        raise click.UsageError("SQLALCHEMY_SHARDS is not set.")
+
+    shards.create_all()
+
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+@click.option('--wait', type=float, default=None,
+              help="Seconds to wait for other processes to see the move "
+                   "[default: SHARD_PLACEMENT_TTL].")
+def move_user(user_id, shard, wait):
+    """Move a user's messages, likes and follows to another shard."""
+
+    if not shards.sharded:
+        raise click.UsageError("SQLALCHEMY_SHARDS is not set.")
+    if wait is None:
+        wait = app.config['SHARD_PLACEMENT_TTL']
+
+    try:
+        old_shard = shards.move_user(user_id, shard, wait=wait)
+    except ValueError as exc:
+        raise click.UsageError(str(exc))
+
+    click.echo(f"Moved user {user_id} from {old_shard} to {shard}.")
+
+
+##############################################################################
+# Conditional requests
 #
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Pages that can say what they show get an ETag and may be kept by the
+# browser, which has to check back each time; if nothing changed, we answer
+# 304 Not Modified before rendering anything. Static files say how long
+# they keep (see assets.py). Everything else is never stored (it's mostly
+# forms and redirects).
+
+
+def not_modified(*parts):
+    """Tag this page with an ETag for `parts` and the user looking at it.
+
+    Returns a 304 response if the browser already has this version, which
+    the view should return instead of rendering. `parts` must cover
+    everything on the page that isn't about the current user.
+    """
+
+    # a page showing flashed messages is a one-off
+    if '_flashes' in session:
+        return None
+
+    viewer = (g.user.snapshot() if g.user else None,
+              session.get(CURR_USER_STAMP_KEY))
+    g.etag = sha1(repr((viewer, parts)).encode('UTF-8')).hexdigest()
+
+    if request.if_none_match.contains(g.etag):
+        return app.response_class(status=304)
+
+    return None
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(resp):
+    """Let browsers keep pages they can revalidate, and nothing else."""
+
+    etag = g.get('etag')
+
+    if etag is not None and resp.status_code in (200, 304):
+        resp.set_etag(etag)
+        # private: these pages differ for every logged-in user
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        resp.vary.add('Cookie')
+
+    elif not resp.cache_control.public:
+        resp.headers['Cache-Control'] = 'no-store'
+
+    return resp
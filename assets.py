@@ -0,0 +1,183 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies everything in static/ to static/dist/ under a
+name containing a hash of its contents (style.css -> style.3f2a9c1e.css),
+alongside gzipped and, if the brotli package is installed, brotli
+compressed copies, and writes a manifest mapping the original names to the
+hashed ones. Stylesheets' url(/static/...) references are rewritten to the
+hashed names too.
+
+Templates link assets with `asset_url('stylesheets/style.css')`. Once the
+manifest exists that gives /assets/<hashed name>, which never changes
+content, so it is served with a year-long "immutable" Cache-Control and
+browsers don't ask for it again; a new build gives new names. Without a
+build, asset_url falls back to plain /static URLs, so development needs
+no build step.
+
+Files go out through send_file, so the WSGI server's sendfile support
+(wsgi.file_wrapper) is used, or a front-end server's with USE_X_SENDFILE.
+
+Settings, read by init_app:
+
+ASSETS_MANIFEST
+    path of the manifest (default: static/dist/manifest.json).
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, safe_join, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+MAX_AGE = 365 * 24 * 60 * 60
+
+# what we precompress; images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.txt', '.json'}
+
+# pick the smallest encoding the browser takes: (Accept-Encoding, suffix)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+STATIC_URL = re.compile(r"""url\((["']?)/static/([^)"']+)\1\)""")
+
+
+def fingerprint(path, data):
+    """`path` with a hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def rewrite_url(match, manifest):
+    """A stylesheet's url(/static/...) pointing at the built asset."""
+
+    quote, filename = match.groups()
+    if filename not in manifest:
+        return match.group(0)
+    return f"url({quote}/assets/{manifest[filename]}{quote})"
+
+
+def build(static_folder):
+    """Build static_folder/dist and its manifest; returns the manifest."""
+
+    dist = os.path.join(static_folder, DIST)
+    shutil.rmtree(dist, ignore_errors=True)
+
+    sources = sorted(
+        os.path.relpath(os.path.join(root, name), static_folder)
+        for root, dirs, files in os.walk(static_folder)
+        for name in files
+        if os.path.commonpath([root, dist]) != dist)
+
+    # stylesheets refer to other assets, so hash those first
+    sources.sort(key=lambda path: path.endswith('.css'))
+
+    manifest = {}
+    for source in sources:
+        with open(os.path.join(static_folder, source), 'rb') as f:
+            data = f.read()
+
+        if source.endswith('.css'):
+            data = STATIC_URL.sub(
+                lambda m: rewrite_url(m, manifest),
+                data.decode('UTF-8')).encode('UTF-8')
+
+        name = fingerprint(source, data).replace(os.sep, '/')
+        manifest[source.replace(os.sep, '/')] = name
+
+        target = os.path.join(dist, name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(data)
+
+        if os.path.splitext(source)[1] in COMPRESSIBLE:
+            with open(target + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, 9))
+            if brotli is not None:
+                with open(target + '.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+class Assets:
+    """Links to and serves built assets."""
+
+    def __init__(self, app=None):
+        self.manifest = {}
+        self.static_folder = None
+        self.dist = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.dist = os.path.join(app.static_folder, DIST)
+        path = app.config.setdefault('ASSETS_MANIFEST',
+                                     os.path.join(self.dist, MANIFEST))
+        self.load(path)
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+        app.jinja_env.globals['asset_url'] = self.url
+
+    def load(self, path):
+        """Read the manifest at `path`, if it has been built."""
+
+        try:
+            with open(path) as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def build(self):
+        """Rebuild the assets and start linking to the new ones."""
+
+        self.manifest = build(self.static_folder)
+        return self.manifest
+
+    def url(self, filename):
+        """URL for the static file `filename`, fingerprinted if built."""
+
+        name = self.manifest.get(filename)
+        if name is None:
+            return url_for('static', filename=filename)
+        return url_for('assets', filename=name)
+
+    def send(self, filename):
+        """Serve a built asset, precompressed if the browser accepts it."""
+
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if (request.accept_encodings[encoding] and
+                    os.path.exists(safe_join(self.dist, filename + suffix))):
+                response = send_from_directory(
+                    self.dist, filename + suffix,
+                    mimetype=(mimetypes.guess_type(filename)[0] or
+                              'application/octet-stream'))
+                response.content_encoding = encoding
+                break
+
+        if response is None:
+            response = send_from_directory(self.dist, filename)
+
+        response.vary.add('Accept-Encoding')
+        response.headers['Cache-Control'] = (
+            f"public, max-age={MAX_AGE}, immutable")
+        return response
+
+
+assets = Assets()
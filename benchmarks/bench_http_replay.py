@@ -0,0 +1,344 @@
+"""Load-replay benchmark for Warbler's pages, through the whole WSGI app.
+
+Generates a data set with generator/create_csvs.py, loads it with `flask
+seed`'s loader, then has several concurrent clients, each logged in as a
+different user, replay a weighted mix of routes: the home timeline,
+profiles, user search, likes and unlikes, follows and unfollows, and
+posting. Reports p50/p95/p99 latency, throughput and SQL queries per
+request (from the profiler's X-DB-Query-Count header) for each route.
+Run it against a throwaway database -- it replaces everything in it:
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python benchmarks/bench_http_replay.py --users 20000 \\
+        --messages 200000 --follows 1000000 --output before.json
+
+Pass --reuse to skip loading and replay against whatever is there, and
+--baseline with an earlier --output to see what changed since, e.g.
+between two commits:
+
+    python benchmarks/bench_http_replay.py --reuse --baseline before.json
+
+which exits non-zero if any route's p95 got more than --tolerance slower
+or it started running more queries.
+
+Requests go through app.test_client() on threads in this process, so
+clients contend for the GIL as they would for a threaded server's.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from uuid import uuid4
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from app import app, CURR_USER_KEY, CURR_USER_STAMP_KEY  # noqa: E402
+from models import db, User, Message, Follows, Likes  # noqa: E402
+from seeding import load  # noqa: E402
+
+# route -> relative weight; roughly a reader-heavy social site
+DEFAULT_MIX = {
+    'home': 40,
+    'profile': 20,
+    'user search': 10,
+    'like': 12,
+    'follow': 6,
+    'new message': 6,
+}
+
+SEARCH_TERMS = ['a', 'an', 'jo', 'mar', 'son', 'ch', 'li', 'ste', 'el', 'z']
+
+
+def parse_mix(value):
+    """Parse `home=40,profile=20,...` into a mix."""
+
+    mix = {}
+    for part in value.split(','):
+        route, _, weight = part.partition('=')
+        route = route.strip()
+        if route not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"unknown route {route!r}")
+        mix[route] = float(weight)
+    return mix
+
+
+def seed(args):
+    """Generate and load a data set of the requested size."""
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        subprocess.run(
+            [sys.executable, os.path.join(ROOT, 'generator', 'create_csvs.py'),
+             '--users', str(args.users), '--messages', str(args.messages),
+             '--follows', str(args.follows), '--likes', str(args.likes),
+             '--seed', str(args.seed), '--out-dir', data_dir],
+            check=True, stdout=sys.stderr)
+        load(data_dir, echo=lambda line: print(line, file=sys.stderr))
+
+
+class Client:
+    """One logged-in user clicking around."""
+
+    def __init__(self, user_id, rng, max_user_id, max_message_id):
+        self.user_id = user_id
+        self.rng = rng
+        self.max_user_id = max_user_id
+        self.max_message_id = max_message_id
+
+        self.http = app.test_client()
+        with self.http.session_transaction() as session:
+            session[CURR_USER_KEY] = user_id
+            session[CURR_USER_STAMP_KEY] = uuid4().hex
+
+        # what we've done so far, so likes and follows can be undone
+        # rather than repeated
+        self.following = {
+            followed_id for followed_id, in db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id)}
+        self.liked = {
+            message_id for message_id, in db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id)}
+        db.session.remove()
+
+    def other_user(self):
+        while True:
+            user_id = self.rng.randint(1, self.max_user_id)
+            if user_id != self.user_id:
+                return user_id
+
+    def request(self, route):
+        """Make one `route` request: (name reported under, response)."""
+
+        if route == 'home':
+            return route, self.http.get('/')
+
+        if route == 'profile':
+            return route, self.http.get(f'/users/{self.other_user()}')
+
+        if route == 'user search':
+            return route, self.http.get(
+                f'/users?q={self.rng.choice(SEARCH_TERMS)}')
+
+        if route == 'like':
+            # likes of our own messages are refused (403) -- real clients
+            # don't show the button, but it costs the same
+            message_id = self.rng.randint(1, self.max_message_id)
+            if message_id in self.liked:
+                self.liked.discard(message_id)
+                return 'unlike', self.http.delete(f'/users/likes/{message_id}')
+            self.liked.add(message_id)
+            return 'like', self.http.put(f'/users/likes/{message_id}')
+
+        if route == 'follow':
+            if self.following and self.rng.random() < 0.5:
+                followed_id = self.rng.choice(sorted(self.following))
+                self.following.discard(followed_id)
+                return 'unfollow', self.http.post(
+                    f'/users/stop-following/{followed_id}')
+            followed_id = self.other_user()
+            if followed_id in self.following:
+                return 'profile', self.http.get(f'/users/{followed_id}')
+            self.following.add(followed_id)
+            return 'follow', self.http.post(f'/users/follow/{followed_id}')
+
+        if route == 'new message':
+            return route, self.http.post('/messages/new', data={
+                'text': f"benchmark warble {self.rng.getrandbits(32):08x}"})
+
+        raise ValueError(route)
+
+    def replay(self, routes, samples):
+        """Make a request for each of `routes`, adding to `samples`."""
+
+        for route in routes:
+            started = perf_counter()
+            name, response = self.request(route)
+            elapsed = perf_counter() - started
+
+            samples.append((
+                name, elapsed, response.status_code,
+                int(response.headers.get('X-DB-Query-Count', 0))))
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def summarize(samples, seconds):
+    """Per-route latency, throughput and query stats."""
+
+    by_route = defaultdict(list)
+    for sample in samples:
+        by_route[sample[0]].append(sample)
+
+    results = {}
+    for route, route_samples in sorted(by_route.items()):
+        timings = [elapsed * 1000 for _, elapsed, _, _ in route_samples]
+        queries = [count for _, _, _, count in route_samples]
+        results[route] = {
+            'requests': len(route_samples),
+            'errors': sum(status >= 500 for _, _, status, _ in route_samples),
+            'requests_per_second': round(len(route_samples) / seconds, 2),
+            'p50_ms': round(percentile(timings, 0.50), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2),
+            'queries_per_request': round(sum(queries) / len(queries), 2),
+            'max_queries': max(queries),
+        }
+
+    return results
+
+
+def run(args):
+    """Replay the mix on `args.clients` clients; returns the report."""
+
+    rng = random.Random(args.seed)
+    max_user_id = db.session.query(db.func.max(User.id)).scalar()
+    max_message_id = db.session.query(db.func.max(Message.id)).scalar()
+    if not max_user_id or not max_message_id:
+        sys.exit("Nothing to replay against: load some data first.")
+
+    user_ids = rng.sample(range(1, max_user_id + 1),
+                          min(args.clients, max_user_id))
+    clients = [Client(user_id, random.Random(f"{args.seed}-{user_id}"),
+                      max_user_id, max_message_id)
+               for user_id in user_ids]
+
+    routes, weights = zip(*args.mix.items())
+
+    def plan(client, count):
+        return client.rng.choices(routes, weights, k=count)
+
+    # fill caches and connection pools before measuring
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        list(pool.map(lambda client: client.replay(plan(client, args.warmup),
+                                                   []),
+                      clients))
+
+    samples = []
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+        list(pool.map(lambda client: client.replay(plan(client, args.requests),
+                                                   samples),
+                      clients))
+    seconds = perf_counter() - started
+
+    return {
+        'commit': git_commit(),
+        'database': db.engine.dialect.name,
+        'users': max_user_id,
+        'messages': max_message_id,
+        'clients': len(clients),
+        'requests': len(samples),
+        'seconds': round(seconds, 2),
+        'requests_per_second': round(len(samples) / seconds, 2),
+        'routes': summarize(samples, seconds),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT, check=True, capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None, tolerance=0.2):
+    """Print the report, compared with `baseline` if given.
+
+    Returns the routes that regressed: p95 more than `tolerance` slower,
+    or more queries per request.
+    """
+
+    print(f"{report['requests']:,} requests from {report['clients']} clients "
+          f"in {report['seconds']}s: {report['requests_per_second']:,} req/s",
+          file=sys.stderr)
+    if baseline:
+        print(f"compared with {baseline.get('commit') or 'baseline'}: "
+              f"{baseline['requests_per_second']:,} req/s", file=sys.stderr)
+
+    regressions = []
+    for route, stats in report['routes'].items():
+        line = (f"{route:>12}: p50 {stats['p50_ms']:8.2f}ms  "
+                f"p95 {stats['p95_ms']:8.2f}ms  p99 {stats['p99_ms']:8.2f}ms  "
+                f"{stats['queries_per_request']:5.1f} queries  "
+                f"{stats['errors']} errors")
+
+        before = (baseline or {}).get('routes', {}).get(route)
+        if before:
+            change = stats['p95_ms'] / before['p95_ms'] - 1
+            extra_queries = (stats['queries_per_request'] -
+                             before['queries_per_request'])
+            line += f"  | p95 {change:+.0%}, queries {extra_queries:+.1f}"
+            if change > tolerance or extra_queries > 0.5:
+                regressions.append(route)
+                line += "  REGRESSED"
+
+        print(line, file=sys.stderr)
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20000)
+    parser.add_argument('--likes', type=int, default=10000)
+    parser.add_argument('--seed', default='bench')
+    parser.add_argument('--reuse', action='store_true',
+                        help="replay against the data already loaded")
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=250,
+                        help="requests per client")
+    parser.add_argument('--warmup', type=int, default=20,
+                        help="unmeasured requests per client first")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="route weights, e.g. home=40,profile=20 "
+                             f"(routes: {', '.join(DEFAULT_MIX)})")
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--baseline', help="compare with this earlier output")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="p95 slowdown to call a regression")
+    args = parser.parse_args()
+
+    # the clients post forms without fetching them first
+    app.config['WTF_CSRF_ENABLED'] = False
+    # every client needs a connection at once (SQLite doesn't pool)
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        app.config['SQLALCHEMY_POOL_SIZE'] = max(5, args.clients)
+
+    with app.app_context():
+        if not args.reuse:
+            seed(args)
+        report = run(args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = print_report(report, baseline, args.tolerance)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if regressions:
+        sys.exit(f"regressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Latency benchmark for message search (/messages/search).
+
+Loads a synthetic set of messages into a scratch database, indexes them,
+then times each kind of search the page supports. Run it against a
+throwaway database -- it drops and recreates every table:
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python benchmarks/bench_message_search.py --messages 10000000
+
+Pass --reuse to skip loading and benchmark whatever is already there.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from itertools import accumulate
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from models import db, User, Message, MessageTerm, tokenize  # noqa: E402
+from pagination import paginate  # noqa: E402
+from search import message_search  # noqa: E402
+
+BATCH_SIZE = 10000
+VOCABULARY_SIZE = 20000
+
+
+def make_vocabulary(rng):
+    """Made-up words, most common first."""
+
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(letters)
+                          for _ in range(rng.randint(3, 9))))
+    return sorted(words, key=lambda word: (len(word), word))
+
+
+def load(num_users, num_messages, rng):
+    """Fill the database with users and indexed messages."""
+
+    db.drop_all()
+    db.create_all()
+
+    db.session.execute(User.__table__.insert(), [
+        dict(id=i, username=f"bench{i}", email=f"bench{i}@example.com",
+             password='x')
+        for i in range(1, num_users + 1)
+    ])
+
+    vocabulary = make_vocabulary(rng)
+    # Zipf-ish: word n is picked about 1/n as often as the commonest word
+    cumulative_weights = list(accumulate(
+        1 / rank for rank in range(1, len(vocabulary) + 1)))
+    start = datetime(2020, 1, 1)
+
+    loaded_at = perf_counter()
+    for first_id in range(1, num_messages + 1, BATCH_SIZE):
+        messages, terms = [], []
+        for message_id in range(first_id,
+                                min(first_id + BATCH_SIZE, num_messages + 1)):
+            text = ' '.join(rng.choices(vocabulary,
+                                        cum_weights=cumulative_weights,
+                                        k=rng.randint(4, 20)))[:140]
+            messages.append(dict(
+                id=message_id,
+                text=text,
+                timestamp=start + timedelta(seconds=message_id),
+                user_id=rng.randint(1, num_users),
+            ))
+            terms.extend(dict(term=term, message_id=message_id,
+                              position=position)
+                         for position, term in enumerate(tokenize(text)))
+
+        db.session.execute(Message.__table__.insert(), messages)
+        db.session.execute(MessageTerm.__table__.insert(), terms)
+        db.session.commit()
+
+        done = min(first_id + BATCH_SIZE - 1, num_messages)
+        rate = done / (perf_counter() - loaded_at)
+        print(f"loaded {done:,} messages ({rate:,.0f}/s)", file=sys.stderr)
+
+    if db.engine.dialect.name == 'postgresql':
+        for table in ('users', 'messages'):
+            db.session.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                f"(SELECT max(id) FROM {table}))")
+        db.session.commit()
+        db.session.execute('ANALYZE')
+
+
+def sample_searches(rng):
+    """Pick realistic searches of each kind from the loaded messages."""
+
+    max_id = db.session.query(db.func.max(Message.id)).scalar()
+    texts = [Message.query.get(rng.randint(1, max_id)) for _ in range(50)]
+    texts = [msg for msg in texts if msg]
+
+    common = (db.session
+              .query(MessageTerm.term)
+              .filter(MessageTerm.message_id == texts[0].id)
+              .order_by(db.func.length(MessageTerm.term))
+              .limit(1)
+              .scalar())
+
+    searches = {'common term': [], 'rare term': [], 'two terms': [],
+                'prefix': [], 'phrase': [], 'author filter': []}
+    for msg in texts:
+        words = tokenize(msg.text)
+        searches['rare term'].append((max(words, key=len), None))
+        searches['two terms'].append((f"{words[0]} {words[-1]}", None))
+        searches['prefix'].append((f"{words[1][:3]}*", None))
+        searches['phrase'].append((f'"{words[1]} {words[2]}"', None))
+        searches['author filter'].append((words[0], msg.user_id))
+        searches['common term'].append((common, None))
+
+    return searches
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(searches, per_page):
+    """Time the first page of every search; returns stats per kind."""
+
+    results = {}
+    for kind, queries in searches.items():
+        timings = []
+        for query, author_id in queries:
+            started = perf_counter()
+            paginate(message_search(query, author_id=author_id),
+                     Message.timestamp, Message.id, per_page=per_page)
+            timings.append((perf_counter() - started) * 1000)
+            db.session.rollback()
+
+        results[kind] = {
+            'searches': len(timings),
+            'p50_ms': round(percentile(timings, 0.50), 2),
+            'p95_ms': round(percentile(timings, 0.95), 2),
+            'p99_ms': round(percentile(timings, 0.99), 2),
+        }
+        print(f"{kind:>14}: p50 {results[kind]['p50_ms']:8.2f}ms  "
+              f"p95 {results[kind]['p95_ms']:8.2f}ms  "
+              f"p99 {results[kind]['p99_ms']:8.2f}ms", file=sys.stderr)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--per-page', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true',
+                        help="benchmark the data already loaded")
+    parser.add_argument('--output', help="write results as JSON here")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    with app.app_context():
+        if not args.reuse:
+            load(args.users, args.messages, rng)
+
+        results = run(sample_searches(rng), args.per_page)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({'messages': args.messages, 'results': results},
+                      output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
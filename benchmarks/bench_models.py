@@ -0,0 +1,306 @@
+"""Scaling benchmark for the hot methods in models.py.
+
+Times User.is_following, User.is_followed_by (against the database and
+against the follow graph), User.authenticate, User.signup and the home
+timeline query on follow graphs of increasing size, then fits how each
+one's time grows with the number of follows. Every method here should
+cost the same however big the site is -- they look up one user's rows
+through an index -- so the benchmark fails if any of them starts growing
+with the table instead, say because an index went missing:
+
+    DATABASE_URL=postgresql:///warbler-bench \\
+        python benchmarks/bench_models.py --sizes 100,10000,1000000
+
+Each size runs against a fresh SQLite database and, with --database (or
+DATABASE_URL), against that database too -- it drops and recreates every
+table, so use a throwaway one.
+
+Users each follow DEGREE others, so the follow table grows with the
+number of users while the work per call should stay the same.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app  # noqa: E402
+from follow_graph import follow_graph  # noqa: E402
+from models import (db, User, Message, Follows,  # noqa: E402
+                    TimelineEntry)
+from pagination import paginate  # noqa: E402
+from passwords import hash_password, hasher  # noqa: E402
+from seeding import copy_rows, insert_rows  # noqa: E402
+
+DEGREE = 10
+MESSAGES_PER_USER = 2
+BATCH_SIZE = 50000
+PASSWORD = 'password'
+
+# slope of log(time) against log(follows) -> complexity class; an index
+# lookup barely moves, a scan grows with the table
+COMPLEXITY_CLASSES = [(0.3, 'O(log n)'), (1.5, 'O(n)'),
+                      (math.inf, 'O(n^2)')]
+
+
+def complexity(slope):
+    return next(name for bound, name in COMPLEXITY_CLASSES if slope < bound)
+
+
+def load(num_follows, rng, hashed):
+    """Fill the database with about `num_follows` follows; returns user count."""
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    num_users = max(num_follows // DEGREE, DEGREE + 1)
+    start = datetime(2020, 1, 1)
+    engine = db.engine
+    insert = copy_rows if engine.dialect.name == 'postgresql' else insert_rows
+
+    def batches(rows):
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    tables = [
+        (User.__table__, ['id', 'username', 'email', 'password'],
+         ((user_id, f"user{user_id}", f"user{user_id}@example.com", hashed)
+          for user_id in range(1, num_users + 1))),
+        (Message.__table__, ['id', 'text', 'timestamp', 'user_id'],
+         ((message_id, f"message {message_id}",
+           (start + timedelta(seconds=rng.randrange(365 * 24 * 60 * 60))
+            ).isoformat(),
+           (message_id - 1) // MESSAGES_PER_USER + 1)
+          for message_id in range(1, num_users * MESSAGES_PER_USER + 1))),
+        (Follows.__table__, ['user_being_followed_id', 'user_following_id'],
+         ((followed_id, follower_id)
+          for follower_id in range(1, num_users + 1)
+          for followed_id in [
+              user_id for user_id in rng.sample(range(1, num_users + 1),
+                                                DEGREE + 1)
+              if user_id != follower_id][:DEGREE])),
+    ]
+
+    for table, columns, rows in tables:
+        for batch in batches(rows):
+            with engine.begin() as conn:
+                insert(conn, table, columns, batch)
+
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            for table in ('users', 'messages'):
+                conn.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT max(id) FROM {table}))")
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            conn.execute('ANALYZE')
+
+    return num_users
+
+
+def timeline(user):
+    """The homepage's query (see app.homepage)."""
+
+    return paginate(
+        Message
+        .query
+        .options(db.selectinload(Message.user))
+        .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+        .filter(TimelineEntry.user_id == user.id),
+        TimelineEntry.timestamp, TimelineEntry.message_id)
+
+
+# name -> (function of (random user, another random user, call number))
+BENCHMARKS = {
+    'is_following': lambda user, other, n: user.is_following(other),
+    'is_followed_by': lambda user, other, n: user.is_followed_by(other),
+    'authenticate': lambda user, other, n: User.authenticate(
+        f"user{user.id}", PASSWORD),
+    'signup': lambda user, other, n: (
+        User.signup(f"new{n}", f"new{n}@example.com", PASSWORD, None),
+        db.session.flush()),
+    'timeline': lambda user, other, n: timeline(user),
+}
+
+# run again with the follow graph loaded
+GRAPH_BENCHMARKS = ['is_following', 'is_followed_by']
+
+
+def time_calls(function, num_users, calls, rng):
+    """Per-call times, in ms, of `calls` calls on random users."""
+
+    timings = []
+    for n in range(calls):
+        # bare instances, so the timing doesn't include loading them
+        user = User(id=rng.randint(1, num_users))
+        other = User(id=rng.randint(1, num_users))
+
+        started = perf_counter()
+        function(user, other, n)
+        timings.append((perf_counter() - started) * 1000)
+
+        # start each call afresh: no session caches, nothing left over
+        db.session.rollback()
+
+    return timings
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def slope(points):
+    """Least-squares slope of log(y) against log(x)."""
+
+    xs = [math.log(x) for x, _ in points]
+    ys = [math.log(max(y, 1e-6)) for _, y in points]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if not spread:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / spread
+
+
+def run(sizes, calls, rng, hashed):
+    """Benchmark every method at every size; returns results by method."""
+
+    curves = {}
+    with tempfile.TemporaryDirectory() as graph_dir:
+        for size in sizes:
+            num_users = load(size, rng, hashed)
+            print(f"{db.engine.dialect.name}: {size:,} follows, "
+                  f"{num_users:,} users", file=sys.stderr)
+
+            runs = [(name, name, function)
+                    for name, function in BENCHMARKS.items()]
+            runs += [(f"{name} (follow graph)", name, BENCHMARKS[name])
+                     for name in GRAPH_BENCHMARKS]
+
+            for label, name, function in runs:
+                graph = label != name
+                if graph:
+                    follow_graph.path = os.path.join(graph_dir, 'follows')
+                    follow_graph.rebuild(
+                        db.session.query(Follows.user_following_id,
+                                         Follows.user_being_followed_id))
+                    follow_graph.refresh()
+
+                try:
+                    timings = time_calls(function, num_users, calls, rng)
+                finally:
+                    if graph:
+                        follow_graph.close()
+                        follow_graph.path = None
+
+                curves.setdefault(label, {})[size] = {
+                    'p50_ms': round(percentile(timings, 0.50), 4),
+                    'p95_ms': round(percentile(timings, 0.95), 4),
+                }
+
+    results = {}
+    for label, curve in curves.items():
+        fitted = slope([(size, stats['p50_ms'])
+                        for size, stats in curve.items()])
+        results[label] = {
+            'sizes': curve,
+            'slope': round(fitted, 3),
+            'complexity': complexity(fitted),
+        }
+
+    return results
+
+
+def print_results(database, results):
+    sizes = list(next(iter(results.values()))['sizes'])
+    print(f"\n{database}: p50 ms per call by number of follows",
+          file=sys.stderr)
+    print(f"{'':>28}" + ''.join(f"{size:>12,}" for size in sizes) +
+          "   slope  class", file=sys.stderr)
+    for label, result in results.items():
+        print(f"{label:>28}" +
+              ''.join(f"{result['sizes'][size]['p50_ms']:12.3f}"
+                      for size in sizes) +
+              f"  {result['slope']:6.2f}  {result['complexity']}",
+              file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='100,1000,10000,100000',
+                        type=lambda value: [int(size)
+                                            for size in value.split(',')],
+                        help="numbers of follows to try, comma separated")
+    parser.add_argument('--calls', type=int, default=200,
+                        help="calls per method and size")
+    parser.add_argument('--database', action='append',
+                        help="database URL to run against as well as SQLite "
+                             "(default: DATABASE_URL, if set); repeatable")
+    parser.add_argument('--rounds', type=int, default=4,
+                        help="bcrypt work factor; low, so hashing doesn't "
+                             "hide the queries")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results as JSON here")
+    args = parser.parse_args()
+
+    if len(args.sizes) < 2:
+        parser.error("--sizes needs at least two sizes to fit a curve")
+
+    hasher.rounds = args.rounds
+    hasher.workers = 0
+    hashed = hash_password(PASSWORD, args.rounds)
+
+    databases = args.database or [os.environ.get('DATABASE_URL')]
+    report = {}
+    regressions = []
+
+    with tempfile.TemporaryDirectory() as sqlite_dir:
+        urls = [f"sqlite:///{os.path.join(sqlite_dir, 'bench.db')}"]
+        urls += [url for url in databases if url]
+
+        for url in urls:
+            # Flask-SQLAlchemy makes a new engine when the URL changes
+            app.config['SQLALCHEMY_DATABASE_URI'] = url
+            with app.app_context():
+                results = run(args.sizes, args.calls,
+                              random.Random(args.seed), hashed)
+                database = db.engine.dialect.name
+                db.session.remove()
+                db.engine.dispose()
+
+            print_results(database, results)
+            report[database] = results
+            regressions += [
+                f"{label} on {database} ({result['complexity']})"
+                for label, result in results.items()
+                if result['complexity'] != COMPLEXITY_CLASSES[0][1]]
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if regressions:
+        sys.exit(f"grows with the table: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
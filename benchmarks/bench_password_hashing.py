@@ -0,0 +1,95 @@
+"""Login throughput benchmark for the password hasher (passwords.py).
+
+Times bcrypt password checks inline on one thread, then on the process
+pool with several concurrent "requests", and reports logins per second
+overall and per core:
+
+    python benchmarks/bench_password_hashing.py --rounds 12 --workers 4
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher, PasswordHasherBusy, hash_password  # noqa: E402
+
+
+def timed(logins, check):
+    """Run `logins` password checks; returns (seconds, logins rejected)."""
+
+    rejected = 0
+    started = perf_counter()
+    for _ in range(logins):
+        try:
+            check()
+        except PasswordHasherBusy:
+            rejected += 1
+    return perf_counter() - started, rejected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--clients', type=int,
+                        help="concurrent logins (default: 2 per worker)")
+    parser.add_argument('--logins', type=int, default=40,
+                        help="logins per client")
+    parser.add_argument('--output', help="write results as JSON here")
+    args = parser.parse_args()
+
+    clients = args.clients or args.workers * 2
+    hashed = hash_password('correct horse', args.rounds)
+
+    inline = PasswordHasher()
+    inline.rounds = args.rounds
+    inline.workers = 0
+
+    inline_logins = max(args.logins // 4, 5)
+    seconds, _ = timed(inline_logins,
+                       lambda: inline.check(hashed, 'correct horse'))
+    inline_rate = inline_logins / seconds
+
+    hasher = PasswordHasher()
+    hasher.rounds = args.rounds
+    hasher.workers = args.workers
+    hasher.queue_depth = clients
+
+    hasher.get_pool()
+    hasher.check(hashed, 'correct horse')  # start the workers
+
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as requests:
+        results = list(requests.map(
+            lambda _: timed(args.logins,
+                            lambda: hasher.check(hashed, 'correct horse')),
+            range(clients)))
+    seconds = perf_counter() - started
+    hasher.shutdown()
+
+    rejected = sum(rejected for _, rejected in results)
+    pool_rate = (clients * args.logins - rejected) / seconds
+
+    report = {
+        'rounds': args.rounds,
+        'workers': args.workers,
+        'clients': clients,
+        'inline_logins_per_second': round(inline_rate, 2),
+        'pool_logins_per_second': round(pool_rate, 2),
+        'pool_logins_per_second_per_core': round(pool_rate / args.workers, 2),
+        'rejected': rejected,
+    }
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
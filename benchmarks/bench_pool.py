@@ -0,0 +1,166 @@
+"""Connection pool saturation benchmark (see pools.py).
+
+Runs more and more concurrent clients against one process's pool, each
+checking out a connection, holding it for a query of --hold milliseconds
+and returning it, over and over. Below the pool's size plus overflow,
+checkouts are immediate; past it, clients queue for connections, checkout
+waits climb with the queue, throughput stops growing, and once a wait
+passes --timeout, checkouts fail. For each level it reports throughput,
+checkout wait percentiles, the peak number of clients waiting, timeouts,
+and the pool monitor's checkout histogram:
+
+    DATABASE_URL=postgresql:///warbler \\
+        python benchmarks/bench_pool.py --pool-size 10 --max-overflow 5 \\
+        --clients 5,10,15,20,40 --output pool.json
+
+The query is pg_sleep on PostgreSQL; elsewhere the client just sleeps
+while holding the connection.
+"""
+
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask  # noqa: E402
+from sqlalchemy.exc import TimeoutError as PoolTimeout  # noqa: E402
+
+from models import db  # noqa: E402
+from pools import PoolMonitor  # noqa: E402
+
+# how often to look at how many clients are waiting, in seconds
+SAMPLE_INTERVAL = 0.005
+
+
+def make_app(args):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL', 'postgresql:///warbler')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_POOL_SIZE'] = args.pool_size
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = args.max_overflow
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = args.timeout
+
+    monitor = PoolMonitor(app)
+    db.init_app(app)
+    return app, monitor
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    value = samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    return round(value * 1000, 2)
+
+
+def run_level(args, clients):
+    """Run `clients` clients for --seconds; returns that level's report."""
+
+    app, monitor = make_app(args)
+    with app.app_context():
+        engine = db.get_engine(app)
+        hold = args.hold / 1000
+        if engine.dialect.name == 'postgresql':
+            def query(conn):
+                conn.execute("SELECT pg_sleep(%(hold)s)", hold=hold)
+        else:
+            def query(conn):
+                conn.execute("SELECT 1")
+                sleep(hold)
+
+        stopping = Event()
+        peak_waiting = peak_overflow = 0
+
+        def watch():
+            nonlocal peak_waiting, peak_overflow
+            while not stopping.is_set():
+                peak_waiting = max(peak_waiting, engine.pool.stats.waiting)
+                peak_overflow = max(peak_overflow, engine.pool.overflow())
+                sleep(SAMPLE_INTERVAL)
+
+        def client(_):
+            waits, timeouts = [], 0
+            deadline = perf_counter() + args.seconds
+            while perf_counter() < deadline:
+                started = perf_counter()
+                try:
+                    conn = engine.connect()
+                except PoolTimeout:
+                    timeouts += 1
+                    continue
+                waits.append(perf_counter() - started)
+                try:
+                    query(conn)
+                finally:
+                    conn.close()
+            return waits, timeouts
+
+        watcher = Thread(target=watch, daemon=True)
+        watcher.start()
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=clients) as pool:
+            results = list(pool.map(client, range(clients)))
+        seconds = perf_counter() - started
+        stopping.set()
+        watcher.join()
+
+        waits = [wait for client_waits, _ in results for wait in client_waits]
+        stats = monitor.stats()['primary']
+        engine.dispose()
+
+    return {
+        'clients': clients,
+        'queries_per_second': round(len(waits) / seconds, 2),
+        'checkout_p50_ms': percentile(waits, 0.50),
+        'checkout_p95_ms': percentile(waits, 0.95),
+        'checkout_p99_ms': percentile(waits, 0.99),
+        'peak_waiting': peak_waiting,
+        'peak_overflow': peak_overflow,
+        'timeouts': sum(timeouts for _, timeouts in results),
+        'checkout_ms': stats['checkout_ms'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pool-size', type=int, default=10)
+    parser.add_argument('--max-overflow', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=5,
+                        help="seconds to wait for a connection")
+    parser.add_argument('--clients', default='5,10,15,20,40',
+                        help="comma-separated client counts to run")
+    parser.add_argument('--hold', type=float, default=20,
+                        help="milliseconds each query holds its connection")
+    parser.add_argument('--seconds', type=float, default=5,
+                        help="how long to run each level")
+    parser.add_argument('--output', help="write results as JSON here")
+    args = parser.parse_args()
+
+    levels = []
+    for clients in [int(count) for count in args.clients.split(',')]:
+        level = run_level(args, clients)
+        print(json.dumps({key: value for key, value in level.items()
+                          if key != 'checkout_ms'}))
+        levels.append(level)
+
+    report = {
+        'pool_size': args.pool_size,
+        'max_overflow': args.max_overflow,
+        'timeout': args.timeout,
+        'hold_ms': args.hold,
+        'levels': levels,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""In-process caches for Warbler."""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """A thread-safe least-recently-used cache.
+
+    Holds at most `maxsize` entries, dropping the least recently used when
+    full; with a `ttl`, entries also expire that many seconds after they're
+    set. Hit, miss and eviction counts are kept for monitoring.
+
+    To bound something other than the number of entries, pass `weigh`, a
+    function giving each value's weight (say, its size in bytes); then
+    `maxsize` limits the total weight instead.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """The value cached for `key`, or `default`."""
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires, weight = entry
+            if expires is not None and expires <= monotonic():
+                del self.entries[key]
+                self.weight -= weight
+                self.misses += 1
+                return default
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Cache `value` under `key`."""
+
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        weight = self.weigh(value) if self.weigh is not None else 1
+
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (value, expires, weight)
+            self.weight += weight
+
+            while self.weight > self.maxsize:
+                _, (_, _, evicted_weight) = self.entries.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def delete(self, key):
+        """Forget `key`, if it's cached."""
+
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        """Counts for monitoring."""
+
+        with self.lock:
+            return {
+                'size': len(self.entries),
+                'weight': self.weight,
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
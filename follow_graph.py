@@ -0,0 +1,396 @@
+"""A memory-mapped index of who follows whom.
+
+Checking "does A follow B?" against the follows table costs a query per
+check, and the templates ask it for every user on a page. FollowGraph
+answers it from a snapshot of the table laid out as two CSR (compressed
+sparse row) adjacency arrays -- one indexed by follower, one by followed
+user -- in a single file. Every worker process maps the same file, so
+the operating system keeps one copy of it in memory however many workers
+there are.
+
+A user's neighbours sit sorted in one contiguous slice of the targets
+array, so membership is a binary search of that slice and a user's
+following/follower count is the difference of two offsets.
+
+Follows and unfollows made after the snapshot was built are appended to
+a log next to it (fixed-size records written with O_APPEND, so workers
+can't interleave them). Each process replays new log records into an
+in-memory overlay at the start of every request. `flask
+build-follow-graph` writes a fresh snapshot, which starts a new log;
+workers notice the new file and switch over.
+
+Settings, read by init_app:
+
+FOLLOW_GRAPH_PATH
+    where the snapshot lives (default: the FOLLOW_GRAPH_PATH environment
+    variable). When it is unset, or the snapshot hasn't been built yet,
+    User.is_following and friends query the database instead.
+"""
+
+import os
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from threading import Lock
+
+MAGIC = b'WFGRAPH1'
+
+# magic, generation, node count (highest user id + 1), edge count
+HEADER = struct.Struct('=8sqqq')
+
+# followed (1) or unfollowed (0), follower id, followed id
+RECORD = struct.Struct('=iii')
+
+
+def _array(view, pos, typecode, count):
+    """Slice `count` items of `typecode` out of `view` at byte `pos`.
+
+    Returns the array and the (8-byte aligned) position after it.
+    """
+
+    size = struct.calcsize(typecode) * count
+    end = pos + size
+    return view[pos:end].cast(typecode), end + (-end % 8)
+
+
+def _csr(edges, node_count):
+    """Offsets and targets arrays for (source, target) pairs sorted by source."""
+
+    offsets = [0] * (node_count + 1)
+    for source, _ in edges:
+        offsets[source + 1] += 1
+    for node in range(node_count):
+        offsets[node + 1] += offsets[node]
+
+    return offsets, [target for _, target in edges]
+
+
+def write_snapshot(path, edges, generation):
+    """Write a snapshot of `edges`, (follower id, followed id) pairs, to `path`."""
+
+    out_edges = sorted(set(edges))
+    in_edges = sorted((followed, follower) for follower, followed in out_edges)
+    node_count = max((max(edge) for edge in out_edges), default=-1) + 1
+
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, generation, node_count, len(out_edges)))
+        for offsets, targets in (_csr(out_edges, node_count),
+                                 _csr(in_edges, node_count)):
+            for typecode, items in (('q', offsets), ('i', targets)):
+                data = array(typecode, items).tobytes()
+                f.write(data + bytes(-len(data) % 8))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class Snapshot:
+    """A read-only, memory-mapped follow graph snapshot."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.identity = (stat.st_dev, stat.st_ino)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.generation, self.node_count, self.edge_count = (
+            HEADER.unpack_from(self.mmap))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a follow graph snapshot")
+
+        view = memoryview(self.mmap)
+        pos = HEADER.size
+        self.out_offsets, pos = _array(view, pos, 'q', self.node_count + 1)
+        self.out_targets, pos = _array(view, pos, 'i', self.edge_count)
+        self.in_offsets, pos = _array(view, pos, 'q', self.node_count + 1)
+        self.in_targets, pos = _array(view, pos, 'i', self.edge_count)
+
+    def _row(self, offsets, node):
+        if 0 <= node < self.node_count:
+            return offsets[node], offsets[node + 1]
+        return 0, 0
+
+    def contains(self, follower_id, followed_id):
+        """Does the snapshot have `follower_id` following `followed_id`?"""
+
+        lo, hi = self._row(self.out_offsets, follower_id)
+        i = bisect_left(self.out_targets, followed_id, lo, hi)
+        return i < hi and self.out_targets[i] == followed_id
+
+    def following(self, user_id):
+        """Ids `user_id` follows in the snapshot."""
+
+        lo, hi = self._row(self.out_offsets, user_id)
+        return self.out_targets[lo:hi].tolist()
+
+    def followers(self, user_id):
+        """Ids following `user_id` in the snapshot."""
+
+        lo, hi = self._row(self.in_offsets, user_id)
+        return self.in_targets[lo:hi].tolist()
+
+    def following_count(self, user_id):
+        lo, hi = self._row(self.out_offsets, user_id)
+        return hi - lo
+
+    def followers_count(self, user_id):
+        lo, hi = self._row(self.in_offsets, user_id)
+        return hi - lo
+
+
+class Overlay:
+    """Follows and unfollows logged since a snapshot was built.
+
+    Kept by follower and by followed user, so one user's changes can be
+    read without looking through everyone's.
+    """
+
+    def __init__(self):
+        # follower id -> {followed id: followed?}, where that differs
+        # from the snapshot; and the same the other way round
+        self.by_follower = {}
+        self.by_followed = {}
+        self.following_deltas = {}
+        self.followers_deltas = {}
+
+    def get(self, follower_id, followed_id):
+        """Followed?, if that differs from the snapshot; else None."""
+
+        return self.by_follower.get(follower_id, {}).get(followed_id)
+
+    def set(self, follower_id, followed_id, state):
+        """Record a difference from the snapshot; None drops it."""
+
+        for index, key, other in [
+                (self.by_follower, follower_id, followed_id),
+                (self.by_followed, followed_id, follower_id)]:
+            if state is None:
+                changes = index.get(key, {})
+                changes.pop(other, None)
+                if not changes:
+                    index.pop(key, None)
+            else:
+                index.setdefault(key, {})[other] = state
+
+
+class FollowGraph:
+    """A Snapshot plus the follows and unfollows logged since it was built."""
+
+    def __init__(self, app=None):
+        self.path = None
+        self.lock = Lock()
+        # (snapshot, overlay), swapped as one so lock-free readers never
+        # see a new snapshot with an old overlay, or none at all
+        self.current = None
+        self.log_fd = None
+        self.log_offset = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.path = app.config.setdefault('FOLLOW_GRAPH_PATH',
+                                          os.environ.get('FOLLOW_GRAPH_PATH'))
+        app.before_request(self.refresh)
+
+    def log_path(self, generation):
+        return f"{self.path}.{generation}.log"
+
+    @property
+    def loaded(self):
+        """Is there a snapshot to answer questions from?"""
+
+        return self.current is not None
+
+    @property
+    def snapshot(self):
+        return self.current[0] if self.current is not None else None
+
+    def close(self):
+        """Forget the current snapshot and log."""
+
+        with self.lock:
+            if self.log_fd is not None:
+                os.close(self.log_fd)
+            self.current = None
+            self.log_fd = None
+            self.log_offset = 0
+
+    def refresh(self):
+        """Pick up a rebuilt snapshot and any newly logged changes."""
+
+        if self.path is None:
+            return
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self.loaded:
+                self.close()
+            return
+
+        with self.lock:
+            if (self.current is None or
+                    self.snapshot.identity != (stat.st_dev, stat.st_ino)):
+                self._open()
+            self._replay()
+
+    def _open(self):
+        snapshot = Snapshot(self.path)
+        log_fd = os.open(self.log_path(snapshot.generation),
+                         os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+
+        # the old mapping is unmapped once nothing refers to it
+        old_fd, self.log_fd, self.log_offset = self.log_fd, log_fd, 0
+        self.current = (snapshot, Overlay())
+        if old_fd is not None:
+            os.close(old_fd)
+
+    def _replay(self):
+        """Apply log records written (by any process) since we last looked."""
+
+        size = os.fstat(self.log_fd).st_size
+        # ignore a record that is only partly written
+        end = size - (size - self.log_offset) % RECORD.size
+        if end <= self.log_offset:
+            return
+
+        data = os.pread(self.log_fd, end - self.log_offset, self.log_offset)
+        self.log_offset = end
+
+        snapshot, overlay = self.current
+        for state, follower_id, followed_id in RECORD.iter_unpack(data):
+            self._apply(snapshot, overlay, follower_id, followed_id,
+                        bool(state))
+
+    def _apply(self, snapshot, overlay, follower_id, followed_id, state):
+        in_snapshot = snapshot.contains(follower_id, followed_id)
+        current = overlay.get(follower_id, followed_id)
+        if (in_snapshot if current is None else current) == state:
+            return
+
+        overlay.set(follower_id, followed_id,
+                    None if in_snapshot == state else state)
+
+        delta = 1 if state else -1
+        overlay.following_deltas[follower_id] = (
+            overlay.following_deltas.get(follower_id, 0) + delta)
+        overlay.followers_deltas[followed_id] = (
+            overlay.followers_deltas.get(followed_id, 0) + delta)
+
+    def _log(self, records):
+        if not self.loaded or not records:
+            return
+
+        with self.lock:
+            os.write(self.log_fd, b''.join(
+                RECORD.pack(int(state), follower_id, followed_id)
+                for state, follower_id, followed_id in records))
+            self._replay()
+
+    def add(self, follower_id, followed_id):
+        """Record that `follower_id` now follows `followed_id`."""
+
+        self._log([(True, follower_id, followed_id)])
+
+    def remove(self, follower_id, followed_id):
+        """Record that `follower_id` no longer follows `followed_id`."""
+
+        self._log([(False, follower_id, followed_id)])
+
+    def remove_user(self, user_id):
+        """Record that `user_id`'s follows went with their account."""
+
+        if not self.loaded:
+            return
+
+        self._log(
+            [(False, user_id, followed_id)
+             for followed_id in self.following(user_id)] +
+            [(False, follower_id, user_id)
+             for follower_id in self.followers(user_id)])
+
+    def is_following(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`?"""
+
+        snapshot, overlay = self.current
+        state = overlay.get(follower_id, followed_id)
+        if state is not None:
+            return state
+        return snapshot.contains(follower_id, followed_id)
+
+    def following(self, user_id):
+        """Ids of the users `user_id` follows."""
+
+        snapshot, overlay = self.current
+        return self._merge(snapshot.following(user_id),
+                           overlay.by_follower, user_id)
+
+    def followers(self, user_id):
+        """Ids of the users following `user_id`."""
+
+        snapshot, overlay = self.current
+        return self._merge(snapshot.followers(user_id),
+                           overlay.by_followed, user_id)
+
+    def _merge(self, ids, index, user_id):
+        # other threads replay into the overlay as we read it
+        with self.lock:
+            changes = dict(index.get(user_id, {}))
+
+        ids = set(ids)
+        for other_id, state in changes.items():
+            (ids.add if state else ids.discard)(other_id)
+        return ids
+
+    def following_count(self, user_id):
+        snapshot, overlay = self.current
+        return (snapshot.following_count(user_id) +
+                overlay.following_deltas.get(user_id, 0))
+
+    def followers_count(self, user_id):
+        snapshot, overlay = self.current
+        return (snapshot.followers_count(user_id) +
+                overlay.followers_deltas.get(user_id, 0))
+
+    def rebuild(self, edges):
+        """Replace the snapshot with one of `edges`, (follower, followed) pairs.
+
+        `edges` may be a lazy query: changes logged while it is being read
+        are carried over into the new snapshot's log. Workers switch to the
+        new snapshot on their next request; a change a worker logs in the
+        moment between the carry-over and the switch is missed until the
+        next rebuild.
+        """
+
+        try:
+            with open(self.path, 'rb') as f:
+                generation = HEADER.unpack(f.read(HEADER.size))[1]
+        except FileNotFoundError:
+            generation = 0
+
+        old_log = self.log_path(generation)
+        try:
+            carried = os.stat(old_log).st_size
+        except FileNotFoundError:
+            carried = None
+
+        tmp_path = f"{self.path}.tmp"
+        write_snapshot(tmp_path, edges, generation + 1)
+
+        with open(self.log_path(generation + 1), 'wb') as new_log:
+            if carried is not None:
+                with open(old_log, 'rb') as f:
+                    f.seek(carried)
+                    tail = f.read()
+                    # copy whole records only: a writer may be mid-append
+                    tail = tail[:len(tail) - len(tail) % RECORD.size]
+                new_log.write(tail)
+
+        os.replace(tmp_path, self.path)
+
+        if carried is not None:
+            os.remove(old_log)
+
+
+follow_graph = FollowGraph()
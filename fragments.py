@@ -0,0 +1,76 @@
+"""Cached HTML fragments for Warbler pages.
+
+Timelines, profiles and likes pages are mostly lists of message cards
+(templates/messages/card.html), and a message's card hardly ever changes:
+messages can't be edited, so only their author's name and picture and
+whether the viewer likes them vary. MessageCards renders each card once
+and keeps the HTML in a byte-bounded LRU cache, keyed by
+
+    (message id, author's profile_version, liked)
+
+Editing a profile changes its profile_version, so every process stops
+using that author's old cards without being told; they age out of the
+cache like any other cold entry. Deleted messages are dropped explicitly
+(see messages_destroy).
+
+The card template must only use the message and `liked`: anything else
+it showed (the current user, say) would be served from the cache to
+whoever happened to ask next.
+
+Settings, read by init_app:
+
+MESSAGE_CARD_CACHE_BYTES
+    how much rendered HTML to keep (default 8 MiB).
+"""
+
+import sys
+
+from markupsafe import Markup
+
+from cache import LRUCache
+
+CARD_TEMPLATE = 'messages/card.html'
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+
+
+class MessageCards:
+    """Renders message cards, caching the HTML."""
+
+    def __init__(self, app=None):
+        self.cache = LRUCache(maxsize=DEFAULT_CACHE_BYTES, weigh=sys.getsizeof)
+        self.jinja_env = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.cache.maxsize = app.config.setdefault('MESSAGE_CARD_CACHE_BYTES',
+                                                   DEFAULT_CACHE_BYTES)
+        self.jinja_env = app.jinja_env
+        app.jinja_env.globals['message_card'] = self.render
+
+    def key(self, message, liked):
+        return (message.id, message.user.profile_version, liked)
+
+    def render(self, message, liked=None):
+        """The card for `message`; `liked` is None to leave out the like button."""
+
+        key = self.key(message, liked)
+        html = self.cache.get(key)
+
+        if html is None:
+            html = Markup(self.jinja_env
+                          .get_template(CARD_TEMPLATE)
+                          .render(msg=message, liked=liked))
+            self.cache.set(key, html)
+
+        return html
+
+    def forget(self, message):
+        """Drop every cached card for `message`."""
+
+        for liked in (None, True, False):
+            self.cache.delete(self.key(message, liked))
+
+
+message_cards = MessageCards()
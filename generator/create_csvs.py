@@ -2,29 +2,67 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows -- up to load-testing
+sizes:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --likes 20000000 --processes 8
+
+and then `flask seed --data-dir <out dir>`.
+
+The data aims to look like a real social network's. How many followers
+users have follows a power law (a few have a huge following, most have a
+handful), as does how much they post; how many users they follow is
+heavy-tailed too. Posts cluster in bursts rather than spreading evenly
+over time.
+
+Rows are written in shards, on several processes, each shard with its own
+random generator seeded from --seed and the shard's position, so the same
+arguments always give the same files, however many processes make them.
+Nothing here needs the network.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+from itertools import accumulate
+from multiprocessing import Pool
+
 from faker import Faker
-from helpers import get_random_datetime
+
+from helpers import get_bursts, get_random_datetime
 
 MAX_WARBLER_LENGTH = 140
 
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+NUM_LIKES = 2000
+
+# bcrypt hash of "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-fake = Faker()
+# timestamps end here by default, so output doesn't depend on the date
+END = datetime(2018, 10, 1)
+YEAR_GAP = 2
+NUM_BURSTS = 200
 
-# Generate random profile image URLs to use for users
+# Pareto shapes: smaller is more unequal
+POPULARITY_SHAPE = 1.2
+ACTIVITY_SHAPE = 1.5
+DEGREE_SHAPE = 2.0
+
+ROWS_PER_SHARD = 100000
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +70,188 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+with open(os.path.join(os.path.dirname(__file__),
+                       'header_images.txt')) as f:
+    header_image_urls = f.read().split()
+
+
+def cumulative_weights(rng, count, shape):
+    """Running totals of `count` Pareto-distributed weights."""
+
+    return list(accumulate(rng.paretovariate(shape) for _ in range(count)))
+
+
+def degree(rng, mean, most):
+    """A heavy-tailed count averaging about `mean`, at most `most`."""
+
+    # a Pareto variate with shape a has mean a / (a - 1)
+    scale = mean * (DEGREE_SHAPE - 1) / DEGREE_SHAPE
+    return min(int(scale * rng.paretovariate(DEGREE_SHAPE)), most)
+
+
+# Set in each worker process by init_worker, since they're big and the same
+# for every shard.
+options = None
+popularity = None
+activity = None
+bursts = None
+
+
+def init_worker(worker_options):
+    global options, popularity, activity, bursts
+
+    options = worker_options
+    rng = random.Random(f"{options.seed}:shared")
+    popularity = cumulative_weights(rng, options.users, POPULARITY_SHAPE)
+    activity = cumulative_weights(rng, options.users, ACTIVITY_SHAPE)
+    bursts = get_bursts(NUM_BURSTS, YEAR_GAP, rng, options.end)
+
+
+def shard_rng(table, start):
+    seed = f"{options.seed}:{table}:{start}"
+    fake = Faker()
+    fake.seed_instance(seed)
+    return random.Random(seed), fake
+
+
+def write_shard(shard):
+    """Write a (table, start, stop) shard's rows to a file; return its path."""
+
+    table, start, stop = shard
+    rng, fake = shard_rng(table, start)
+    rows = ROWS[table](rng, fake, start, stop)
+
+    fd, path = tempfile.mkstemp(dir=options.tmp_dir, suffix='.csv')
+    with os.fdopen(fd, 'w', newline='') as f:
+        csv.writer(f).writerows(rows)
+    return path
+
+
+def users_rows(rng, fake, start, stop):
+    for user_id in range(start, stop):
+        # numbered, so they stay unique however many we make
+        username = f"{fake.user_name()}{user_id}"
+        yield [
+            f"{username}@{fake.free_email_domain()}",
+            username,
+            rng.choice(image_urls),
+            PASSWORD,
+            fake.sentence(),
+            rng.choice(header_image_urls),
+            fake.city(),
+        ]
+
+
+def messages_rows(rng, fake, start, stop):
+    authors = range(1, options.users + 1)
+    for _ in range(start, stop):
+        yield [
+            fake.paragraph()[:MAX_WARBLER_LENGTH],
+            get_random_datetime(YEAR_GAP, rng, options.end, bursts),
+            rng.choices(authors, cum_weights=activity)[0],
+        ]
+
+
+def follows_rows(rng, fake, start, stop):
+    """Follows by users `start` up to `stop`, of popular users mostly."""
+
+    users = range(1, options.users + 1)
+    mean = options.follows / options.users
+
+    for follower in range(start, stop):
+        wanted = degree(rng, mean, options.users - 1)
+        followed = set()
+
+        # popular users come up again and again; don't try forever
+        for _ in range(10):
+            picks = rng.choices(users, cum_weights=popularity,
+                                k=wanted - len(followed))
+            followed.update(pick for pick in picks if pick != follower)
+            if len(followed) >= wanted:
+                break
+
+        for user_id in sorted(followed):
+            yield [user_id, follower]
+
+
+def likes_rows(rng, fake, start, stop):
+    """Likes by users `start` up to `stop`."""
+
+    mean = options.likes / options.users
+
+    for user_id in range(start, stop):
+        wanted = degree(rng, mean, options.messages)
+        for message_id in sorted(rng.sample(range(1, options.messages + 1),
+                                            wanted)):
+            yield [user_id, message_id]
+
+
+ROWS = {
+    'users': users_rows,
+    'messages': messages_rows,
+    'follows': follows_rows,
+    'likes': likes_rows,
+}
+
+
+def generate(pool, table, headers, shards):
+    """Write `table`.csv from `shards`, (start, stop) row ranges."""
+
+    path = os.path.join(options.out_dir, f'{table}.csv')
+    with open(path, 'w', newline='') as out:
+        csv.writer(out).writerow(headers)
+
+        parts = pool.imap(write_shard, [(table, start, stop)
+                                        for start, stop in shards])
+        for done, part in enumerate(parts, start=1):
+            with open(part) as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+            print(f"{table}: {done}/{len(shards)} shards", file=sys.stderr)
+
+
+def shards(first, last, per_shard):
+    """(start, stop) ranges covering `first` to `last` inclusive."""
+
+    return [(start, min(start + per_shard, last + 1))
+            for start in range(first, last + 1, per_shard)]
+
+
+def main(argv=None):
+    global options
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS,
+                        help="roughly how many follows to make")
+    parser.add_argument('--likes', type=int, default=NUM_LIKES,
+                        help="roughly how many likes to make")
+    parser.add_argument('--seed', default='warbler')
+    parser.add_argument('--end', type=datetime.fromisoformat, default=END,
+                        help="latest message timestamp")
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--out-dir', default=os.path.dirname(__file__))
+    options = parser.parse_args(argv)
+
+    # follows and likes are made per user, so shard those by user; a
+    # user's follows and likes are a few dozen rows, not one
+    user_shard = max(1, ROWS_PER_SHARD * options.users //
+                     max(options.follows + options.likes, options.users))
+
+    with tempfile.TemporaryDirectory(dir=options.out_dir) as tmp_dir:
+        options.tmp_dir = tmp_dir
+        with Pool(options.processes, init_worker, (options,)) as pool:
+            generate(pool, 'users', USERS_CSV_HEADERS,
+                     shards(1, options.users, ROWS_PER_SHARD))
+            generate(pool, 'messages', MESSAGES_CSV_HEADERS,
+                     shards(1, options.messages, ROWS_PER_SHARD))
+            generate(pool, 'follows', FOLLOWS_CSV_HEADERS,
+                     shards(1, options.users, user_shard))
+            if options.likes:
+                generate(pool, 'likes', LIKES_CSV_HEADERS,
+                         shards(1, options.users, user_shard))
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,36 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
+from math import log
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, rng=random, now=None, bursts=(),
+                        burst_share=0.5, burst_width=timedelta(hours=6)):
+    """Get a random datetime within the last few years.
 
-    now = datetime.now()
+    Real posting isn't spread evenly: things happen, and everyone talks
+    about them at once. Given `bursts` (see get_bursts), `burst_share` of
+    the datetimes fall shortly after one of them, most within
+    `burst_width`, and the rest anywhere in the range.
+
+    Pass a seeded `rng` and a fixed `now` for repeatable results.
+    """
+
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+
+    if bursts and rng.random() < burst_share:
+        start = rng.choice(bursts)
+        offset = -log(1 - rng.random()) * burst_width.total_seconds()
+        return min(start + timedelta(seconds=offset), now)
+
+    random_timestamp = rng.uniform(then.timestamp(), now.timestamp())
 
     return datetime.fromtimestamp(random_timestamp)
+
+
+def get_bursts(count, year_gap=2, rng=random, now=None):
+    """Get `count` random burst starts for get_random_datetime."""
+
+    return [get_random_datetime(year_gap, rng, now) for _ in range(count)]
@@ -0,0 +1,388 @@
+"""Thumbnails of users' profile and header images, served by us.
+
+Users' image_url and header_image_url can point anywhere, at pictures of
+any size; the timeline used to have every browser download each one in
+full to show it 48 pixels wide. ImageProxy serves a fixed-size JPEG
+instead:
+
+    /images/<size>/<token>
+
+where `token` is the source URL, signed so that only URLs we rendered
+can be fetched. Templates get these URLs from thumbnail_url(src, size).
+
+Each source is fetched once. Everything goes in an on-disk cache that is
+addressed by content: originals/ holds fetched images under the sha256 of
+their bytes, thumbs/<size>/ the thumbnails of those, and sources/ maps a
+source URL to the hash of what it returned. So users sharing a picture
+(the default one, say) share its files. When the cache outgrows
+IMAGE_CACHE_BYTES, the least recently used files are removed; serving a
+file marks it used.
+
+A source that can't be fetched or isn't an image is redirected to as-is,
+and not retried for a few minutes.
+
+Settings, read by init_app:
+
+IMAGE_CACHE_DIR
+    where the cache lives (default: images/ in the instance folder).
+IMAGE_CACHE_BYTES
+    how big it may get (default 256 MiB).
+IMAGE_FETCH_TIMEOUT
+    seconds to wait for a source (default 5).
+IMAGE_FETCH_MAX_BYTES
+    biggest source we'll take (default 10 MiB).
+IMAGE_PROXY_ALLOW_PRIVATE
+    whether sources may be on private or loopback addresses (default
+    False, so users can't point us at internal services).
+"""
+
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+from http.client import HTTPConnection, HTTPSConnection
+from threading import Lock
+from urllib.parse import urlsplit
+from urllib.request import (HTTPHandler, HTTPRedirectHandler, HTTPSHandler,
+                            build_opener)
+
+from flask import abort, redirect, safe_join, send_file, url_for
+from itsdangerous import BadSignature, URLSafeSerializer
+from PIL import Image, ImageOps
+
+from cache import LRUCache
+
+# name -> (width, height); twice the size they're shown at, for high-DPI
+# screens
+SIZES = {
+    'timeline': (96, 96),
+    'card': (140, 140),
+    'avatar': (400, 400),
+    'header': (1500, 500),
+}
+
+DEFAULT_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_FETCH_TIMEOUT = 5
+DEFAULT_FETCH_MAX_BYTES = 10 * 1024 * 1024
+
+# how long to keep redirecting a source that failed, in seconds
+FAILURE_TTL = 300
+
+# how long browsers keep a thumbnail; the source URL can start returning a
+# new picture, so not forever
+MAX_AGE = 24 * 60 * 60
+
+JPEG_QUALITY = 85
+
+
+class ImageUnavailable(Exception):
+    """A source couldn't be fetched or turned into a thumbnail."""
+
+
+def digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def public_addresses(host, port):
+    """getaddrinfo() for `host`, refusing it if any address isn't public."""
+
+    try:
+        infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError as exc:
+        raise ImageUnavailable(host) from exc
+
+    for *_, sockaddr in infos:
+        if not ipaddress.ip_address(sockaddr[0].split('%')[0]).is_global:
+            raise ImageUnavailable(host)
+    return infos
+
+
+def connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT,
+                   source_address=None):
+    """socket.create_connection(), to the public addresses we checked.
+
+    Looking the host up once, here, means it can't pass the check and
+    then resolve somewhere internal when we connect (DNS rebinding).
+    """
+
+    host, port = address
+    error = None
+    for *_, sockaddr in public_addresses(host, port):
+        try:
+            return socket.create_connection(sockaddr[:2], timeout,
+                                            source_address)
+        except OSError as exc:
+            error = exc
+    raise error
+
+
+class PublicHTTPConnection(HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPSConnection(HTTPSConnection):
+    # still verified against, and sent (SNI), the host's name
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPHandler(HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req,
+                            context=self._context,
+                            check_hostname=self._check_hostname)
+
+
+class CheckedRedirectHandler(HTTPRedirectHandler):
+    """Follows redirects only to hosts `proxy` may fetch from."""
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        self.proxy.check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class ImageProxy:
+    """Fetches, thumbnails, caches and serves users' images."""
+
+    def __init__(self, app=None):
+        self.signer = None
+        self.static_folder = None
+        self.cache_dir = None
+        self.cache_bytes = DEFAULT_CACHE_BYTES
+        self.fetch_timeout = DEFAULT_FETCH_TIMEOUT
+        self.fetch_max_bytes = DEFAULT_FETCH_MAX_BYTES
+        self.allow_private = False
+
+        self.failures = LRUCache(maxsize=10000, ttl=FAILURE_TTL)
+
+        # our running estimate of the cache's size; None until measured
+        self.usage = None
+        self.usage_lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.signer = URLSafeSerializer(app.secret_key, salt='image-proxy')
+        self.static_folder = app.static_folder
+        self.cache_dir = app.config.setdefault(
+            'IMAGE_CACHE_DIR', os.path.join(app.instance_path, 'images'))
+        self.cache_bytes = app.config.setdefault('IMAGE_CACHE_BYTES',
+                                                 DEFAULT_CACHE_BYTES)
+        self.fetch_timeout = app.config.setdefault('IMAGE_FETCH_TIMEOUT',
+                                                   DEFAULT_FETCH_TIMEOUT)
+        self.fetch_max_bytes = app.config.setdefault('IMAGE_FETCH_MAX_BYTES',
+                                                     DEFAULT_FETCH_MAX_BYTES)
+        self.allow_private = app.config.setdefault('IMAGE_PROXY_ALLOW_PRIVATE',
+                                                   False)
+
+        app.add_url_rule('/images/<size>/<token>', 'thumbnail', self.send)
+        app.jinja_env.globals['thumbnail_url'] = self.url
+
+    def url(self, src, size):
+        """URL of the `size` thumbnail of the image at `src`."""
+
+        if not src:
+            return src
+        return url_for('thumbnail', size=size, token=self.signer.dumps(src))
+
+    def send(self, size, token):
+        """Serve a thumbnail, making it first if need be."""
+
+        if size not in SIZES:
+            abort(404)
+
+        try:
+            src = self.signer.loads(token)
+        except BadSignature:
+            abort(404)
+
+        if self.failures.get(src):
+            return redirect(src)
+
+        try:
+            path = self.thumbnail(src, size)
+        except ImageUnavailable:
+            self.failures.set(src, True)
+            return redirect(src)
+
+        response = send_file(path, mimetype='image/jpeg', conditional=True)
+        response.headers['Cache-Control'] = f"public, max-age={MAX_AGE}"
+        return response
+
+    # The cache
+
+    def path(self, *parts):
+        return os.path.join(self.cache_dir, *parts)
+
+    def thumbnail(self, src, size):
+        """Path of the cached `size` thumbnail of `src`."""
+
+        pointer = self.path('sources', digest(src.encode('UTF-8')))
+        original = None
+
+        try:
+            with open(pointer) as f:
+                content = f.read()
+        except FileNotFoundError:
+            original = self.fetch(src)
+            content = digest(original)
+            self.store(pointer, content.encode('ascii'))
+
+        thumb = self.path('thumbs', size, content + '.jpg')
+        if self.touch(thumb):
+            return thumb
+
+        if original is None:
+            try:
+                with open(self.path('originals', content), 'rb') as f:
+                    original = f.read()
+            except FileNotFoundError:
+                # evicted; fetch it again (it may have changed, too)
+                original = self.fetch(src)
+                content = digest(original)
+                self.store(pointer, content.encode('ascii'), replace=True)
+                thumb = self.path('thumbs', size, content + '.jpg')
+
+        resized = self.resize(original, SIZES[size])
+        self.store(self.path('originals', content), original)
+        self.store(thumb, resized)
+        return thumb
+
+    def touch(self, path):
+        """Mark `path` as just used; False if it isn't cached."""
+
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def store(self, path, data, replace=False):
+        """Write `data` to `path` in the cache, atomically.
+
+        Cached content never changes, so if `path` is already there we just
+        mark it used -- unless told to `replace` it.
+        """
+
+        if not replace and self.touch(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self.usage_lock:
+            if self.usage is None:
+                self.usage = self.measure()[0]
+            else:
+                self.usage += len(data)
+
+            if self.usage > self.cache_bytes:
+                self.evict()
+
+    def measure(self):
+        """Total size of the cache and its files, oldest first."""
+
+        files = []
+        for root, dirs, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        files.sort()
+        return sum(size for _, size, _ in files), files
+
+    def evict(self):
+        """Remove least recently used files until the cache is 90% full.
+
+        Other processes write to the cache too, so measure it afresh.
+        """
+
+        self.usage, files = self.measure()
+        target = self.cache_bytes * 0.9
+
+        for _, size, path in files:
+            if self.usage <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.usage -= size
+
+    # Sources
+
+    def fetch(self, src):
+        """The bytes of the image at `src`."""
+
+        if src.startswith('/static/'):
+            try:
+                path = safe_join(self.static_folder, src[len('/static/'):])
+                with open(path, 'rb') as f:
+                    return f.read()
+            except Exception as exc:
+                raise ImageUnavailable(src) from exc
+
+        self.check_url(src)
+        handlers = [CheckedRedirectHandler(self)]
+        if not self.allow_private:
+            handlers += [PublicHTTPHandler(), PublicHTTPSHandler()]
+        opener = build_opener(*handlers)
+
+        try:
+            with opener.open(src, timeout=self.fetch_timeout) as response:
+                data = response.read(self.fetch_max_bytes + 1)
+        except (OSError, ValueError) as exc:
+            raise ImageUnavailable(src) from exc
+
+        if len(data) > self.fetch_max_bytes:
+            raise ImageUnavailable(src)
+
+        return data
+
+    def check_url(self, url):
+        """Refuse URLs we shouldn't fetch from.
+
+        Private addresses are refused when we connect; see connect_public.
+        """
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ImageUnavailable(url)
+
+    def resize(self, data, dimensions):
+        """A JPEG of the image in `data`, cropped to fill `dimensions`."""
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image = ImageOps.fit(image.convert('RGB'), dimensions,
+                                 Image.LANCZOS)
+        except (OSError, ValueError, Image.DecompressionBombError) as exc:
+            raise ImageUnavailable() from exc
+
+        out = io.BytesIO()
+        image.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+
+image_proxy = ImageProxy()
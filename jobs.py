@@ -0,0 +1,441 @@
+"""Background jobs for Warbler's slow write side effects.
+
+Work that doesn't have to finish before the response -- fanning a new
+warble out to thousands of timelines, deleting an account and everything
+in it -- is declared as a task and enqueued instead of done in the view:
+
+    @jobs.task(max_attempts=5)
+    def fan_out_message(message_id):
+        ...
+
+    fan_out_message.enqueue(msg.id)
+    db.session.commit()
+
+Jobs are rows in the `jobs` table of the app's own database, inserted in
+the request's transaction: a job exists exactly when the writes that
+asked for it were committed, and survives restarts. Each process runs a
+small pool of worker threads (JOB_WORKERS) that claim due jobs, run them
+and mark them done in the job's own transaction, so a job's database
+writes and its "done" commit together. A job that raises is retried with
+exponential backoff, up to its max_attempts, then left marked failed with
+its error. A claim is a lease: if a worker dies mid-job, the job is
+picked up again once JOB_LEASE has passed. So a job can run more than
+once, and tasks should be safe to repeat.
+
+Enqueueing with a `key` makes the job idempotent: while a job with that
+key exists (in any state), enqueueing it again does nothing.
+
+Work that must happen only once the job's transaction is committed (like
+telling other processes about it) goes in on_commit().
+
+With JOBS_EAGER on, jobs enqueued by a request are run at the end of that
+request instead, in the same thread -- which is what the tests use.
+`flask run-jobs` runs a worker on its own.
+
+Settings, read by init_app:
+
+JOB_WORKERS
+    worker threads per process (default 2; 0 for none).
+JOB_LEASE
+    seconds a worker may hold a job before others may take it over
+    (default 300).
+JOB_POLL_INTERVAL
+    seconds idle workers wait before looking for jobs from other
+    processes or due retries (default 5).
+JOB_RETENTION
+    seconds finished jobs are kept, idempotency keys and all (default a
+    week).
+JOBS_EAGER
+    run jobs at the end of the request that enqueued them (default False).
+"""
+
+import json
+import logging
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+
+from flask import current_app, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from models import db
+
+logger = logging.getLogger('warbler.jobs')
+
+DEFAULT_WORKERS = 2
+DEFAULT_LEASE = 300
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_RETENTION = 7 * 24 * 60 * 60
+DEFAULT_MAX_ATTEMPTS = 5
+
+# retry after 2, 4, 8, ... seconds, but never wait more than an hour
+MAX_BACKOFF = 60 * 60
+
+# how many recent jobs each task's latency figures cover
+LATENCY_SAMPLES = 1000
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(db.Model):
+    """A task waiting to run, running, or run."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+
+    task = db.Column(db.Text, nullable=False)
+
+    # JSON: [args, kwargs]
+    arguments = db.Column(db.Text, nullable=False)
+
+    key = db.Column(db.Text, unique=True)
+
+    status = db.Column(db.Text, nullable=False, default=QUEUED)
+
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    max_attempts = db.Column(db.Integer, nullable=False)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+
+    # when it may next run: when enqueued, or after a failure, the retry
+    run_at = db.Column(db.DateTime, nullable=False)
+
+    locked_until = db.Column(db.DateTime)
+
+    finished_at = db.Column(db.DateTime)
+
+    last_error = db.Column(db.Text)
+
+
+def on_commit(callback):
+    """Call `callback()` once the session's transaction commits.
+
+    Dropped if it rolls back instead.
+    """
+
+    db.session.info.setdefault('on_commit', []).append(callback)
+
+
+@event.listens_for(db.session, 'after_commit')
+def run_on_commit(session):
+    for callback in session.info.pop('on_commit', []):
+        callback()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_on_commit(session, previous_transaction):
+    session.info.pop('on_commit', None)
+
+
+class Task:
+    """A function that can be run in the background."""
+
+    def __init__(self, queue, function, max_attempts):
+        self.queue = queue
+        self.function = function
+        self.name = function.__name__
+        self.max_attempts = max_attempts
+
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+
+    def enqueue(self, *args, key=None, delay=0, **kwargs):
+        """Run this with these arguments once the session commits.
+
+        Does nothing if a job with `key` already exists.
+        """
+
+        self.queue.enqueue(self, args, kwargs, key, delay)
+
+
+class TaskStats:
+    """What happened to one task's jobs in this process."""
+
+    def __init__(self):
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+        # seconds from due to started, and spent running
+        self.waits = deque(maxlen=LATENCY_SAMPLES)
+        self.runs = deque(maxlen=LATENCY_SAMPLES)
+
+    def as_dict(self):
+        def percentile(samples, fraction):
+            if not samples:
+                return None
+            samples = sorted(samples)
+            value = samples[min(len(samples) - 1, int(len(samples) * fraction))]
+            return round(value * 1000, 2)
+
+        return {
+            'succeeded': self.succeeded,
+            'retried': self.retried,
+            'failed': self.failed,
+            'wait_p50_ms': percentile(self.waits, 0.50),
+            'wait_p95_ms': percentile(self.waits, 0.95),
+            'run_p50_ms': percentile(self.runs, 0.50),
+            'run_p95_ms': percentile(self.runs, 0.95),
+        }
+
+
+class JobQueue:
+    """Enqueues tasks as jobs and runs them on a pool of threads."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.tasks = {}
+        self.workers = DEFAULT_WORKERS
+        self.lease = DEFAULT_LEASE
+        self.poll_interval = DEFAULT_POLL_INTERVAL
+        self.retention = DEFAULT_RETENTION
+
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.stopping = Event()
+        self.pool_pid = None
+        self.last_pruned = None
+        self.stats_by_task = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config.setdefault('JOB_WORKERS', DEFAULT_WORKERS)
+        self.lease = app.config.setdefault('JOB_LEASE', DEFAULT_LEASE)
+        self.poll_interval = app.config.setdefault('JOB_POLL_INTERVAL',
+                                                   DEFAULT_POLL_INTERVAL)
+        self.retention = app.config.setdefault('JOB_RETENTION',
+                                               DEFAULT_RETENTION)
+        app.config.setdefault('JOBS_EAGER', False)
+
+        app.after_request(self.run_eagerly)
+
+    def task(self, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Decorator declaring a task."""
+
+        def decorator(function):
+            task = Task(self, function, max_attempts)
+            self.tasks[task.name] = task
+            return task
+
+        return decorator
+
+    # Enqueueing
+
+    def enqueue(self, task, args, kwargs, key=None, delay=0):
+        now = datetime.utcnow()
+        values = dict(
+            task=task.name,
+            arguments=json.dumps([args, kwargs]),
+            key=key,
+            status=QUEUED,
+            attempts=0,
+            max_attempts=task.max_attempts,
+            created_at=now,
+            run_at=now + timedelta(seconds=delay),
+        )
+
+        table = Job.__table__
+        if db.session.get_bind().dialect.name == 'postgresql':
+            insert = pg_insert(table).on_conflict_do_nothing(
+                index_elements=['key'])
+        else:
+            insert = table.insert().prefix_with('OR IGNORE')
+        db.session.execute(insert.values(**values))
+
+        # read per request, so tests can turn it on after init_app
+        if has_request_context() and current_app.config['JOBS_EAGER']:
+            g.jobs_enqueued = True
+        else:
+            on_commit(self.wake)
+
+    def run_eagerly(self, response):
+        if g.pop('jobs_enqueued', False):
+            self.run_pending()
+        return response
+
+    def exists(self, key):
+        """Is there a job with this key, in any state?"""
+
+        return db.session.query(
+            db.session.query(Job.id).filter(Job.key == key).exists()
+        ).scalar()
+
+    # Working
+
+    def wake(self):
+        """Have the pool look for jobs now, starting it if need be."""
+
+        if not self.workers:
+            return
+
+        with self.lock:
+            # a forked process has no threads; start its own
+            if self.pool_pid != os.getpid():
+                self.pool_pid = os.getpid()
+                for _ in range(self.workers):
+                    Thread(target=self.work, daemon=True).start()
+
+        self.wakeup.set()
+
+    def work(self):
+        """Run jobs as they come, until stop() (the pool's threads run this)."""
+
+        while not self.stopping.is_set():
+            # clear first, so a wake-up while we're busy isn't missed
+            self.wakeup.clear()
+
+            with self.app.app_context():
+                try:
+                    self.run_pending()
+                    self.prune()
+                except Exception:
+                    logger.exception("job worker error")
+                finally:
+                    db.session.remove()
+
+            self.wakeup.wait(self.poll_interval)
+
+    def stop(self):
+        """Have workers stop once they finish the job they're on."""
+
+        self.stopping.set()
+        self.wakeup.set()
+
+    def run_pending(self):
+        """Run due jobs in this thread until there are none; returns how many."""
+
+        count = 0
+        while self.run_next():
+            count += 1
+        return count
+
+    def run_next(self):
+        """Claim and run one due job; False if there was none."""
+
+        job_id = self.claim()
+        if job_id is None:
+            return False
+
+        job = Job.query.get(job_id)
+        task = self.tasks.get(job.task)
+        stats = self.stats_by_task.setdefault(job.task, TaskStats())
+        stats.waits.append(
+            max((datetime.utcnow() - job.run_at).total_seconds(), 0))
+
+        started = perf_counter()
+        try:
+            if task is None:
+                raise LookupError(f"unknown task {job.task!r}")
+            args, kwargs = json.loads(job.arguments)
+            task.function(*args, **kwargs)
+
+            job = Job.query.get(job_id)
+            job.status = DONE
+            job.finished_at = datetime.utcnow()
+            job.locked_until = None
+            db.session.commit()
+            stats.succeeded += 1
+
+        except Exception as exc:
+            db.session.rollback()
+            logger.exception("job %s (%s) failed", job_id, task and task.name)
+            self.retry_later(job_id, exc, stats)
+
+        stats.runs.append(perf_counter() - started)
+        return True
+
+    def claim(self):
+        """Lease the next due job to this worker; returns its id."""
+
+        now = datetime.utcnow()
+        claimable = db.and_(
+            Job.run_at <= now,
+            db.or_(Job.status == QUEUED,
+                   # its worker went away
+                   db.and_(Job.status == RUNNING, Job.locked_until < now)))
+
+        while True:
+            job_id = (db.session
+                      .query(Job.id)
+                      .filter(claimable)
+                      .order_by(Job.run_at)
+                      .limit(1)
+                      .scalar())
+            if job_id is None:
+                db.session.commit()
+                return None
+
+            # only one worker's update can match; the others look again
+            claimed = (Job.query
+                       .filter(Job.id == job_id, claimable)
+                       .update({
+                           Job.status: RUNNING,
+                           Job.attempts: Job.attempts + 1,
+                           Job.locked_until: now + timedelta(
+                               seconds=self.lease),
+                       }, synchronize_session=False))
+            db.session.commit()
+
+            if claimed:
+                return job_id
+
+    def retry_later(self, job_id, exc, stats):
+        job = Job.query.get(job_id)
+        job.last_error = f"{type(exc).__name__}: {exc}"
+        job.locked_until = None
+
+        if job.attempts >= job.max_attempts:
+            job.status = FAILED
+            job.finished_at = datetime.utcnow()
+            stats.failed += 1
+        else:
+            job.status = QUEUED
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=min(2 ** job.attempts, MAX_BACKOFF))
+            stats.retried += 1
+
+        db.session.commit()
+
+    def prune(self):
+        """Delete jobs that finished more than JOB_RETENTION ago, hourly."""
+
+        if (self.last_pruned is not None and
+                monotonic() - self.last_pruned < 60 * 60):
+            return
+        self.last_pruned = monotonic()
+
+        (Job.query
+         .filter(Job.status.in_([DONE, FAILED]),
+                 Job.finished_at <
+                 datetime.utcnow() - timedelta(seconds=self.retention))
+         .delete(synchronize_session=False))
+        db.session.commit()
+
+    def stats(self):
+        """Per-task outcomes and latencies in this process, and the backlog."""
+
+        backlog = dict(db.session
+                       .query(Job.status, db.func.count(Job.id))
+                       .group_by(Job.status))
+        return {
+            'backlog': backlog,
+            'tasks': {name: stats.as_dict()
+                      for name, stats in self.stats_by_task.items()},
+        }
+
+
+jobs = JobQueue()
@@ -1,13 +1,43 @@
 """SQLAlchemy models for Warbler."""
 
+import os
 import pdb
+import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from hashlib import sha1
+from random import random
+from threading import Lock
+from time import sleep
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.schema import CreateTable
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from cache import LRUCache
+from follow_graph import follow_graph
+from passwords import hasher
+from profiler import install_profiler
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
+
+# How many entries we keep in each user's materialized home timeline, and
+# roughly how many fan-outs a timeline can absorb between trims.
+TIMELINE_DEPTH = 800
+TIMELINE_TRIM_INTERVAL = 50
+
+# What counts as a word for message search.
+WORD = re.compile(r"\w+")
+
+# Sharding (see ShardRouter): how many users' shards to remember, and for
+# how long, since moving a user changes theirs; threads querying shards at
+# once; and rows per insert when moving a user.
+DEFAULT_PLACEMENT_CACHE_SIZE = 100000
+DEFAULT_PLACEMENT_TTL = 60
+DEFAULT_SCATTER_THREADS = 16
+MOVE_BATCH_SIZE = 10000
 
 
 class Follows(db.Model):
@@ -15,6 +45,15 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # the primary key covers "who follows X?"; this covers "who does X
+    # follow?" (timelines, follow checks, counters)
+    __table_args__ = (
+        db.Index('ix_follows_follower', 'user_following_id',
+                 'user_being_followed_id'),
+        # on the follower's shard
+        {'info': {'sharded': True}},
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -38,8 +77,13 @@ class Likes(db.Model):
         primary_key=True
     )
 
+    # unique_like covers a user's likes; the index, a message's (like
+    # counts, and deleting the message)
     __table_args__ = (
         db.UniqueConstraint('user_id', 'message_id', name='unique_like'),
+        db.Index('ix_likes_message_id', 'message_id'),
+        # on the liker's shard
+        {'info': {'sharded': True}},
     )
 
     user_id = db.Column(
@@ -58,6 +102,10 @@ class User(db.Model):
 
     __tablename__ = 'users'
 
+    # SQLite would otherwise hand a deleted user's id to the next signup,
+    # who'd inherit jobs keyed by it (like "delete-account:<id>")
+    __table_args__ = {'sqlite_autoincrement': True}
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -98,6 +146,38 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts shown on profiles. They're updated in the same
+    # transaction as the writes they count (see update_counters); run
+    # `flask repair-counters` to recompute them from the source tables.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     messages = db.relationship('Message', cascade='all, delete')
 
     followers = db.relationship(
@@ -122,17 +202,228 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    @property
+    def profile_version(self):
+        """Changes whenever anything shown with this user's messages does."""
+
+        # not hash(): it's salted per process, and every worker must agree
+        return sha1(f"{self.username}\0{self.image_url}".encode('UTF-8')
+                    ).hexdigest()[:16]
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        if follow_graph.loaded:
+            return follow_graph.is_following(other_user.id, self.id)
+
+        return other_user.id in self.follower_ids()
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
+
+        if follow_graph.loaded:
+            return follow_graph.is_following(self.id, other_user.id)
+
+        return other_user.id in self.following_ids()
+
+    def following_ids(self):
+        """Ids of the users this user follows.
+
+        Without the follow graph this is one query, remembered until the
+        session next flushes, so templates can check every user on a page.
+        """
+
+        if follow_graph.loaded:
+            return follow_graph.following(self.id)
+
+        return session_follow_ids(
+            ('following', self.id),
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == self.id),
+            [shards.shard_for(self.id)])
+
+    def follower_ids(self):
+        """Ids of the users following this user.
+
+        Follows live on the follower's shard, so this asks every shard.
+        """
+
+        if follow_graph.loaded:
+            return follow_graph.followers(self.id)
+
+        return session_follow_ids(
+            ('followers', self.id),
+            db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == self.id))
+
+    def liked_message_ids(self, message_ids):
+        """Which of `message_ids` this user likes, as a set."""
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        return {message_id for (message_id,) in
+                shards.session_for(self.id)
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id,
+                        Likes.message_id.in_(message_ids))}
+
+    def like(self, message_id):
+        """Like a message; returns False if this user already liked it.
+
+        Liking twice is harmless: the insert skips an existing like rather
+        than tripping the unique constraint, even if two requests race.
+        """
+
+        table = Likes.__table__
+        session = shards.session_for(self.id)
+        if session.get_bind(clause=table.insert()).dialect.name == (
+                'postgresql'):
+            insert = pg_insert(table).on_conflict_do_nothing(
+                constraint='unique_like')
+        else:
+            insert = table.insert().prefix_with('OR IGNORE')
+
+        result = session.execute(
+            insert.values(user_id=self.id, message_id=message_id))
+
+        if not result.rowcount:
+            return False
+
+        User.update_counters([self.id], likes_count=1)
+        return True
+
+    def unlike(self, message_id):
+        """Stop liking a message; returns False if this user didn't like it."""
+
+        unliked = (shards.session_for(self.id)
+                   .query(Likes)
+                   .filter_by(user_id=self.id, message_id=message_id)
+                   .delete(synchronize_session=False))
+
+        if not unliked:
+            return False
+
+        User.update_counters([self.id], likes_count=-1)
+        return True
+
+    @classmethod
+    def update_counters(cls, user_ids, **deltas):
+        """Add `deltas` to the named counters of the users in `user_ids`.
+
+        The arithmetic happens in SQL, so concurrent requests can't lose
+        each other's updates:
+
+            User.update_counters([user.id], messages_count=1)
+        """
+
+        if not user_ids:
+            return
+
+        users_changed(user_ids)
+
+        (cls.query
+         .filter(cls.id.in_(user_ids))
+         .update({getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()},
+                 synchronize_session=False))
+
+    @classmethod
+    def recount_counters(cls, user_ids=None):
+        """Recompute counters from the messages, follows and likes tables.
+
+        Recounts every user if `user_ids` isn't given.
+        """
+
+        def count(column, matching):
+            return (db.session
+                    .query(db.func.count(column))
+                    .filter(matching == cls.id)
+                    .as_scalar())
+
+        query = cls.query
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+            users_changed(user_ids)
+
+        if shards.sharded:
+            # the counted rows aren't in this database: count them on each
+            # shard and add the shards' counts up here
+            cls.write_counters(query, user_ids)
+            return
+
+        query.update({
+            cls.messages_count: count(Message.id, Message.user_id),
+            cls.following_count: count(Follows.user_being_followed_id,
+                                       Follows.user_following_id),
+            cls.followers_count: count(Follows.user_following_id,
+                                       Follows.user_being_followed_id),
+            cls.likes_count: count(Likes.id, Likes.user_id),
+        }, synchronize_session=False)
+
+    @classmethod
+    def write_counters(cls, query, user_ids):
+        """Set the counters of the users `query` selects from every shard's rows."""
+
+        counted = [
+            ('messages_count', Message.user_id, Message.id),
+            ('following_count', Follows.user_following_id,
+             Follows.user_being_followed_id),
+            ('followers_count', Follows.user_being_followed_id,
+             Follows.user_following_id),
+            ('likes_count', Likes.user_id, Likes.id),
+        ]
+
+        def count_shard(session):
+            counts = []
+            for name, user_id, column in counted:
+                rows = (session
+                        .query(user_id, db.func.count(column))
+                        .group_by(user_id))
+                if user_ids is not None:
+                    rows = rows.filter(user_id.in_(user_ids))
+                counts.extend((id, name, count) for id, count in rows)
+            return counts
+
+        totals = {}
+        for counts in shards.scatter(count_shard):
+            for id, name, count in counts:
+                total = totals.setdefault(id, dict.fromkeys(
+                    (name for name, _, _ in counted), 0))
+                total[name] += count
+
+        query.update({getattr(cls, name): 0 for name, _, _ in counted},
+                     synchronize_session=False)
+
+        if totals:
+            db.session.execute(
+                cls.__table__.update()
+                .where(cls.id == db.bindparam('_id'))
+                .values({name: db.bindparam(f'_{name}')
+                         for name, _, _ in counted}),
+                [dict({f'_{name}': count for name, count in total.items()},
+                      _id=id)
+                 for id, total in totals.items()])
+
+    def snapshot(self):
+        """This user's column values, as a dict that's safe to cache."""
+
+        return {attr.key: getattr(self, attr.key)
+                for attr in self.__mapper__.column_attrs}
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """A User in the current session, rebuilt from `snapshot()`.
+
+        This doesn't query the database; it trusts the snapshot is current.
+        """
+
+        user = cls(**snapshot)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -141,7 +432,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -166,19 +457,121 @@ class User(db.Model):
 
         user = cls.query.filter_by(username=username).first()
 
-        if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            if is_auth:
-                return user
+        if user and user.check_password(password):
+            return user
 
         return False
 
+    def check_password(self, password):
+        """Does `password` match this user's?
+
+        If it does and the stored hash uses an old work factor, the hash is
+        upgraded (commit the session to save it).
+        """
+
+        if not hasher.check(self.password, password):
+            return False
+
+        if hasher.needs_rehash(self.password):
+            self.password = hasher.hash(password)
+
+        return True
+
+
+def session_follow_ids(key, query, shard_keys=None):
+    """The ids `query` selects, cached on the session under `key`.
+
+    The query runs on each shard in `shard_keys` (default: all of them).
+    """
+
+    cache = db.session.info.setdefault('follow_ids', {})
+    if key not in cache:
+        cache[key] = set().union(*shards.scatter(
+            lambda session: {user_id for (user_id,)
+                             in query.with_session(session)},
+            shard_keys))
+    return cache[key]
+
+
+@event.listens_for(db.session, 'after_flush')
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_soft_rollback')
+def forget_follow_ids(session, *args):
+    session.info.pop('follow_ids', None)
+
+
+# Functions called with a set of user ids whenever a commit changes those
+# users' rows, so caches of user data can drop them.
+user_change_listeners = []
+
+
+def users_changed(user_ids):
+    """Note that these users' rows change in the current transaction."""
+
+    (db.session
+     .info
+     .setdefault('changed_user_ids', set())
+     .update(user_ids))
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_changed_users(session, flush_context):
+    (session
+     .info
+     .setdefault('changed_user_ids', set())
+     .update(user.id for user in session.dirty | session.deleted
+             if isinstance(user, User)))
+
+
+@event.listens_for(db.session, 'after_commit')
+def notify_changed_users(session):
+    user_ids = session.info.pop('changed_user_ids', None)
+    if user_ids:
+        for listener in user_change_listeners:
+            listener(user_ids)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_changed_users(session):
+    session.info.pop('changed_user_ids', None)
+
+
+# On PostgreSQL, trigram indexes let the /users search (see search.py) use
+# an index for its leading-wildcard ILIKEs.
+
+event.listen(
+    User.__table__,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'),
+)
+
+# Indexes made by DDL rather than db.Index, by name, so bulk loads (see
+# seeding.py) can put them off like the others.
+ddl_indexes = {}
+
+for column in ('username', 'bio', 'location'):
+    ddl_indexes[f'ix_users_{column}_trgm'] = (
+        User.__table__,
+        DDL(f'CREATE INDEX IF NOT EXISTS ix_users_{column}_trgm '
+            f'ON users USING gin ({column} gin_trgm_ops)').execute_if(
+            dialect='postgresql'),
+    )
+    event.listen(User.__table__, 'after_create',
+                 ddl_indexes[f'ix_users_{column}_trgm'][1])
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
 
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+        # on the author's shard
+        {'info': {'sharded': True}},
+    )
+
     id = db.Column(
         db.Integer,
         primary_key=True,
@@ -192,7 +585,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -204,6 +597,615 @@ class Message(db.Model):
     user = db.relationship('User')
 
 
+class MessageTerm(db.Model):
+    """One word of a message, at its position: our full-text index.
+
+    Looking up messages by word is an index range scan on (term, message_id)
+    instead of a LIKE over every message. Positions let us match phrases,
+    and keeping terms in a btree makes prefix queries a range scan too.
+    """
+
+    __tablename__ = 'message_terms'
+
+    __table_args__ = (
+        db.Index('ix_message_terms_message_id', 'message_id'),
+        # with their message
+        {'info': {'sharded': True}},
+    )
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    position = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    @classmethod
+    def index_message(cls, message):
+        """Add a (flushed) message's words to the index."""
+
+        rows = [dict(term=term, message_id=message.id, position=position)
+                for position, term in enumerate(tokenize(message.text))]
+        if rows:
+            object_session(message).execute(cls.__table__.insert(), rows)
+
+    @classmethod
+    def remove_message(cls, message):
+        """Drop a message's words from the index."""
+
+        (object_session(message)
+         .query(cls)
+         .filter(cls.message_id == message.id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls, batch_size=10000):
+        """Re-index every message.
+
+        Use this after loading data that bypassed the app (like seed.py).
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        rows = []
+        for message_id, text in (db.session
+                                 .query(Message.id, Message.text)
+                                 .yield_per(batch_size)):
+            rows.extend(dict(term=term, message_id=message_id,
+                             position=position)
+                        for position, term in enumerate(tokenize(text)))
+            if len(rows) >= batch_size:
+                db.session.execute(cls.__table__.insert(), rows)
+                rows = []
+
+        if rows:
+            db.session.execute(cls.__table__.insert(), rows)
+
+
+def tokenize(text):
+    """Split message text into lowercase words, in order."""
+
+    return WORD.findall(text.lower())
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Timelines are filled when a message is written (fan-out-on-write), so
+    the homepage can read a user's timeline with a single index range scan
+    instead of querying everyone they follow.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    __table_args__ = (
+        db.Index(
+            'ix_timeline_entries_user_timestamp',
+            'user_id', 'timestamp', 'message_id',
+        ),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    @classmethod
+    def fan_out(cls, message):
+        """Add `message` to its author's timeline and their followers'.
+
+        The message must already be flushed (so it has an id and timestamp).
+        Returns the ids of the followers that received it.
+        """
+
+        follower_ids = [
+            follower_id for (follower_id,) in db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == message.user_id)
+        ]
+        recipients = [message.user_id] + [
+            follower_id for follower_id in follower_ids
+            if follower_id != message.user_id
+        ]
+
+        db.session.execute(cls.__table__.insert(), [
+            dict(user_id=user_id,
+                 message_id=message.id,
+                 timestamp=message.timestamp)
+            for user_id in recipients
+        ])
+
+        # Trimming a timeline costs about TIMELINE_DEPTH index reads, so
+        # only trim a random sample of recipients on each write; timelines
+        # stay within a few TIMELINE_TRIM_INTERVALs of TIMELINE_DEPTH.
+        cls.trim([
+            user_id for user_id in recipients
+            if random() < 1 / TIMELINE_TRIM_INTERVAL
+        ])
+
+        return follower_ids
+
+    @classmethod
+    def trim(cls, user_ids):
+        """Drop everything past TIMELINE_DEPTH from these users' timelines."""
+
+        if not user_ids:
+            return
+
+        ranked = (db.session
+                  .query(cls.user_id,
+                         cls.message_id,
+                         db.func.row_number().over(
+                             partition_by=cls.user_id,
+                             order_by=(cls.timestamp.desc(),
+                                       cls.message_id.desc()),
+                         ).label('position'))
+                  .filter(cls.user_id.in_(user_ids))
+                  .subquery())
+
+        stale = (db.session
+                 .query(ranked.c.user_id, ranked.c.message_id)
+                 .filter(ranked.c.position > TIMELINE_DEPTH))
+
+        (cls.query
+         .filter(db.tuple_(cls.user_id, cls.message_id).in_(stale))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def backfill(cls, user_id, followed_user_id):
+        """Copy `followed_user_id`'s recent messages into a user's timeline.
+
+        Used when `user_id` starts following someone.
+        """
+
+        already_there = (db.session
+                         .query(cls.message_id)
+                         .filter(cls.user_id == user_id))
+
+        recent = (db.session
+                  .query(db.literal(user_id), Message.id, Message.timestamp)
+                  .filter(Message.user_id == followed_user_id)
+                  .filter(~Message.id.in_(already_there))
+                  .order_by(Message.timestamp.desc(), Message.id.desc())
+                  .limit(TIMELINE_DEPTH))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], recent))
+
+        cls.trim([user_id])
+
+    @classmethod
+    def remove_author(cls, user_id, followed_user_id):
+        """Remove `followed_user_id`'s messages from a user's timeline.
+
+        Used when `user_id` stops following someone.
+        """
+
+        authored = (db.session
+                    .query(Message.id)
+                    .filter(Message.user_id == followed_user_id))
+
+        (cls.query
+         .filter(cls.user_id == user_id)
+         .filter(cls.message_id.in_(authored))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message_id):
+        """Remove a message from every timeline it was fanned out to."""
+
+        (cls.query
+         .filter(cls.message_id == message_id)
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_user(cls, user_id):
+        """Remove a user's own timeline and their messages from all others."""
+
+        authored = (db.session
+                    .query(Message.id)
+                    .filter(Message.user_id == user_id))
+
+        (cls.query
+         .filter(db.or_(cls.user_id == user_id,
+                        cls.message_id.in_(authored)))
+         .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from the messages and follows tables.
+
+        Use this after loading data that bypassed the app (like seed.py).
+        """
+
+        cls.query.delete(synchronize_session=False)
+
+        own = db.session.query(
+            Message.user_id.label('owner_id'),
+            Message.id.label('message_id'),
+            Message.timestamp.label('timestamp'),
+        )
+
+        followed = (db.session
+                    .query(Follows.user_following_id,
+                           Message.id,
+                           Message.timestamp)
+                    .join(Message,
+                          Message.user_id == Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id
+                            != Follows.user_being_followed_id))
+
+        candidates = own.union_all(followed).subquery()
+
+        ranked = (db.session
+                  .query(candidates.c.owner_id,
+                         candidates.c.message_id,
+                         candidates.c.timestamp,
+                         db.func.row_number().over(
+                             partition_by=candidates.c.owner_id,
+                             order_by=(candidates.c.timestamp.desc(),
+                                       candidates.c.message_id.desc()),
+                         ).label('position'))
+                  .subquery())
+
+        newest = (db.session
+                  .query(ranked.c.owner_id,
+                         ranked.c.message_id,
+                         ranked.c.timestamp)
+                  .filter(ranked.c.position <= TIMELINE_DEPTH))
+
+        db.session.execute(cls.__table__.insert().from_select(
+            ['user_id', 'message_id', 'timestamp'], newest))
+
+
+##############################################################################
+# Sharding
+#
+# With SQLALCHEMY_SHARDS set, the tables that grow with activity --
+# messages (and their search terms), likes and follows -- are split over
+# those databases by user: each user's messages, likes and follows live on
+# their shard. Users, jobs and the rest stay in the main database. Without
+# it, the main database is the only shard and nothing changes.
+#
+# Shard sessions commit when db.session does, just before it; the two
+# aren't one transaction, so a failure in between can leave counters off
+# (`flask repair-counters` fixes them). Home timelines aren't materialized
+# across shards: the homepage gathers them from the shards instead.
+
+
+class UserShard(db.Model):
+    """The shard a moved user's rows are on (see ShardRouter.move_user).
+
+    Users who were never moved are on their default shard.
+    """
+
+    __tablename__ = 'user_shards'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+
+class MessageId(db.Model):
+    """Message ids handed out by the main database, so shards can't reuse them."""
+
+    __tablename__ = 'message_ids'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class ShardRouter:
+    """Says which shard each user's rows are on, and queries the shards."""
+
+    def __init__(self, app=None):
+        # bind keys; None is the main database
+        self.keys = [None]
+        self.placements = LRUCache(maxsize=DEFAULT_PLACEMENT_CACHE_SIZE,
+                                   ttl=DEFAULT_PLACEMENT_TTL)
+        self.scatter_threads = DEFAULT_SCATTER_THREADS
+        # bind key -> scoped session for it
+        self.sessions = {}
+
+        self.lock = Lock()
+        self.pool = None
+        self.pool_pid = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        urls = app.config.setdefault(
+            'SQLALCHEMY_SHARDS',
+            os.environ.get('DATABASE_SHARD_URLS', '').split())
+        self.placements.ttl = app.config.setdefault('SHARD_PLACEMENT_TTL',
+                                                    DEFAULT_PLACEMENT_TTL)
+        self.scatter_threads = app.config.setdefault(
+            'SHARD_SCATTER_THREADS', DEFAULT_SCATTER_THREADS)
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.keys = []
+        for n, url in enumerate(urls):
+            binds[f'shard{n}'] = url
+            self.keys.append(f'shard{n}')
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+        self.keys = self.keys or [None]
+        self.sessions = {key: db.create_scoped_session({'shard': key})
+                         for key in self.keys if key is not None}
+        app.teardown_appcontext(self.remove_sessions)
+
+    @property
+    def sharded(self):
+        return self.keys != [None]
+
+    # Placement
+
+    def shard_for(self, user_id):
+        """The bind key of `user_id`'s shard."""
+
+        return next(iter(self.group([user_id])))
+
+    def group(self, user_ids):
+        """{bind key: [the ids in `user_ids` on that shard]}."""
+
+        user_ids = list(user_ids)
+        if not self.sharded:
+            return {None: user_ids}
+
+        placed = {user_id: self.placements.get(user_id)
+                  for user_id in user_ids}
+        unplaced = [user_id for user_id, key in placed.items() if key is None]
+        if unplaced:
+            moved = dict(db.session
+                         .query(UserShard.user_id, UserShard.shard)
+                         .filter(UserShard.user_id.in_(unplaced)))
+            for user_id in unplaced:
+                placed[user_id] = (moved.get(user_id) or
+                                   self.keys[user_id % len(self.keys)])
+                self.placements.set(user_id, placed[user_id])
+
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(placed[user_id], []).append(user_id)
+        return groups
+
+    # Sessions
+
+    def session(self, key):
+        """This context's session for shard `key`."""
+
+        if key is None:
+            return db.session()
+        return self.sessions[key]()
+
+    def session_for(self, user_id):
+        """This context's session for `user_id`'s shard."""
+
+        return self.session(self.shard_for(user_id))
+
+    def remove_sessions(self, exc=None):
+        for scoped in self.sessions.values():
+            scoped.remove()
+
+    def commit(self):
+        for scoped in self.sessions.values():
+            if scoped.registry.has():
+                scoped().commit()
+
+    def rollback(self):
+        for scoped in self.sessions.values():
+            if scoped.registry.has():
+                scoped().rollback()
+
+    def scatter(self, function, keys=None):
+        """[function(session) for each shard in `keys`], run in parallel.
+
+        `keys` defaults to every shard. `function` gets the shard's session
+        and must only use that (not db.session or Model.query), since it
+        runs on another thread; query.with_session(session) moves a query
+        there.
+        """
+
+        keys = self.keys if keys is None else list(keys)
+        sessions = [self.session(key) for key in keys]
+        if len(sessions) < 2:
+            return [function(session) for session in sessions]
+
+        with self.lock:
+            # a forked process has no threads; start its own
+            if self.pool_pid != os.getpid():
+                self.pool = ThreadPoolExecutor(self.scatter_threads)
+                self.pool_pid = os.getpid()
+
+        return list(self.pool.map(function, sessions))
+
+    def get(self, model, ident, keys=None):
+        """The `model` with primary key `ident`, from whichever shard has it."""
+
+        found = self.scatter(lambda session: session.query(model).get(ident),
+                             keys)
+        return next((instance for instance in found if instance is not None),
+                    None)
+
+    # Schema
+
+    def create_all(self):
+        """Create the sharded tables on every shard that hasn't got them.
+
+        Without foreign keys: what they point at can be on another shard,
+        or (users) in the main database.
+        """
+
+        for key in self.keys:
+            if key is None:
+                continue
+            with db.get_engine(bind=key).begin() as conn:
+                for table in sharded_tables():
+                    if conn.dialect.has_table(conn, table.name):
+                        continue
+                    conn.execute(CreateTable(
+                        table, include_foreign_key_constraints=[]))
+                    for index in table.indexes:
+                        index.create(conn)
+
+    def drop_all(self):
+        for key in self.keys:
+            if key is None:
+                continue
+            with db.get_engine(bind=key).begin() as conn:
+                for table in reversed(sharded_tables()):
+                    table.drop(conn, checkfirst=True)
+
+    # Moving users
+
+    def move_user(self, user_id, key, wait=0):
+        """Move `user_id`'s messages, likes and follows to shard `key`.
+
+        Copies them, points the user at the new shard, waits `wait` seconds
+        for other processes' placements to expire (SHARD_PLACEMENT_TTL),
+        copies whatever they wrote to the old shard meanwhile, then deletes
+        the user's rows from the old shard. Returns the old shard's key.
+        """
+
+        old_key = self.shard_for(user_id)
+        if key not in self.keys:
+            raise ValueError(f"No shard {key!r}")
+        if key == old_key:
+            return old_key
+
+        old, new = self.session(old_key), self.session(key)
+
+        self.copy_user(user_id, old, new)
+        db.session.merge(UserShard(user_id=user_id, shard=key))
+        db.session.commit()
+        self.placements.set(user_id, key)
+
+        sleep(wait)
+
+        self.copy_user(user_id, old, new)
+        self.delete_user_rows(user_id, old)
+        db.session.commit()
+
+        return old_key
+
+    def copy_user(self, user_id, source, destination):
+        """Copy a user's rows from one shard's session to another's.
+
+        Rows the destination already has are skipped, so copying again only
+        adds what's new.
+        """
+
+        authored = (source
+                    .query(Message.id)
+                    .filter(Message.user_id == user_id))
+
+        for table, rows in [
+            (Message.__table__,
+             source.query(Message.__table__).filter(
+                 Message.user_id == user_id)),
+            (MessageTerm.__table__,
+             source.query(MessageTerm.__table__).filter(
+                 MessageTerm.message_id.in_(authored))),
+            # likes' ids are only unique per shard: let the new one number
+            # them, and skip likes it has by unique_like
+            (Likes.__table__,
+             source.query(Likes.user_id, Likes.message_id).filter(
+                 Likes.user_id == user_id)),
+            (Follows.__table__,
+             source.query(Follows.__table__).filter(
+                 Follows.user_following_id == user_id)),
+        ]:
+            if destination.get_bind(clause=table.insert()).dialect.name == (
+                    'postgresql'):
+                insert = pg_insert(table).on_conflict_do_nothing()
+            else:
+                insert = table.insert().prefix_with('OR IGNORE')
+
+            batch = []
+            for row in rows.yield_per(MOVE_BATCH_SIZE):
+                batch.append(row._asdict())
+                if len(batch) == MOVE_BATCH_SIZE:
+                    destination.execute(insert, batch)
+                    batch = []
+            if batch:
+                destination.execute(insert, batch)
+
+    def delete_user_rows(self, user_id, session):
+        """Delete a user's messages, likes and follows from a shard's session."""
+
+        authored = (session
+                    .query(Message.id)
+                    .filter(Message.user_id == user_id))
+
+        for query in [
+            session.query(MessageTerm).filter(
+                MessageTerm.message_id.in_(authored)),
+            session.query(Message).filter(Message.user_id == user_id),
+            session.query(Likes).filter(Likes.user_id == user_id),
+            session.query(Follows).filter(Follows.user_following_id == user_id),
+        ]:
+            query.delete(synchronize_session=False)
+
+
+def sharded_tables():
+    return [table for table in db.metadata.sorted_tables
+            if table.info.get('sharded')]
+
+
+@event.listens_for(Message, 'before_insert')
+def allocate_message_id(mapper, connection, message):
+    # each shard numbering its own messages would give out the same ids
+    if message.id is None and shards.sharded:
+        message.id = (db.session
+                      .execute(MessageId.__table__.insert())
+                      .inserted_primary_key[0])
+
+
+@event.listens_for(db.session, 'before_commit')
+def commit_shards(session):
+    shards.commit()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def roll_back_shards(session, previous_transaction):
+    shards.rollback()
+
+
+shards = ShardRouter()
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -212,6 +1214,7 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    install_profiler(app)
 
     @app.route('/debug')
     def debug():
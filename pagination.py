@@ -0,0 +1,97 @@
+"""Keyset ("cursor") pagination for lists of messages.
+
+Rather than OFFSET, each page remembers the (timestamp, id) of the last
+message it showed; the next page asks for messages strictly older than
+that, which the database can answer with an index seek however deep the
+user has scrolled.
+
+Sharded lists come a page per shard, all from the same cursor;
+merge_pages makes one page of them.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+
+from sqlalchemy import and_, or_
+
+PER_PAGE = 100
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id):
+    """Make an opaque, URL-safe cursor pointing at (timestamp, id)."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('UTF-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Turn a cursor back into (timestamp, id).
+
+    Raises ValueError if the cursor wasn't made by encode_cursor.
+    """
+
+    try:
+        raw = urlsafe_b64decode(cursor.encode('ascii')).decode('UTF-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (Base64Error, UnicodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def paginate(query, timestamp_column, id_column, cursor=None,
+             per_page=PER_PAGE):
+    """Get one page of `query`, newest first.
+
+    `timestamp_column` and `id_column` are the columns to order and seek by;
+    the rows returned must have matching `timestamp` and `id` attributes
+    (like Message). Returns (items, next_cursor), where next_cursor is None
+    on the last page.
+    """
+
+    if cursor:
+        timestamp, id = decode_cursor(cursor)
+        query = query.filter(or_(
+            timestamp_column < timestamp,
+            and_(timestamp_column == timestamp, id_column < id),
+        ))
+
+    items = (query
+             .order_by(timestamp_column.desc(), id_column.desc())
+             .limit(per_page + 1)
+             .all())
+
+    if len(items) <= per_page:
+        return items, None
+
+    items = items[:per_page]
+    last = items[-1]
+    return items, encode_cursor(last.timestamp, last.id)
+
+
+def merge_pages(pages, per_page=PER_PAGE):
+    """Combine (items, next_cursor) pages from the same cursor into one.
+
+    Each page must be newest first, as paginate makes them.
+    """
+
+    pages = list(pages)
+    if not pages:
+        return [], None
+    if len(pages) == 1:
+        return pages[0]
+
+    items = list(islice(
+        merge(*(items for items, _ in pages),
+              key=lambda item: (item.timestamp, item.id), reverse=True),
+        per_page + 1))
+    if len(items) <= per_page and not any(cursor for _, cursor in pages):
+        return items, None
+
+    items = items[:per_page]
+    last = items[-1]
+    return items, encode_cursor(last.timestamp, last.id)
@@ -0,0 +1,169 @@
+"""Password hashing for Warbler, off the request thread.
+
+bcrypt is deliberately slow: at the default work factor one hash or check
+keeps a CPU core busy for about a quarter of a second. Doing that inline
+ties up the WSGI worker for the duration, so PasswordHasher runs it on a
+small process pool instead, and refuses new work (PasswordHasherBusy)
+rather than letting a login storm queue up without limit.
+
+Settings, read by init_app:
+
+BCRYPT_LOG_ROUNDS
+    bcrypt work factor for new hashes (default 12). Hashes made with a
+    different work factor are upgraded the next time their user logs in.
+PASSWORD_HASH_WORKERS
+    size of the process pool (default: one per CPU). 0 hashes inline.
+PASSWORD_HASH_QUEUE_DEPTH
+    how many hashes may wait for a worker before we turn requests away
+    (default: 4 per worker).
+PASSWORD_HASH_TIMEOUT
+    seconds to wait for a result (default 10).
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+import bcrypt
+
+DEFAULT_ROUNDS = 12
+DEFAULT_QUEUE_DEPTH_PER_WORKER = 4
+DEFAULT_TIMEOUT = 10
+
+
+class PasswordHasherBusy(Exception):
+    """Too many hashes are already waiting for a worker."""
+
+
+def hash_password(password, rounds):
+    """bcrypt-hash `password`; runs in a pool worker."""
+
+    hashed = bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt(rounds))
+    return hashed.decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`? Runs in a pool worker."""
+
+    return bcrypt.checkpw(password.encode('UTF-8'), hashed.encode('UTF-8'))
+
+
+def hash_rounds(hashed):
+    """The work factor a bcrypt hash was made with."""
+
+    # hashes look like $2b$12$<salt and checksum>
+    return int(hashed.split('$')[2])
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a bounded process pool."""
+
+    def __init__(self, app=None):
+        self.rounds = DEFAULT_ROUNDS
+        self.workers = os.cpu_count() or 1
+        self.queue_depth = self.workers * DEFAULT_QUEUE_DEPTH_PER_WORKER
+        self.timeout = DEFAULT_TIMEOUT
+
+        self.pool = None
+        self.pool_pid = None
+        self.pool_lock = Lock()
+        self.slots = None
+        # hashes running or waiting for a worker, in this process
+        self.in_flight = 0
+        self.count_lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.rounds = app.config.setdefault('BCRYPT_LOG_ROUNDS',
+                                            DEFAULT_ROUNDS)
+        self.workers = app.config.setdefault('PASSWORD_HASH_WORKERS',
+                                             os.cpu_count() or 1)
+        self.queue_depth = app.config.setdefault(
+            'PASSWORD_HASH_QUEUE_DEPTH',
+            self.workers * DEFAULT_QUEUE_DEPTH_PER_WORKER)
+        self.timeout = app.config.setdefault('PASSWORD_HASH_TIMEOUT',
+                                             DEFAULT_TIMEOUT)
+        self.shutdown()
+
+    def hash(self, password):
+        """Hash a password with the configured work factor."""
+
+        return self.run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does `password` match `hashed`?"""
+
+        return self.run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was `hashed` made with a different work factor than we use now?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+    def run(self, function, *args):
+        """Run `function(*args)` on the pool and wait for the result.
+
+        Raises PasswordHasherBusy if the queue is already full.
+        """
+
+        if not self.workers:
+            return function(*args)
+
+        pool, slots = self.get_pool()
+
+        if not slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+        self.count(1)
+
+        def release(future=None):
+            self.count(-1)
+            slots.release()
+
+        try:
+            future = pool.submit(function, *args)
+        except Exception:
+            release()
+            raise
+
+        future.add_done_callback(release)
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PasswordHasherBusy()
+
+    def count(self, change):
+        """Add `change` to the in-flight count."""
+
+        with self.count_lock:
+            self.in_flight += change
+
+    def get_pool(self):
+        """The process pool, started on first use in each process.
+
+        (A pool inherited through fork, as with a preloading app server,
+        belongs to the parent process, so children start their own.)
+        """
+
+        with self.pool_lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                self.pool_pid = os.getpid()
+                self.slots = BoundedSemaphore(self.workers + self.queue_depth)
+                self.in_flight = 0
+            return self.pool, self.slots
+
+    def shutdown(self):
+        """Stop the pool, if it's running in this process."""
+
+        with self.pool_lock:
+            if self.pool is not None and self.pool_pid == os.getpid():
+                self.pool.shutdown()
+            self.pool = None
+            self.pool_pid = None
+
+
+hasher = PasswordHasher()
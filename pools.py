@@ -0,0 +1,183 @@
+"""Database connection pool settings and instrumentation.
+
+Each process keeps a pool of connections per database (the primary,
+replicas and shards). When every connection is in use, a request waits
+for one to come back; if none does within SQLALCHEMY_POOL_TIMEOUT, it
+gets a 503 rather than piling up behind the others. Statements that run
+longer than SQLALCHEMY_STATEMENT_TIMEOUT are cancelled by PostgreSQL, so
+one runaway query can't hold a connection indefinitely.
+
+Pools are InstrumentedQueuePools, which count what happens to them:
+checkouts, how long each waited (as a histogram), how many requests are
+waiting now and how many gave up. PoolMonitor.stats() reports that for
+each database, for this process; /metrics shows it.
+
+Settings, read by init_app (the first four are Flask-SQLAlchemy's own):
+
+SQLALCHEMY_POOL_SIZE
+    connections each pool keeps open (default: the DATABASE_POOL_SIZE
+    environment variable, or 10).
+SQLALCHEMY_MAX_OVERFLOW
+    connections a pool may open beyond that under load, closed once
+    they're returned (default: DATABASE_MAX_OVERFLOW, or 5).
+SQLALCHEMY_POOL_TIMEOUT
+    seconds to wait for a connection before giving up (default 5).
+SQLALCHEMY_POOL_RECYCLE
+    seconds after which a connection is replaced, before a server or
+    proxy drops it (default 1800).
+SQLALCHEMY_POOL_PRE_PING
+    check a connection still works before using it (default True).
+SQLALCHEMY_STATEMENT_TIMEOUT
+    seconds a statement may run, on PostgreSQL (default 30; None for no
+    limit).
+"""
+
+import os
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import current_app
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 5
+DEFAULT_POOL_TIMEOUT = 5
+DEFAULT_POOL_RECYCLE = 30 * 60
+DEFAULT_STATEMENT_TIMEOUT = 30
+
+# upper bounds, in milliseconds, of the checkout wait histogram's buckets;
+# the last bucket has everything slower
+CHECKOUT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+
+class PoolStats:
+    """What one pool's checkouts have been through, in this process."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.buckets = [0] * (len(CHECKOUT_BUCKETS_MS) + 1)
+
+    def start_wait(self):
+        with self.lock:
+            self.waiting += 1
+
+    def end_wait(self, elapsed, timed_out=False):
+        with self.lock:
+            self.waiting -= 1
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.buckets[bisect_left(CHECKOUT_BUCKETS_MS,
+                                         elapsed * 1000)] += 1
+
+    def histogram(self):
+        """[[bucket's upper bound in ms (None for the last), checkouts]...]."""
+
+        bounds = list(CHECKOUT_BUCKETS_MS) + [None]
+        with self.lock:
+            return [list(bucket) for bucket in zip(bounds, self.buckets)]
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that keeps PoolStats on its checkouts."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        # the wait includes opening a new connection, if the pool must
+        start = perf_counter()
+        timed_out = False
+        self.stats.start_wait()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self.stats.end_wait(perf_counter() - start, timed_out)
+
+    def recreate(self):
+        # engine.dispose() swaps in a new pool; keep counting
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def apply_engine_options(app, info, options):
+    """Add the pool options Flask-SQLAlchemy doesn't know to `options`.
+
+    For SQLAlchemy.apply_driver_hacks (see routing.RoutingSQLAlchemy).
+    """
+
+    if app.config.get('SQLALCHEMY_POOL_PRE_PING'):
+        options['pool_pre_ping'] = True
+
+    # Flask-SQLAlchemy picks its own pools for SQLite, unless it's given a
+    # pool size
+    options.setdefault('poolclass', InstrumentedQueuePool)
+
+    timeout = app.config.get('SQLALCHEMY_STATEMENT_TIMEOUT')
+    if timeout and info.drivername.startswith('postgresql'):
+        connect_args = options.setdefault('connect_args', {})
+        connect_args['options'] = (
+            f"{connect_args.get('options', '')} "
+            f"-c statement_timeout={int(timeout * 1000)}").strip()
+
+
+class PoolMonitor:
+    """Sets up the apps' pools, and reports on them."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Set pool defaults; call before db.init_app, which sets its own."""
+
+        app.config.setdefault(
+            'SQLALCHEMY_POOL_SIZE',
+            int(os.environ.get('DATABASE_POOL_SIZE', DEFAULT_POOL_SIZE)))
+        app.config.setdefault(
+            'SQLALCHEMY_MAX_OVERFLOW',
+            int(os.environ.get('DATABASE_MAX_OVERFLOW',
+                               DEFAULT_MAX_OVERFLOW)))
+        app.config.setdefault('SQLALCHEMY_POOL_TIMEOUT', DEFAULT_POOL_TIMEOUT)
+        app.config.setdefault('SQLALCHEMY_POOL_RECYCLE', DEFAULT_POOL_RECYCLE)
+        app.config.setdefault('SQLALCHEMY_POOL_PRE_PING', True)
+        app.config.setdefault('SQLALCHEMY_STATEMENT_TIMEOUT',
+                              DEFAULT_STATEMENT_TIMEOUT)
+
+    def stats(self):
+        """Each database's pool, by bind key ('primary' for the main one)."""
+
+        db = current_app.extensions['sqlalchemy'].db
+        bind_keys = [None] + list(current_app.config.get('SQLALCHEMY_BINDS')
+                                  or {})
+
+        stats = {}
+        for bind_key in bind_keys:
+            pool = db.get_engine(current_app, bind=bind_key).pool
+            if not isinstance(pool, InstrumentedQueuePool):
+                continue
+
+            stats[bind_key or 'primary'] = {
+                'size': pool.size(),
+                'in_use': pool.checkedout(),
+                'overflow': max(pool.overflow(), 0),
+                'waiting': pool.stats.waiting,
+                'checkouts': pool.stats.checkouts,
+                'timeouts': pool.stats.timeouts,
+                'checkout_ms': pool.stats.histogram(),
+            }
+        return stats
+
+
+pools = PoolMonitor()
@@ -0,0 +1,145 @@
+"""Per-request SQL profiling for Warbler.
+
+Every statement run while handling a request is counted and timed, and
+statements are grouped by "shape" (the SQL with literals and IN-lists
+collapsed) so the same query running once per row -- an N+1 -- stands out.
+
+The totals go out as response headers and as one JSON log line per request
+on the 'warbler.sql' logger. Apps can also set a query budget per endpoint:
+
+    app.config['SQL_QUERY_BUDGETS'] = {'homepage': 4}
+
+A request that runs more queries than its endpoint's budget logs a warning,
+or raises QueryBudgetExceeded when SQL_QUERY_BUDGETS_ENFORCE is on (which
+is what the tests do).
+"""
+
+import json
+import logging
+import re
+from collections import Counter
+from time import perf_counter
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger('warbler.sql')
+
+DEFAULT_N_PLUS_ONE_THRESHOLD = 5
+
+IN_LIST = re.compile(r'\(\s*(?:%\(\w+\)s|\?|:\w+)(?:\s*,\s*(?:%\(\w+\)s|\?|:\w+))*\s*\)')
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(Exception):
+    """A request ran more queries than its endpoint's budget allows."""
+
+
+def statement_shape(statement):
+    """Normalize a SQL statement so repeats of the same query compare equal.
+
+    Collapses whitespace, literals and bound IN-lists, so
+    `... WHERE id IN (%(id_1)s, %(id_2)s)` and the same query with ten ids
+    have the same shape.
+    """
+
+    shape = IN_LIST.sub('(...)', statement)
+    shape = LITERALS.sub('?', shape)
+    return WHITESPACE.sub(' ', shape).strip()
+
+
+class RequestProfile:
+    """Queries run while handling one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        self.shapes[statement_shape(statement)] += 1
+
+    def repeated(self, threshold):
+        """Shapes run at least `threshold` times -- likely N+1 patterns."""
+
+        return [(shape, count) for shape, count in self.shapes.most_common()
+                if count >= threshold]
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_times', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    elapsed = perf_counter() - conn.info['query_start_times'].pop()
+
+    if has_request_context():
+        profile = g.get('sql_profile')
+        if profile is not None:
+            profile.record(statement, elapsed)
+
+
+def install_profiler(app):
+    """Profile the SQL run by each of `app`'s requests."""
+
+    app.config.setdefault('SQL_PROFILER_HEADERS', True)
+    app.config.setdefault('SQL_N_PLUS_ONE_THRESHOLD',
+                          DEFAULT_N_PLUS_ONE_THRESHOLD)
+    app.config.setdefault('SQL_QUERY_BUDGETS', {})
+    app.config.setdefault('SQL_QUERY_BUDGETS_ENFORCE', False)
+
+    # Listen on the Engine class rather than one engine, so queries to any
+    # bind are counted.
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def start_sql_profile():
+        g.sql_profile = RequestProfile()
+
+    @app.after_request
+    def finish_sql_profile(response):
+        profile = g.get('sql_profile')
+        if profile is None:
+            return response
+
+        repeated = profile.repeated(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+        budget = app.config['SQL_QUERY_BUDGETS'].get(request.endpoint)
+        over_budget = budget is not None and profile.count > budget
+
+        if app.config['SQL_PROFILER_HEADERS']:
+            response.headers['X-DB-Query-Count'] = str(profile.count)
+            response.headers['X-DB-Time-Ms'] = f"{profile.total_time * 1000:.2f}"
+            response.headers['X-DB-N-Plus-One'] = str(len(repeated))
+
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'queries': profile.count,
+            'db_time_ms': round(profile.total_time * 1000, 2),
+            'n_plus_one': [{'shape': shape, 'count': count}
+                           for shape, count in repeated],
+            'budget': budget,
+        }
+
+        if repeated or over_budget:
+            logger.warning(json.dumps(record))
+        else:
+            logger.info(json.dumps(record))
+
+        if over_budget and app.config['SQL_QUERY_BUDGETS_ENFORCE']:
+            raise QueryBudgetExceeded(
+                f"{request.endpoint} ran {profile.count} queries "
+                f"(budget {budget})")
+
+        return response
@@ -0,0 +1,234 @@
+"""Publish/subscribe between Warbler's worker processes.
+
+Broker tells users' open pages about events meant for them -- new
+warbles in their timeline, so far (see the /stream endpoint). Pages
+subscribe by user id; publishing an event for some user ids hands it to
+their subscriptions, whichever process they're in:
+
+- subscriptions in the publishing process get it straight away;
+- every other process that has subscribers binds a Unix datagram socket
+  in PUBSUB_DIR, and the publisher sends each of them the event. A
+  datagram arrives whole or not at all, so processes can't see half an
+  event, and nothing but the socket files needs setting up.
+
+Delivery is best effort: an event for a process that has gone away, or
+whose socket or a subscriber's queue is full, is dropped and counted.
+Pages only use events to say "there's something new", so a missed one
+costs a reload at worst.
+
+Waiting subscribers block on a queue.Queue and the socket listener is a
+thread, so under gevent or eventlet (e.g. gunicorn -k gevent) with
+monkey-patching, each idle connection is a greenlet rather than a thread,
+and tens of thousands of them cost little more than their sockets.
+
+Settings, read by init_app:
+
+PUBSUB_DIR
+    where processes' sockets go (default: pubsub/ in the instance folder).
+PUBSUB_QUEUE_SIZE
+    events a subscription holds before dropping new ones (default 100).
+"""
+
+import json
+import os
+import queue
+import socket
+from threading import Lock, Thread
+from uuid import uuid4
+
+DEFAULT_QUEUE_SIZE = 100
+
+# user ids per datagram, keeping each one well inside the socket buffer
+MAX_RECIPIENTS = 1000
+MAX_DATAGRAM = 64 * 1024
+
+
+class Subscription:
+    """Events for one user, as they arrive."""
+
+    def __init__(self, user_id, queue_size):
+        self.user_id = user_id
+        self.queue = queue.Queue(queue_size)
+
+    def get(self, timeout=None):
+        """The next event, waiting up to `timeout` seconds; None if none came."""
+
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    """Routes events to subscriptions in this and other processes."""
+
+    def __init__(self, app=None):
+        self.dir = None
+        self.queue_size = DEFAULT_QUEUE_SIZE
+
+        self.lock = Lock()
+        # user id -> their subscriptions in this process
+        self.subscriptions = {}
+        self.socket = None
+        self.socket_path = None
+        self.socket_pid = None
+        self.sender = None
+
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.dir = app.config.setdefault(
+            'PUBSUB_DIR', os.path.join(app.instance_path, 'pubsub'))
+        self.queue_size = app.config.setdefault('PUBSUB_QUEUE_SIZE',
+                                                DEFAULT_QUEUE_SIZE)
+
+    # Subscribing
+
+    def subscribe(self, user_id):
+        """Start collecting events for `user_id`; unsubscribe when done."""
+
+        subscription = Subscription(user_id, self.queue_size)
+        with self.lock:
+            self.listen()
+            self.subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.user_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.user_id, None)
+
+    def listen(self):
+        """Bind this process's socket and start reading it, once."""
+
+        if self.socket is not None and self.socket_pid == os.getpid():
+            return
+
+        # a forked worker inherits its parent's socket; it needs its own
+        if self.socket is not None:
+            self.socket.close()
+
+        os.makedirs(self.dir, exist_ok=True)
+        self.socket_path = os.path.join(self.dir,
+                                        f"{os.getpid()}-{uuid4().hex[:12]}.sock")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.socket_path)
+        self.socket_pid = os.getpid()
+
+        Thread(target=self.receive, args=(self.socket,), daemon=True).start()
+
+    def receive(self, sock):
+        while True:
+            try:
+                data = sock.recv(MAX_DATAGRAM)
+            except OSError:
+                return  # closed
+            recipients, event = json.loads(data.decode('UTF-8'))
+            self.deliver(recipients, event)
+
+    def close(self):
+        """Stop receiving events from other processes."""
+
+        with self.lock:
+            if self.socket is not None:
+                self.socket.close()
+                try:
+                    os.remove(self.socket_path)
+                except FileNotFoundError:
+                    pass
+                self.socket = None
+
+    # Publishing
+
+    def publish(self, user_ids, event):
+        """Send `event` (anything JSON can encode) to `user_ids`' subscriptions."""
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return
+
+        self.published += 1
+        self.deliver(user_ids, event)
+
+        for start in range(0, len(user_ids), MAX_RECIPIENTS):
+            datagram = json.dumps(
+                [user_ids[start:start + MAX_RECIPIENTS], event]).encode('UTF-8')
+            for path in self.peers():
+                self.send(path, datagram)
+
+    def deliver(self, user_ids, event):
+        """Hand `event` to this process's subscriptions for `user_ids`."""
+
+        with self.lock:
+            subscriptions = [subscription
+                             for user_id in user_ids
+                             for subscription in self.subscriptions.get(
+                                 user_id, ())]
+
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+                self.delivered += 1
+            except queue.Full:
+                self.dropped += 1
+
+    def peers(self):
+        """Paths of the other processes' sockets."""
+
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            return []
+
+        return [os.path.join(self.dir, name) for name in names
+                if name.endswith('.sock') and
+                os.path.join(self.dir, name) != self.socket_path]
+
+    def send(self, path, datagram):
+        if self.sender is None:
+            self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # never hold a request up on a busy peer
+            self.sender.setblocking(False)
+
+        try:
+            self.sender.sendto(datagram, path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # its process is gone; tidy up after it
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        except OSError:
+            # its buffer is full (or the event is too big to send)
+            self.dropped += 1
+
+    def stats(self):
+        with self.lock:
+            subscribers = sum(len(subscriptions)
+                              for subscriptions in self.subscriptions.values())
+        return {
+            'subscribers': subscribers,
+            'published': self.published,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+        }
+
+
+def format_event(event_type, data, id=None):
+    """`data` as a text/event-stream event."""
+
+    lines = [f"event: {event_type}"]
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.append(f"data: {json.dumps(data)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+broker = Broker()
@@ -0,0 +1,240 @@
+"""Sending read-only pages' queries to read replicas.
+
+Most of Warbler's traffic is people reading timelines and profiles, and
+those reads needn't compete with writes on the primary database. Views
+decorated with @read_only run their SELECTs against a replica, chosen at
+random per request from SQLALCHEMY_REPLICAS; everything else -- other
+views, background jobs, commands -- and every write goes to the primary
+(SQLALCHEMY_DATABASE_URI). Replication itself is the databases' business.
+
+Replicas lag behind the primary, so a user who has just posted or
+followed someone could reload and not see it. To stop that, a request
+that writes leaves a consistency token in the user's session: the
+primary's WAL position after the write on PostgreSQL, or just the time.
+Until a replica has replayed that position (or REPLICA_MAX_LAG seconds
+have passed, elsewhere), that user's read-only pages read from the
+primary too. Within a request, everything after a write reads from the
+primary.
+
+The routing happens in RoutingSession.get_bind, so queries don't need to
+say where they go. The same hook sends sharded tables' statements to a
+shard, for sessions made for one (see models.ShardRouter).
+
+Settings, read by init_app:
+
+SQLALCHEMY_REPLICAS
+    replica database URLs (default: the whitespace-separated
+    DATABASE_REPLICA_URLS environment variable; none means everything
+    uses the primary). They become SQLALCHEMY_BINDS replica0, replica1...
+REPLICA_MAX_LAG
+    seconds to assume a replica may be behind, where we can't ask it
+    (default 5).
+"""
+
+import os
+import random
+from time import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.expression import Select, CompoundSelect, UpdateBase
+from sqlalchemy.sql.util import find_tables
+
+from pools import apply_engine_options
+
+CONSISTENCY_TOKEN_KEY = 'read_primary_until'
+DEFAULT_MAX_LAG = 5
+
+
+def read_only(view):
+    """Mark a view as only reading, so it may use a replica.
+
+    Goes under @app.route.
+    """
+
+    view.read_only = True
+    return view
+
+
+class RoutingSession(SignallingSession):
+    """A session that picks the primary or a replica for each statement.
+
+    A session made with a `shard` (a bind key) runs statements on tables
+    marked info={'sharded': True} there instead (see models.ShardRouter).
+    """
+
+    def __init__(self, db, shard=None, **options):
+        self.shard = shard
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.shard is not None and touches_sharded_table(mapper, clause):
+            return self.app.extensions['sqlalchemy'].db.get_engine(
+                self.app, bind=self.shard)
+
+        router = self.app.extensions.get('replica_router')
+        if router is not None:
+            bind_key = router.bind_for(self, clause)
+            if bind_key is not None:
+                return self.app.extensions['sqlalchemy'].db.get_engine(
+                    self.app, bind=bind_key)
+
+        return super().get_bind(mapper, clause)
+
+
+def touches_sharded_table(mapper, clause):
+    """Is the statement about a sharded table?"""
+
+    if mapper is not None:
+        tables = [mapper.local_table]
+    elif clause is not None:
+        tables = find_tables(clause, include_crud=True)
+    else:
+        return False
+
+    return any(table.info.get('sharded') for table in tables)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with RoutingSession for its sessions.
+
+    Its engines also get the pool options pools.py sets up.
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername == 'sqlite':
+            # a shard's session may be used by a scatter thread (see
+            # ShardRouter.scatter), one thread at a time
+            options.setdefault('connect_args', {})['check_same_thread'] = False
+        apply_engine_options(app, info, options)
+
+
+class ReplicaRouter:
+    """Decides which database each request reads from."""
+
+    def __init__(self, app=None):
+        self.replicas = []
+        self.max_lag = DEFAULT_MAX_LAG
+        # bind key (None for the primary) -> read-only requests sent there
+        self.routed = {}
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        urls = app.config.setdefault(
+            'SQLALCHEMY_REPLICAS',
+            os.environ.get('DATABASE_REPLICA_URLS', '').split())
+        self.max_lag = app.config.setdefault('REPLICA_MAX_LAG',
+                                             DEFAULT_MAX_LAG)
+
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        self.replicas = []
+        for n, url in enumerate(urls):
+            binds[f'replica{n}'] = url
+            self.replicas.append(f'replica{n}')
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+        app.extensions['replica_router'] = self
+        app.before_request(self.choose_bind)
+        app.after_request(self.leave_token)
+
+    def engine(self, bind_key=None):
+        return current_app.extensions['sqlalchemy'].db.get_engine(
+            current_app, bind=bind_key)
+
+    # Per request
+
+    def choose_bind(self):
+        """Pick a replica for a read-only view, if the user may use one."""
+
+        view = current_app.view_functions.get(request.endpoint)
+        if not self.replicas or not getattr(view, 'read_only', False):
+            return
+
+        bind_key = random.choice(self.replicas)
+        if self.caught_up(bind_key):
+            g.read_bind = bind_key
+        self.routed[g.get('read_bind')] = (
+            self.routed.get(g.get('read_bind'), 0) + 1)
+
+    def caught_up(self, bind_key):
+        """Has the replica got everything this user has written?
+
+        The token stays until every replica has, since the next request
+        may pick another.
+        """
+
+        token = session.get(CONSISTENCY_TOKEN_KEY)
+        if token is None:
+            return True
+
+        position = token.get('position')
+        if position is None:
+            caught_up = time() >= token['at'] + self.max_lag
+            if caught_up:
+                session.pop(CONSISTENCY_TOKEN_KEY)
+            return caught_up
+
+        if not self.replayed(bind_key, position):
+            return False
+        if all(self.replayed(other, position)
+               for other in self.replicas if other != bind_key):
+            session.pop(CONSISTENCY_TOKEN_KEY)
+        return True
+
+    def replayed(self, bind_key, position):
+        """Has this replica replayed the primary's WAL up to `position`?"""
+
+        replayed = self.engine(bind_key).execute(
+            "SELECT pg_last_wal_replay_lsn() >= %(position)s::pg_lsn",
+            position=position).scalar()
+        # NULL: it isn't replaying anything, so it's as current as it gets
+        return replayed is not False
+
+    def bind_for(self, db_session, clause):
+        """The bind key to run `clause` on: a replica's, or None."""
+
+        if not has_request_context():
+            return None
+
+        writing = (db_session._flushing or
+                   isinstance(clause, UpdateBase) or
+                   getattr(clause, '_for_update_arg', None) is not None)
+        if writing:
+            # read our own writes for the rest of the request
+            g.wrote = True
+            g.pop('read_bind', None)
+            return None
+
+        if isinstance(clause, (Select, CompoundSelect)):
+            return g.get('read_bind')
+
+        return None
+
+    def leave_token(self, response):
+        """After a write, keep this user on the primary until replicas catch up."""
+
+        if self.replicas and g.get('wrote'):
+            token = {'at': time()}
+            primary = self.engine()
+            if primary.dialect.name == 'postgresql':
+                token['position'] = primary.execute(
+                    "SELECT pg_current_wal_lsn()::text").scalar()
+            session[CONSISTENCY_TOKEN_KEY] = token
+
+        return response
+
+    def stats(self):
+        """Read-only requests per database, in this process."""
+
+        return {(bind_key or 'primary'): count
+                for bind_key, count in self.routed.items()}
+
+
+router = ReplicaRouter()
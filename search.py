@@ -0,0 +1,351 @@
+"""Search over users (the /users directory) and messages.
+
+Users
+-----
+
+On PostgreSQL, searches use ILIKE backed by pg_trgm GIN indexes (created
+alongside the users table; see models.py), so a leading wildcard no longer
+means a full table scan.
+
+Other databases (SQLite in tests and small deployments) get an in-process
+trigram index instead. It's built from the users table on first use and
+kept current from the session: users added, changed or deleted through the
+ORM are applied to the index when their transaction commits.
+
+Both backends rank results the same way: exact username match, then
+username prefix, then username substring, then a match in bio or
+location; ties go to the more similar username.
+
+Messages
+--------
+
+Messages are searched through the MessageTerm inverted index, which
+messages_add() and messages_destroy() keep up to date. A query is a list
+of words, all of which must appear; `"quoted words"` must appear together
+in that order, and `word*` matches any word starting with `word`.
+"""
+
+import re
+from collections import defaultdict
+from threading import Lock
+
+from sqlalchemy import case, event
+
+from models import db, User, Message, MessageTerm, tokenize
+
+# queries shorter than this have no trigrams to look up
+TRIGRAM_LENGTH = 3
+
+
+def trigrams(text):
+    """The set of three-character substrings of lowercased `text`."""
+
+    text = text.lower()
+    return {text[i:i + TRIGRAM_LENGTH]
+            for i in range(len(text) - TRIGRAM_LENGTH + 1)}
+
+
+def similarity(a, b):
+    """How alike two strings are, 0 to 1, by shared trigrams."""
+
+    a_grams, b_grams = trigrams(f"  {a} "), trigrams(f"  {b} ")
+    if not a_grams or not b_grams:
+        return 0.0
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+def escape_like(text):
+    """Escape LIKE wildcards so `text` matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+class MemoryUserSearch:
+    """An in-process trigram index over username, bio and location."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.documents = {}
+        self.postings = defaultdict(set)
+
+    def build(self, rows):
+        """Index (id, username, bio, location) rows, replacing any index."""
+
+        with self.lock:
+            self.documents.clear()
+            self.postings.clear()
+            for row in rows:
+                self._add(*row)
+
+    def add(self, user_id, username, bio, location):
+        """Index a user, replacing whatever we had for them."""
+
+        with self.lock:
+            self._remove(user_id)
+            self._add(user_id, username, bio, location)
+
+    def remove(self, user_id):
+        """Drop a user from the index."""
+
+        with self.lock:
+            self._remove(user_id)
+
+    def _add(self, user_id, username, bio, location):
+        text = '\n'.join([username, bio or '', location or '']).lower()
+        self.documents[user_id] = (username, text)
+        for gram in trigrams(text):
+            self.postings[gram].add(user_id)
+
+    def _remove(self, user_id):
+        if user_id not in self.documents:
+            return
+        _, text = self.documents.pop(user_id)
+        for gram in trigrams(text):
+            self.postings[gram].discard(user_id)
+
+    def search(self, query, page, per_page):
+        """Ids of the users on this page of results, and whether there are
+        more pages after it."""
+
+        query = query.lower()
+
+        with self.lock:
+            grams = trigrams(query)
+            if grams:
+                candidates = set.intersection(
+                    *(self.postings.get(gram, set()) for gram in grams))
+            else:
+                candidates = set(self.documents)
+
+            matches = []
+            for user_id in candidates:
+                username, text = self.documents[user_id]
+                if query not in text:
+                    continue
+                matches.append((self.rank(query, username.lower()),
+                                -similarity(query, username),
+                                username,
+                                user_id))
+
+        matches.sort()
+        start = (page - 1) * per_page
+        page_ids = [user_id for *_, user_id in
+                    matches[start:start + per_page]]
+        return page_ids, len(matches) > start + per_page
+
+    @staticmethod
+    def rank(query, username):
+        if username == query:
+            return 0
+        if username.startswith(query):
+            return 1
+        if query in username:
+            return 2
+        return 3
+
+
+class PostgresUserSearch:
+    """Search with ILIKE over the pg_trgm-indexed user columns."""
+
+    def search(self, query, page, per_page):
+        """Ids of the users on this page of results, and whether there are
+        more pages after it."""
+
+        contains = f"%{escape_like(query)}%"
+        starts = f"{escape_like(query)}%"
+
+        rank = case([
+            (db.func.lower(User.username) == query.lower(), 0),
+            (User.username.ilike(starts, escape='\\'), 1),
+            (User.username.ilike(contains, escape='\\'), 2),
+        ], else_=3)
+
+        rows = (db.session
+                .query(User.id)
+                .filter(db.or_(User.username.ilike(contains, escape='\\'),
+                               User.bio.ilike(contains, escape='\\'),
+                               User.location.ilike(contains, escape='\\')))
+                .order_by(rank,
+                          db.func.similarity(User.username, query).desc(),
+                          User.username)
+                .offset((page - 1) * per_page)
+                .limit(per_page + 1)
+                .all())
+
+        return [user_id for (user_id,) in rows[:per_page]], len(rows) > per_page
+
+
+class UserSearch:
+    """User search, using whichever backend suits the database."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.backend = None
+
+    def get_backend(self):
+        with self.lock:
+            if self.backend is None:
+                if db.engine.dialect.name == 'postgresql':
+                    self.backend = PostgresUserSearch()
+                else:
+                    self.backend = MemoryUserSearch()
+                    self.backend.build(db.session.query(
+                        User.id, User.username, User.bio, User.location))
+            return self.backend
+
+    def search(self, query, page, per_page):
+        """Find users matching `query`, best matches first.
+
+        Returns (users, has_more) for the given 1-based page of `per_page`.
+        """
+
+        ids, has_more = self.get_backend().search(query, page, per_page)
+
+        users = {user.id: user
+                 for user in User.query.filter(User.id.in_(ids))}
+
+        # users deleted behind the index's back just drop out
+        return [users[user_id] for user_id in ids if user_id in users], has_more
+
+    def apply(self, changes):
+        """Update an in-process index with committed user changes."""
+
+        if not isinstance(self.backend, MemoryUserSearch):
+            return
+
+        for user_id, fields in changes:
+            if fields is None:
+                self.backend.remove(user_id)
+            else:
+                self.backend.add(user_id, *fields)
+
+
+user_search = UserSearch()
+
+
+##############################################################################
+# Message search
+
+
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def parse_message_query(query):
+    """Split a search into (kind, words) clauses.
+
+    Kinds are 'term' (one word), 'prefix' (one word, matched as a prefix)
+    and 'phrase' (several words in a row):
+
+        >>> parse_message_query('"hello there" bird*')
+        [('phrase', ['hello', 'there']), ('prefix', ['bird'])]
+    """
+
+    clauses = []
+
+    for phrase, word in QUERY_PART.findall(query):
+        if phrase:
+            words = tokenize(phrase)
+            if len(words) > 1:
+                clauses.append(('phrase', words))
+            elif words:
+                clauses.append(('term', words))
+        elif word.endswith('*'):
+            words = tokenize(word)
+            if words:
+                clauses.extend(('term', [w]) for w in words[:-1])
+                clauses.append(('prefix', words[-1:]))
+        else:
+            clauses.extend(('term', [w]) for w in tokenize(word))
+
+    return clauses
+
+
+def matching_message_ids(kind, words):
+    """A query for the ids of messages matching one clause."""
+
+    if kind == 'term':
+        return (db.session
+                .query(MessageTerm.message_id)
+                .filter(MessageTerm.term == words[0]))
+
+    if kind == 'prefix':
+        prefix = words[0]
+        after_prefix = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+        # the range is what the index can use; the LIKE keeps collations
+        # that sort oddly honest
+        return (db.session
+                .query(MessageTerm.message_id)
+                .filter(MessageTerm.term >= prefix,
+                        MessageTerm.term < after_prefix,
+                        MessageTerm.term.like(f"{escape_like(prefix)}%",
+                                              escape='\\')))
+
+    # phrase: each word must sit right after the one before it
+    first = db.aliased(MessageTerm)
+    query = (db.session
+             .query(first.message_id)
+             .filter(first.term == words[0]))
+
+    for offset, word in enumerate(words[1:], start=1):
+        next_word = db.aliased(MessageTerm)
+        query = query.join(next_word, db.and_(
+            next_word.message_id == first.message_id,
+            next_word.position == first.position + offset,
+            next_word.term == word,
+        ))
+
+    return query
+
+
+def message_search(query, author_id=None):
+    """A Message query for messages matching a search, or None if the
+    search has no words in it.
+
+    Order and page it with pagination.paginate.
+    """
+
+    clauses = parse_message_query(query)
+    if not clauses:
+        return None
+
+    messages = Message.query
+    if author_id is not None:
+        messages = messages.filter(Message.user_id == author_id)
+
+    for kind, words in clauses:
+        messages = messages.filter(
+            Message.id.in_(matching_message_ids(kind, words)))
+
+    return messages
+
+
+##############################################################################
+# Keep an in-process index in step with committed changes to users
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_user_changes(session, flush_context):
+    changes = session.info.setdefault('user_search_changes', [])
+
+    for user in session.new | session.dirty:
+        if isinstance(user, User):
+            changes.append(
+                (user.id, (user.username, user.bio, user.location)))
+
+    for user in session.deleted:
+        if isinstance(user, User):
+            changes.append((user.id, None))
+
+
+@event.listens_for(db.session, 'after_commit')
+def apply_user_changes(session):
+    user_search.apply(session.info.pop('user_search_changes', []))
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_user_changes(session):
+    session.info.pop('user_search_changes', None)
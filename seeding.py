@@ -0,0 +1,231 @@
+"""Bulk loading of CSV seed data, from a few hundred rows to tens of millions.
+
+load() streams each CSV in generator/ (or wherever it's pointed) into its
+table a chunk at a time, each chunk in its own transaction, so memory use
+stays flat and nothing piles up in the ORM session. On PostgreSQL chunks
+go in with COPY; elsewhere (SQLite) with an executemany INSERT.
+
+To keep the load fast, secondary indexes are dropped first and built once
+at the end, when building them in bulk is much cheaper than maintaining
+them row by row. Then the tables the app normally maintains itself
+(timelines, the search index, counters) are built from the loaded data.
+
+Rows get their ids from their line number rather than the sequences, so
+the CSVs can refer to each other by position (follows.csv's user ids are
+lines of users.csv) and a load that stops part way can be resumed: each
+chunk records how far its table has got, in the same transaction. The
+sequences are moved past the loaded ids afterwards.
+
+Use `flask seed` (or seed.py).
+"""
+
+import csv
+import io
+import os
+from datetime import datetime
+from itertools import islice
+from time import monotonic
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+
+from follow_graph import follow_graph
+from models import (db, ddl_indexes, User, Message, Follows, Likes,
+                    MessageTerm, TimelineEntry)
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# in load order; likes.csv is optional
+SOURCES = [
+    (User.__table__, 'users.csv'),
+    (Message.__table__, 'messages.csv'),
+    (Follows.__table__, 'follows.csv'),
+    (Likes.__table__, 'likes.csv'),
+]
+
+# kept apart from the app's tables, so create_all/drop_all leave it be
+progress = Table(
+    'seed_progress', MetaData(),
+    Column('table_name', String, primary_key=True),
+    Column('rows_loaded', Integer, nullable=False),
+)
+
+
+def load(data_dir, chunk_size=DEFAULT_CHUNK_SIZE, resume=False, echo=print):
+    """Load the CSVs in `data_dir` into a fresh database.
+
+    With `resume`, carry on from where an interrupted load stopped instead.
+    `echo` is called with progress reports.
+    """
+
+    engine = db.engine
+
+    # don't let the session's transaction hold locks on what we replace
+    db.session.close()
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+        progress.drop(engine, checkfirst=True)
+    progress.create(engine, checkfirst=True)
+
+    drop_indexes(engine)
+
+    for table, filename in SOURCES:
+        path = os.path.join(data_dir, filename)
+        if os.path.exists(path):
+            load_table(engine, table, path, chunk_size, echo)
+
+    reset_sequences(engine)
+
+    started = monotonic()
+    create_indexes(engine)
+    if engine.dialect.name == 'postgresql':
+        with engine.begin() as conn:
+            conn.execute('ANALYZE')
+    echo(f"indexes: built in {monotonic() - started:.1f}s")
+
+    # bulk loads skip the app's timeline fan-out, search indexing and
+    # counter updates, so build those in one go
+    for step, build in [('timelines', TimelineEntry.rebuild),
+                        ('search index', MessageTerm.rebuild),
+                        ('counters', User.recount_counters)]:
+        started = monotonic()
+        build()
+        db.session.commit()
+        echo(f"{step}: built in {monotonic() - started:.1f}s")
+
+    if follow_graph.path:
+        follow_graph.rebuild(
+            db.session
+            .query(Follows.user_following_id, Follows.user_being_followed_id)
+            .yield_per(chunk_size))
+        echo("follow graph: built")
+
+    progress.drop(engine)
+
+
+def load_table(engine, table, path, chunk_size, echo):
+    """Stream the CSV at `path` into `table`, `chunk_size` rows at a time."""
+
+    with engine.connect() as conn:
+        done = conn.execute(
+            progress.select()
+            .where(progress.c.table_name == table.name)).first()
+    loaded = done.rows_loaded if done else 0
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+
+        # number the rows ourselves (see the module docstring)
+        numbered = 'id' in table.c and 'id' not in columns
+        if numbered:
+            columns = ['id'] + columns
+            rows = ([n] + row for n, row in enumerate(reader, start=1))
+        else:
+            rows = reader
+
+        rows = islice(rows, loaded, None)
+        insert = copy_rows if engine.dialect.name == 'postgresql' else insert_rows
+
+        started = monotonic()
+        start = loaded
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+
+            with engine.begin() as conn:
+                insert(conn, table, columns, chunk)
+                loaded += len(chunk)
+                record_progress(conn, table.name, loaded)
+
+            elapsed = monotonic() - started
+            echo(f"{table.name}: {loaded:,} rows "
+                 f"({(loaded - start) / elapsed:,.0f} rows/s)")
+
+
+def copy_rows(conn, table, columns, rows):
+    """Insert `rows` with PostgreSQL's COPY."""
+
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH CSV", buf)
+
+
+def insert_rows(conn, table, columns, rows):
+    """Insert `rows` with an executemany INSERT.
+
+    Unlike COPY, this goes through SQLAlchemy's types, so turn the CSV's
+    strings into what they expect.
+    """
+
+    parsers = [parser_for(table.c[column]) for column in columns]
+    conn.execute(table.insert(), [
+        {column: parse(value)
+         for column, parse, value in zip(columns, parsers, row)}
+        for row in rows])
+
+
+def parser_for(column):
+    if isinstance(column.type, DateTime):
+        parse = datetime.fromisoformat
+    elif isinstance(column.type, Integer):
+        parse = int
+    else:
+        parse = str
+
+    # COPY reads empty fields as NULL; do the same
+    return lambda value: parse(value) if value != '' else None
+
+
+def record_progress(conn, table_name, rows_loaded):
+    updated = conn.execute(
+        progress.update()
+        .where(progress.c.table_name == table_name)
+        .values(rows_loaded=rows_loaded))
+    if not updated.rowcount:
+        conn.execute(progress.insert().values(table_name=table_name,
+                                              rows_loaded=rows_loaded))
+
+
+def reset_sequences(engine):
+    """Move id sequences past the ids we loaded."""
+
+    if engine.dialect.name != 'postgresql':
+        # SQLite picks the next rowid from the table itself
+        return
+
+    with engine.begin() as conn:
+        for table, _ in SOURCES:
+            if 'id' not in table.c:
+                continue
+            conn.execute(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"coalesce(max(id), 0) + 1, false) FROM {table.name}")
+
+
+def secondary_indexes():
+    """(name, create) for every index we can leave until after a load."""
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            yield index.name, index.create
+
+    for name, (table, ddl) in ddl_indexes.items():
+        yield name, lambda bind, table=table, ddl=ddl: ddl(table, bind)
+
+
+def drop_indexes(engine):
+    with engine.begin() as conn:
+        for name, _ in secondary_indexes():
+            conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+def create_indexes(engine):
+    for _, create in secondary_indexes():
+        create(engine)
@@ -0,0 +1,20 @@
+// Like and unlike warbles without reloading the page.
+//
+// Like buttons are plain forms that POST to /users/add_like/<id>, which
+// still works without JavaScript. Here we send the state the button should
+// end up in to /users/likes/<id> instead and just restyle the button.
+
+$(document).on("submit", ".like-form", function (evt) {
+  evt.preventDefault();
+
+  let $button = $(this).find("button");
+  let liked = $button.hasClass("btn-primary");
+
+  $.ajax({
+    url: `/users/likes/${$(this).data("message-id")}`,
+    method: liked ? "DELETE" : "PUT",
+  }).then(function (resp) {
+    $button.toggleClass("btn-primary", resp.liked);
+    $button.toggleClass("btn-secondary", !resp.liked);
+  });
+});
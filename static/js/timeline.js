@@ -0,0 +1,26 @@
+// Offer new warbles on the home timeline without reloading.
+//
+// /stream sends an event whenever someone the user follows posts. We
+// don't fetch the warbles themselves: the button just counts them, and
+// clicking it reloads the timeline (which is cheap -- see TimelineEntry).
+
+$(function () {
+  let $button = $("#new-messages");
+  if (!$button.length || !window.EventSource) return;
+
+  let count = 0;
+  let source = new EventSource($button.data("stream-url"));
+
+  source.addEventListener("message", function () {
+    count += 1;
+    $button
+      .text(`${count} new warble${count === 1 ? "" : "s"}`)
+      .removeClass("d-none");
+  });
+
+  // the browser reconnects by itself; just don't keep trying from a
+  // page that's been closed
+  $(window).on("beforeunload", function () {
+    source.close();
+  });
+});
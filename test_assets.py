@@ -0,0 +1,97 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from flask import Flask, render_template_string
+
+from assets import Assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Make an app with a couple of static files."""
+
+        self.dir = TemporaryDirectory()
+        static = os.path.join(self.dir.name, "static")
+        os.makedirs(os.path.join(static, "images"))
+        os.makedirs(os.path.join(static, "stylesheets"))
+
+        with open(os.path.join(static, "images", "bg.png"), "wb") as f:
+            f.write(b"not really a png")
+        with open(os.path.join(static, "stylesheets", "style.css"), "w") as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n'
+                    'nav { background: url(/static/images/missing.png); }\n')
+
+        self.app = Flask(__name__, static_folder=static)
+        self.assets = Assets(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def asset_url(self, filename):
+        with self.app.test_request_context():
+            return render_template_string(
+                "{{ asset_url(filename) }}", filename=filename)
+
+    def test_unbuilt(self):
+        """Are plain static URLs used before a build?"""
+        self.assertEqual(self.asset_url("stylesheets/style.css"),
+                         "/static/stylesheets/style.css")
+
+    def test_build(self):
+        """Are assets fingerprinted, precompressed and cross-linked?"""
+        manifest = self.assets.build()
+
+        css = manifest["stylesheets/style.css"]
+        png = manifest["images/bg.png"]
+        self.assertRegex(css, r"^stylesheets/style\.[0-9a-f]{12}\.css$")
+        self.assertEqual(self.asset_url("stylesheets/style.css"),
+                         f"/assets/{css}")
+
+        dist = os.path.join(self.dir.name, "static", "dist")
+        with open(os.path.join(dist, css)) as f:
+            built = f.read()
+        self.assertIn(f'url("/assets/{png}")', built)
+        self.assertIn("url(/static/images/missing.png)", built)
+
+        with gzip.open(os.path.join(dist, css + ".gz"), "rt") as f:
+            self.assertEqual(f.read(), built)
+        self.assertFalse(os.path.exists(os.path.join(dist, png + ".gz")))
+
+        # rebuilding doesn't pick up the last build
+        self.assertEqual(self.assets.build(), manifest)
+
+    def test_serve(self):
+        """Are built assets served compressed and cached for good?"""
+        css = self.assets.build()["stylesheets/style.css"]
+
+        resp = self.client.get(f"/assets/{css}",
+                               headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers["Content-Encoding"], "gzip")
+        self.assertEqual(resp.mimetype, "text/css")
+        self.assertIn(b"/assets/images/bg.",
+                      gzip.decompress(resp.get_data()))
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=31536000, immutable")
+        self.assertIn("Accept-Encoding", resp.headers["Vary"])
+        resp.close()
+
+        resp = self.client.get(f"/assets/{css}")
+        self.assertNotIn("Content-Encoding", resp.headers)
+        self.assertIn(b"/assets/images/bg.", resp.get_data())
+        resp.close()
+
+        resp = self.client.get("/assets/../secret")
+        self.assertEqual(resp.status_code, 404)
@@ -0,0 +1,77 @@
+"""Cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import LRUCache
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the LRU cache."""
+
+    def test_get_and_set(self):
+        """Are values cached and hits/misses counted?"""
+        cache = LRUCache()
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("b", 2), 2)
+
+        stats = cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+
+    def test_evicts_least_recently_used(self):
+        """Is the least recently used entry dropped when full?"""
+        cache = LRUCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_ttl(self):
+        """Do entries expire?"""
+        cache = LRUCache(ttl=10)
+
+        with patch("cache.monotonic", return_value=100):
+            cache.set("a", 1)
+        with patch("cache.monotonic", return_value=109):
+            self.assertEqual(cache.get("a"), 1)
+        with patch("cache.monotonic", return_value=110):
+            self.assertIsNone(cache.get("a"))
+
+    def test_delete_and_clear(self):
+        """Can entries be dropped?"""
+        cache = LRUCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+        cache.clear()
+        self.assertIsNone(cache.get("b"))
+
+    def test_weigh(self):
+        """Can the cache be bounded by total weight?"""
+        cache = LRUCache(maxsize=10, weigh=len)
+        cache.set("a", "xxxx")
+        cache.set("b", "xxxx")
+        cache.set("a", "xx")
+        self.assertEqual(cache.stats()["weight"], 6)
+
+        cache.set("c", "xxxxxx")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "xx")
+        self.assertEqual(cache.stats()["weight"], 8)
+
+        cache.delete("a")
+        self.assertEqual(cache.stats()["weight"], 6)
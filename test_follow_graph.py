@@ -0,0 +1,157 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_follow_graph.py
+
+
+import os
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+
+from follow_graph import FollowGraph, RECORD
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the memory-mapped follow graph."""
+
+    def setUp(self):
+        """Build a small graph in a scratch directory."""
+
+        self.dir = TemporaryDirectory()
+        self.graph = self.make_graph()
+        self.graph.rebuild([(1, 2), (1, 3), (2, 3), (4, 1)])
+        self.graph.refresh()
+
+    def tearDown(self):
+        self.graph.close()
+        self.dir.cleanup()
+
+    def make_graph(self):
+        """Another worker's view of the same graph."""
+
+        graph = FollowGraph()
+        graph.path = os.path.join(self.dir.name, "follows.graph")
+        return graph
+
+    def test_snapshot(self):
+        """Are follows and counts read from the snapshot?"""
+        self.assertTrue(self.graph.is_following(1, 3))
+        self.assertFalse(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(99, 1))
+        self.assertEqual(self.graph.following(1), {2, 3})
+        self.assertEqual(self.graph.followers(3), {1, 2})
+        self.assertEqual(self.graph.following_count(1), 2)
+        self.assertEqual(self.graph.followers_count(1), 1)
+        self.assertEqual(self.graph.followers_count(99), 0)
+
+    def test_empty(self):
+        """Can a graph with no follows be built?"""
+        self.graph.rebuild([])
+        self.graph.refresh()
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(self.graph.following_count(1), 0)
+
+    def test_not_built(self):
+        """Is there nothing loaded before the first build?"""
+        graph = FollowGraph()
+        graph.path = os.path.join(self.dir.name, "missing.graph")
+        graph.refresh()
+        self.assertFalse(graph.loaded)
+        graph.add(1, 2)
+        self.assertFalse(graph.loaded)
+
+    def test_add_and_remove(self):
+        """Do logged changes update membership and counts?"""
+        self.graph.add(3, 1)
+        self.graph.remove(1, 2)
+        # repeats change nothing
+        self.graph.add(3, 1)
+        self.graph.remove(1, 2)
+
+        self.assertTrue(self.graph.is_following(3, 1))
+        self.assertFalse(self.graph.is_following(1, 2))
+        self.assertEqual(self.graph.following_count(1), 1)
+        self.assertEqual(self.graph.followers_count(1), 2)
+        self.assertEqual(self.graph.following(3), {1})
+
+    def test_remove_user(self):
+        """Are all of a deleted user's follows dropped?"""
+        self.graph.remove_user(1)
+        self.assertEqual(self.graph.following(1), set())
+        self.assertEqual(self.graph.followers(1), set())
+        self.assertEqual(self.graph.followers_count(3), 1)
+        self.assertTrue(self.graph.is_following(2, 3))
+
+    def test_shared_between_workers(self):
+        """Do other workers see logged changes when they refresh?"""
+        other = self.make_graph()
+        other.refresh()
+
+        self.graph.add(3, 4)
+        self.assertFalse(other.is_following(3, 4))
+        other.refresh()
+        self.assertTrue(other.is_following(3, 4))
+
+        other.close()
+
+    def test_partial_record_is_ignored(self):
+        """Is a half-written log record left until it is complete?"""
+        record = RECORD.pack(1, 3, 4)
+        os.write(self.graph.log_fd, record[:5])
+        self.graph.refresh()
+        self.assertFalse(self.graph.is_following(3, 4))
+
+        os.write(self.graph.log_fd, record[5:])
+        self.graph.refresh()
+        self.assertTrue(self.graph.is_following(3, 4))
+
+    def test_rebuild_keeps_logged_changes(self):
+        """Are changes logged during a rebuild carried into the new log?"""
+        def edges():
+            # a follow made while the rebuild reads the database
+            self.graph.add(3, 4)
+            yield from [(1, 2)]
+
+        self.graph.rebuild(edges())
+        self.graph.refresh()
+
+        self.assertEqual(self.graph.snapshot.generation, 2)
+        self.assertTrue(self.graph.is_following(1, 2))
+        self.assertTrue(self.graph.is_following(3, 4))
+        self.assertFalse(self.graph.is_following(1, 3))
+
+    def test_reads_while_changes_are_replayed(self):
+        """Can one thread read while another logs follows and rebuilds?"""
+        errors = []
+
+        def write():
+            try:
+                for n in range(200):
+                    self.graph.add(5, 100 + n)
+                    self.graph.add(100 + n, 5)
+                    self.graph.remove(5, 100 + n // 2)
+                    if n % 50 == 0:
+                        self.graph.rebuild([(1, 2)])
+                        self.graph.refresh()
+            except Exception as exc:
+                errors.append(exc)
+
+        writer = Thread(target=write)
+        writer.start()
+        try:
+            while writer.is_alive():
+                self.graph.following(5)
+                self.graph.followers(5)
+                self.graph.is_following(5, 100)
+                self.graph.following_count(5)
+        except Exception as exc:
+            errors.append(exc)
+        writer.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(self.graph.following_count(5),
+                         len(self.graph.following(5)))
+        self.assertEqual(self.graph.followers_count(5),
+                         len(self.graph.followers(5)))
@@ -0,0 +1,220 @@
+"""Image proxy tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_images.py
+
+
+import io
+import os
+import socket
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+from PIL import Image
+
+from images import ImageProxy, ImageUnavailable
+
+
+def png(width, height, color="red"):
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), color).save(out, "PNG")
+    return out.getvalue()
+
+
+class Origin(BaseHTTPRequestHandler):
+    """A stand-in for the sites users' pictures live on."""
+
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+
+        if self.path == "/moved.png":
+            self.send_response(302)
+            self.send_header("Location", "/big.png")
+            self.end_headers()
+            return
+
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxyTestCase(TestCase):
+    """Test fetching, thumbnailing and caching images."""
+
+    @classmethod
+    def setUpClass(cls):
+        Origin.files = {
+            "/big.png": png(1000, 600),
+            "/other.png": png(800, 800, "blue"),
+            "/text.txt": b"not an image",
+        }
+        cls.origin = HTTPServer(("127.0.0.1", 0), Origin)
+        Thread(target=cls.origin.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.origin.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.origin.shutdown()
+        cls.origin.server_close()
+
+    def setUp(self):
+        """Make an app with its own image cache."""
+
+        self.dir = TemporaryDirectory()
+        Origin.requests.clear()
+
+        self.app = Flask(__name__)
+        self.app.config["SECRET_KEY"] = "test"
+        self.app.config["IMAGE_CACHE_DIR"] = self.dir.name
+        self.app.config["IMAGE_PROXY_ALLOW_PRIVATE"] = True
+        self.proxy = ImageProxy(self.app)
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def url(self, src, size):
+        with self.app.test_request_context():
+            return self.proxy.url(src, size)
+
+    def get(self, src, size):
+        resp = self.client.get(self.url(src, size))
+        data = resp.get_data()
+        resp.close()
+        return resp, data
+
+    def test_thumbnail(self):
+        """Are sources fetched once and cropped to each size?"""
+        src = f"{self.base}/big.png"
+
+        resp, data = self.get(src, "timeline")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.mimetype, "image/jpeg")
+        self.assertIn("public", resp.headers["Cache-Control"])
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (96, 96))
+
+        resp, data = self.get(src, "header")
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (1500, 500))
+
+        self.get(src, "timeline")
+        self.assertEqual(Origin.requests, ["/big.png"])
+
+    def test_content_addressed(self):
+        """Do sources with the same picture share cache files?"""
+        self.get(f"{self.base}/big.png", "card")
+        self.get(f"{self.base}/moved.png", "card")
+
+        thumbs = os.listdir(os.path.join(self.dir.name, "thumbs", "card"))
+        self.assertEqual(len(thumbs), 1)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.dir.name, "sources"))), 2)
+
+    def test_refetch_after_eviction(self):
+        """Is an evicted original fetched again for a new size?"""
+        src = f"{self.base}/big.png"
+        self.get(src, "card")
+        originals = os.path.join(self.dir.name, "originals")
+        for name in os.listdir(originals):
+            os.remove(os.path.join(originals, name))
+
+        resp, data = self.get(src, "avatar")
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (400, 400))
+        self.assertEqual(Origin.requests, ["/big.png", "/big.png"])
+
+    def test_static_source(self):
+        """Are the app's own default pictures read from disk?"""
+        with open(os.path.join(self.app.static_folder, "pic.png"), "wb") as f:
+            f.write(png(300, 300))
+        try:
+            resp, data = self.get("/static/pic.png", "timeline")
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            os.remove(os.path.join(self.app.static_folder, "pic.png"))
+
+        self.assertEqual(Origin.requests, [])
+
+    def test_unavailable(self):
+        """Are broken sources redirected to, and not retried?"""
+        for path in ["/text.txt", "/missing.png"]:
+            src = f"{self.base}{path}"
+            for _ in range(2):
+                resp, data = self.get(src, "timeline")
+                self.assertEqual(resp.status_code, 302)
+                self.assertEqual(resp.headers["Location"], src)
+
+        self.assertEqual(Origin.requests, ["/text.txt", "/missing.png"])
+
+    def test_bad_requests(self):
+        """Are unknown sizes and unsigned sources refused?"""
+        url = self.url(f"{self.base}/big.png", "timeline")
+
+        resp = self.client.get(url.replace("timeline", "huge"))
+        self.assertEqual(resp.status_code, 404)
+        resp = self.client.get(url[:-3])
+        self.assertEqual(resp.status_code, 404)
+
+    def test_private_addresses(self):
+        """Are private and odd sources refused unless allowed?"""
+        self.proxy.allow_private = False
+
+        with self.assertRaises(ImageUnavailable):
+            self.proxy.fetch(f"{self.base}/big.png")
+        with self.assertRaises(ImageUnavailable):
+            self.proxy.fetch("file:///etc/passwd")
+        self.assertEqual(Origin.requests, [])
+
+    def test_rebinding(self):
+        """Do we connect to the address we checked, not a fresh lookup's?"""
+        self.proxy.allow_private = False
+        port = self.origin.server_port
+
+        def lookup(address):
+            return [(socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                     (address, port))]
+
+        # public when checked, loopback if looked up again to connect
+        lookups = [lookup('93.184.216.34'), lookup('127.0.0.1')]
+        connected = []
+
+        def create_connection(address, *args):
+            connected.append(address)
+            raise ConnectionRefusedError()
+
+        with patch('socket.getaddrinfo', side_effect=lookups), \
+                patch('socket.create_connection', create_connection):
+            with self.assertRaises(ImageUnavailable):
+                self.proxy.fetch(f"http://rebind.test:{port}/big.png")
+
+        self.assertEqual(connected, [('93.184.216.34', port)])
+        self.assertEqual(Origin.requests, [])
+
+    def test_eviction(self):
+        """Is the cache kept under its size limit, dropping old files first?"""
+        self.get(f"{self.base}/big.png", "header")
+        self.proxy.cache_bytes = self.proxy.measure()[0] + 1000
+
+        self.get(f"{self.base}/other.png", "header")
+        self.assertLessEqual(self.proxy.measure()[0], self.proxy.cache_bytes)
+
+        # the newest thumbnail survived; the oldest files went
+        self.get(f"{self.base}/other.png", "header")
+        self.get(f"{self.base}/big.png", "header")
+        self.assertEqual(Origin.requests,
+                         ["/big.png", "/other.png", "/big.png"])
@@ -0,0 +1,138 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime, timedelta
+from time import sleep
+from unittest import TestCase
+
+from models import db
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from jobs import Job, JobQueue, DONE, FAILED, QUEUED, RUNNING, on_commit
+
+db.create_all()
+
+
+class JobQueueTestCase(TestCase):
+    """Test enqueueing, running and retrying jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        db.session.commit()
+
+        self.calls = []
+        self.queue = JobQueue()
+        self.queue.app = app
+        self.queue.workers = 0
+
+        @self.queue.task(max_attempts=2)
+        def record(value, fail=False):
+            self.calls.append(value)
+            if fail:
+                raise ValueError(value)
+
+        self.record = record
+
+    def tearDown(self):
+        self.queue.stop()
+        db.session.rollback()
+
+    def test_runs_committed_jobs(self):
+        """Are jobs run once their transaction commits, and only then?"""
+        self.record.enqueue(1)
+        self.record.enqueue(2)
+        db.session.rollback()
+        self.record.enqueue(3)
+        db.session.commit()
+
+        self.assertEqual(self.queue.run_pending(), 1)
+        self.assertEqual(self.calls, [3])
+        self.assertEqual(Job.query.one().status, DONE)
+        self.assertEqual(self.queue.run_pending(), 0)
+
+        stats = self.queue.stats()
+        self.assertEqual(stats["backlog"], {DONE: 1})
+        self.assertEqual(stats["tasks"]["record"]["succeeded"], 1)
+        self.assertIsNotNone(stats["tasks"]["record"]["run_p50_ms"])
+
+    def test_idempotency_keys(self):
+        """Is a job with a key enqueued only once?"""
+        self.record.enqueue(1, key="once")
+        db.session.commit()
+        self.queue.run_pending()
+
+        self.record.enqueue(1, key="once")
+        db.session.commit()
+        self.queue.run_pending()
+
+        self.assertEqual(self.calls, [1])
+        self.assertEqual(Job.query.count(), 1)
+
+    def test_retries_then_fails(self):
+        """Are failed jobs retried later, up to max_attempts?"""
+        self.record.enqueue("boom", fail=True)
+        db.session.commit()
+
+        self.assertEqual(self.queue.run_pending(), 1)
+        job = Job.query.one()
+        self.assertEqual(job.status, QUEUED)
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertEqual(job.last_error, "ValueError: boom")
+
+        # not due yet
+        self.assertEqual(self.queue.run_pending(), 0)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual(self.queue.run_pending(), 1)
+
+        job = Job.query.one()
+        self.assertEqual(job.status, FAILED)
+        self.assertEqual(job.attempts, 2)
+        self.assertEqual(self.calls, ["boom", "boom"])
+        self.assertEqual(self.queue.stats()["tasks"]["record"]["failed"], 1)
+
+    def test_expired_leases_are_taken_over(self):
+        """Are jobs whose worker went away run again?"""
+        self.record.enqueue(1)
+        db.session.commit()
+
+        job = Job.query.one()
+        job.status = RUNNING
+        job.locked_until = datetime.utcnow() + timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(self.queue.run_pending(), 0)
+
+        job.locked_until = datetime.utcnow() - timedelta(minutes=1)
+        db.session.commit()
+        self.assertEqual(self.queue.run_pending(), 1)
+        self.assertEqual(self.calls, [1])
+
+    def test_on_commit(self):
+        """Are commit callbacks run on commit and dropped on rollback?"""
+        on_commit(lambda: self.calls.append("rolled back"))
+        db.session.rollback()
+        on_commit(lambda: self.calls.append("committed"))
+        db.session.commit()
+
+        self.assertEqual(self.calls, ["committed"])
+
+    def test_worker_threads(self):
+        """Do the pool's threads pick up jobs as they're committed?"""
+        self.queue.workers = 1
+        self.record.enqueue(1)
+        db.session.commit()
+
+        for _ in range(50):
+            if self.calls:
+                break
+            sleep(0.1)
+
+        self.assertEqual(self.calls, [1])
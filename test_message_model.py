@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, TimelineEntry, TIMELINE_DEPTH
 from sqlalchemy.exc import IntegrityError, DataError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -128,3 +128,33 @@ class MessageModelTestCase(TestCase):
 
         self.assertEqual(len(Message.query.all()), 3)
         self.assertEqual(len(self.testuser.messages), 1)
+
+    def test_timeline_trim(self):
+        """Does trimming keep only the newest TIMELINE_DEPTH entries?"""
+
+        extra = [Message(text=f"Extra {i}", user_id=self.testuser.id)
+                 for i in range(TIMELINE_DEPTH)]
+        db.session.add_all(extra)
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        TimelineEntry.trim([self.testuser.id])
+        db.session.commit()
+
+        entries = TimelineEntry.query.filter_by(user_id=self.testuser.id)
+        self.assertEqual(entries.count(), TIMELINE_DEPTH)
+        self.assertNotIn(self.m1.id, [e.message_id for e in entries])
+
+    def test_timeline_rebuild(self):
+        """Does rebuild include own and followed users' messages?"""
+
+        self.testuser.following.append(self.testuser2)
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.testuser.id).count(), 4)
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.testuser2.id).count(), 2)
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from models import (db, connect_db, Message, User, TimelineEntry, Likes,
+                    Follows)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +22,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from fragments import message_cards
+from pubsub import broker
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +35,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs at the end of the request that queued them, so
+# tests can see what they did
+
+app.config['JOBS_EAGER'] = True
+
 
 class MessageViewTestCase(TestCase):
     """Test views for messages."""
@@ -72,6 +80,74 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
 
+    def test_add_message_fans_out_to_followers(self):
+        """Does a new message land in the author's and followers' timelines?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        db.session.commit()
+
+        follower_id = follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+            msg = Message.query.one()
+            timeline_owners = {entry.user_id for entry in
+                               TimelineEntry.query.filter_by(message_id=msg.id)}
+            self.assertEqual(timeline_owners, {self.testuser.id, follower_id})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/")
+            self.assertIn(b"Hello followers", resp.data)
+
+    def test_add_message_notifies_followers(self):
+        """Are followers watching /stream told about new messages?"""
+
+        follower = User.signup(username="follower", email="f@test.com",
+                               password="follower", image_url=None)
+        db.session.commit()
+        follower_id = follower.id
+        testuser_id = self.testuser.id
+        db.session.add(Follows(user_being_followed_id=testuser_id,
+                               user_following_id=follower_id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            resp = c.get("/stream")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            resp = c.get("/stream")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+            events = iter(resp.response)
+            self.assertEqual(next(events), b"retry: 5000\n\n")
+
+            with self.client as poster:
+                with poster.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+                poster.post("/messages/new", data={"text": "Hello"})
+
+            msg_id = Message.query.one().id
+            self.assertEqual(
+                next(events).decode(),
+                f"event: message\nid: {msg_id}\n"
+                f'data: {{"id": {msg_id}, "user_id": {testuser_id}}}\n\n')
+
+            resp.close()
+            self.assertEqual(broker.stats()["subscribers"], 0)
+
     def test_delete_message(self):
         """Can user delete a message?"""
 
@@ -92,6 +168,112 @@ class MessageViewTestCase(TestCase):
             m = Message.query.get(m.id)
             self.assertIsNone(m)
 
+    def test_delete_missing_message(self):
+        """Is deleting a message that doesn't exist a 404?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/99999/delete")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_delete_message_removes_it_from_timelines(self):
+        """Does deleting a message remove its timeline entries?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Soon gone"})
+            msg_id = Message.query.one().id
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg_id).count(), 1)
+
+            c.post(f"/messages/{msg_id}/delete")
+
+            self.assertEqual(
+                TimelineEntry.query.filter_by(message_id=msg_id).count(), 0)
+
+    def test_delete_message_forgets_its_card(self):
+        """Does deleting a message drop its cached card?"""
+
+        m = Message(text="Cached", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+        msg_id = m.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.get(f"/users/{self.testuser.id}")
+            size = message_cards.cache.stats()["size"]
+
+            c.post(f"/messages/{msg_id}/delete")
+            self.assertEqual(message_cards.cache.stats()["size"], size - 1)
+
+    def test_show_message_conditional_get(self):
+        """Do repeat views of a message get a 304?"""
+
+        m = Message(text="Test message", user_id=self.testuser.id)
+        db.session.add(m)
+        db.session.commit()
+        msg_id = m.id
+
+        with self.client as c:
+            etag = c.get(f"/messages/{msg_id}").headers["ETag"]
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # the page looks different once someone is logged in
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/messages/{msg_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
+            resp = c.get("/messages/0")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_api_messages(self):
+        """Are messages read in one query, with authors, likes and the viewer's?"""
+
+        other = User.signup(username="other", email="other@test.com",
+                            password="other", image_url=None)
+        msgs = [Message(text=f"Message {i}", user=other) for i in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        msg_ids = [m.id for m in msgs]
+        testuser_id = self.testuser.id
+        db.session.add(Likes(user_id=testuser_id, message_id=msg_ids[1]))
+        db.session.commit()
+
+        with self.client as c:
+            ids = ",".join(map(str, reversed(msg_ids)))
+            resp = c.get(f"/api/messages?ids={ids}")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "1")
+            messages = resp.get_json()["messages"]
+            self.assertEqual([m["id"] for m in messages], msg_ids[::-1])
+            self.assertEqual(messages[0]["text"], "Message 2")
+            self.assertEqual(messages[0]["user"]["username"], "other")
+            self.assertEqual([m["likes_count"] for m in messages], [0, 1, 0])
+            self.assertNotIn("liked", messages[0])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            # plus one to load the viewer
+            resp = c.get(f"/api/messages?ids={ids},0")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "2")
+            self.assertEqual([m["liked"] for m in resp.get_json()["messages"]],
+                             [False, True, False])
+
+            resp = c.get("/api/messages?ids=x")
+            self.assertEqual(resp.status_code, 400)
+
     def test_logged_out_users_cannot_delete_messages(self):
         """Can logged out users delete messages?"""
 
@@ -137,3 +319,49 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 302)
             m = Message.query.get(msg_id)
             self.assertIsNotNone(m)
+
+    def test_search_messages(self):
+        """Can messages be found by word, prefix, phrase and author?"""
+
+        other = User.signup(username="otheruser",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "The quick brown fox"})
+            c.post("/messages/new", data={"text": "Brown bread, quick!"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+
+            c.post("/messages/new", data={"text": "Quickly now"})
+
+            resp = c.get("/messages/search?q=brown+QUICK")
+            self.assertIn(b"The quick brown fox", resp.data)
+            self.assertIn(b"Brown bread, quick!", resp.data)
+            self.assertNotIn(b"Quickly now", resp.data)
+
+            resp = c.get('/messages/search?q="quick+brown"')
+            self.assertIn(b"The quick brown fox", resp.data)
+            self.assertNotIn(b"Brown bread, quick!", resp.data)
+
+            resp = c.get("/messages/search?q=quick*")
+            self.assertIn(b"The quick brown fox", resp.data)
+            self.assertIn(b"Quickly now", resp.data)
+
+            resp = c.get("/messages/search?q=quick*&author=otheruser")
+            self.assertNotIn(b"The quick brown fox", resp.data)
+            self.assertIn(b"Quickly now", resp.data)
+
+            msg_id = Message.query.filter_by(text="Quickly now").one().id
+            c.post(f"/messages/{msg_id}/delete")
+
+            resp = c.get("/messages/search?q=quickly")
+            self.assertNotIn(b"Quickly now", resp.data)
+            self.assertIn(b"no warbles found", resp.data)
@@ -0,0 +1,65 @@
+"""Password hasher tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+from passwords import PasswordHasher, PasswordHasherBusy, hash_rounds
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test hashing on the process pool."""
+
+    def setUp(self):
+        """Make a small, fast hasher."""
+
+        self.hasher = PasswordHasher()
+        self.hasher.rounds = 4
+        self.hasher.workers = 1
+        self.hasher.queue_depth = 0
+
+    def tearDown(self):
+        """Stop the pool."""
+
+        self.hasher.shutdown()
+
+    def test_hash_and_check(self):
+        """Do hashes made on the pool check out?"""
+        hashed = self.hasher.hash("password")
+        self.assertEqual(hash_rounds(hashed), 4)
+        self.assertTrue(self.hasher.check(hashed, "password"))
+        self.assertFalse(self.hasher.check(hashed, "wrong password"))
+
+    def test_inline(self):
+        """Does hashing work with no pool at all?"""
+        self.hasher.workers = 0
+        hashed = self.hasher.hash("password")
+        self.assertTrue(self.hasher.check(hashed, "password"))
+        self.assertIsNone(self.hasher.pool)
+
+    def test_needs_rehash(self):
+        """Are hashes with another work factor flagged for upgrade?"""
+        hashed = self.hasher.hash("password")
+        self.assertFalse(self.hasher.needs_rehash(hashed))
+        self.hasher.rounds = 5
+        self.assertTrue(self.hasher.needs_rehash(hashed))
+
+    def test_busy(self):
+        """Is work turned away when the queue is full?"""
+        self.hasher.rounds = 14
+        self.hasher.get_pool()
+
+        slow = Thread(target=self.hasher.hash, args=["password"])
+        slow.start()
+        try:
+            while not self.hasher.in_flight:
+                sleep(0.01)
+            with self.assertRaises(PasswordHasherBusy):
+                self.hasher.hash("password")
+        finally:
+            slow.join()
@@ -0,0 +1,132 @@
+"""Connection pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pools.py
+
+
+import os
+import tempfile
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+from flask import Flask
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+
+from models import db
+from pools import PoolMonitor, InstrumentedQueuePool
+
+
+def make_app(data_dir, **config):
+    """An app with a one-connection pool, unless `config` says otherwise."""
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f"sqlite:///{os.path.join(data_dir, 'pools.db')}")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_POOL_SIZE'] = 1
+    app.config['SQLALCHEMY_MAX_OVERFLOW'] = 0
+    app.config['SQLALCHEMY_POOL_TIMEOUT'] = 0.2
+    app.config.update(config)
+
+    monitor = PoolMonitor(app)
+    db.init_app(app)
+    return app, monitor
+
+
+class PoolTestCase(TestCase):
+    """Test pool settings and what the monitor reports."""
+
+    def setUp(self):
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.app, self.monitor = make_app(self.data_dir.name)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+        self.engine = db.get_engine(self.app)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.ctx.pop()
+        self.data_dir.cleanup()
+
+    def test_engine_options(self):
+        """Do the pool settings reach the engine?"""
+
+        pool = self.engine.pool
+        self.assertIsInstance(pool, InstrumentedQueuePool)
+        self.assertEqual(pool.size(), 1)
+        self.assertEqual(pool._recycle, 30 * 60)
+        self.assertTrue(pool._pre_ping)
+
+    def test_checkouts(self):
+        """Are checkouts counted and put in the histogram?"""
+
+        for _ in range(3):
+            self.engine.execute("SELECT 1")
+
+        stats = self.monitor.stats()['primary']
+        self.assertEqual(stats['checkouts'], 3)
+        self.assertEqual(sum(count for _, count in stats['checkout_ms']), 3)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_saturation(self):
+        """With every connection in use, do others wait, then time out?"""
+
+        held = self.engine.connect()
+        errors = []
+
+        def checkout():
+            try:
+                self.engine.connect()
+            except PoolTimeout as exc:
+                errors.append(exc)
+
+        waiter = Thread(target=checkout)
+        waiter.start()
+        sleep(0.05)
+
+        stats = self.monitor.stats()['primary']
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['waiting'], 1)
+
+        waiter.join()
+        held.close()
+
+        stats = self.monitor.stats()['primary']
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['waiting'], 0)
+        self.assertEqual(stats['in_use'], 0)
+
+    def test_stats_survive_dispose(self):
+        """Does disposing of the pool keep its counts?"""
+
+        self.engine.execute("SELECT 1")
+        self.engine.dispose()
+        self.engine.execute("SELECT 1")
+
+        self.assertEqual(self.monitor.stats()['primary']['checkouts'], 2)
+
+
+class StatementTimeoutTestCase(TestCase):
+    """Test the statement timeout setting."""
+
+    def test_postgresql_only(self):
+        """Is the timeout passed to PostgreSQL connections, and only those?"""
+
+        with tempfile.TemporaryDirectory() as data_dir:
+            app, _ = make_app(data_dir, SQLALCHEMY_STATEMENT_TIMEOUT=2.5)
+
+            options = {}
+            db.apply_driver_hacks(app, make_url('postgresql:///warbler'),
+                                  options)
+            self.assertEqual(options['connect_args']['options'],
+                             '-c statement_timeout=2500')
+
+            options = {}
+            db.apply_driver_hacks(
+                app, make_url(app.config['SQLALCHEMY_DATABASE_URI']), options)
+            self.assertNotIn('options', options.get('connect_args', {}))
@@ -0,0 +1,85 @@
+"""Pub/sub broker tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_pubsub.py
+
+
+import os
+import socket
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from pubsub import Broker, format_event
+
+
+class BrokerTestCase(TestCase):
+    """Test delivering events within and between processes."""
+
+    def setUp(self):
+        self.dir = TemporaryDirectory()
+        self.broker = self.make_broker()
+
+    def tearDown(self):
+        self.broker.close()
+        self.dir.cleanup()
+
+    def make_broker(self):
+        """Another process's broker, sharing our socket directory."""
+
+        broker = Broker()
+        broker.dir = self.dir.name
+        return broker
+
+    def test_local_delivery(self):
+        """Do events reach this process's subscribers, and only theirs?"""
+        one = self.broker.subscribe(1)
+        two = self.broker.subscribe(2)
+
+        self.broker.publish([1, 3], {"id": 10})
+
+        self.assertEqual(one.get(timeout=0), {"id": 10})
+        self.assertIsNone(two.get(timeout=0))
+
+        self.broker.unsubscribe(one)
+        self.broker.publish([1], {"id": 11})
+        self.assertIsNone(one.get(timeout=0))
+        self.assertEqual(self.broker.stats()["subscribers"], 1)
+
+    def test_delivery_between_processes(self):
+        """Do events reach subscribers in other processes?"""
+        other = self.make_broker()
+        try:
+            subscription = other.subscribe(1)
+            self.broker.publish([2, 1], {"id": 10})
+            self.assertEqual(subscription.get(timeout=5), {"id": 10})
+        finally:
+            other.close()
+
+    def test_forgets_dead_processes(self):
+        """Are sockets left behind by dead processes removed?"""
+        path = os.path.join(self.dir.name, "1-dead.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.close()
+
+        self.broker.publish([1], {"id": 10})
+        self.assertFalse(os.path.exists(path))
+
+    def test_full_queues_drop_events(self):
+        """Does a subscriber that isn't keeping up lose events, not block?"""
+        self.broker.queue_size = 2
+        subscription = self.broker.subscribe(1)
+
+        for id in range(3):
+            self.broker.publish([1], {"id": id})
+
+        self.assertEqual(subscription.get(timeout=0), {"id": 0})
+        self.assertEqual(subscription.get(timeout=0), {"id": 1})
+        self.assertIsNone(subscription.get(timeout=0))
+        self.assertEqual(self.broker.stats()["dropped"], 1)
+
+    def test_format_event(self):
+        """Are events formatted for text/event-stream?"""
+        self.assertEqual(format_event("message", {"id": 1}, id=1),
+                         'event: message\nid: 1\ndata: {"id": 1}\n\n')
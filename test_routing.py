@@ -0,0 +1,174 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_routing.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask
+
+from models import db, User
+from routing import ReplicaRouter, read_only, CONSISTENCY_TOKEN_KEY
+
+
+def make_app(data_dir, replicas=1):
+    """An app with a primary and replicas that don't replicate.
+
+    So which one a page read from shows in what it finds.
+    """
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f"sqlite:///{os.path.join(data_dir, 'primary.db')}")
+    app.config['SQLALCHEMY_REPLICAS'] = [
+        f"sqlite:///{os.path.join(data_dir, f'replica{n}.db')}"
+        for n in range(replicas)]
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'test'
+    app.config['TESTING'] = True
+
+    router = ReplicaRouter(app)
+    db.init_app(app)
+
+    def usernames():
+        return ','.join(username for username, in db.session
+                        .query(User.username)
+                        .order_by(User.username))
+
+    @app.route('/users')
+    @read_only
+    def users():
+        return usernames()
+
+    @app.route('/users/all')
+    def users_not_read_only():
+        return usernames()
+
+    @app.route('/users/<username>', methods=['POST'])
+    def add_user(username):
+        db.session.add(User(username=username, email=f"{username}@test.com",
+                            password='x'))
+        db.session.commit()
+        return usernames()
+
+    return app, router
+
+
+class RoutingTestCase(TestCase):
+    """Sets up an app with `replicas` replicas."""
+
+    replicas = 1
+
+    def setUp(self):
+        # each database has a user named for it: primary, or replica
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.app, self.router = make_app(self.data_dir.name, self.replicas)
+
+        with self.app.app_context():
+            db.create_all()
+            for bind_key in self.router.replicas:
+                db.metadata.create_all(db.get_engine(self.app, bind=bind_key))
+
+            for bind_key in [None] + self.router.replicas:
+                username = 'primary' if bind_key is None else 'replica'
+                db.get_engine(self.app, bind=bind_key).execute(
+                    User.__table__.insert().values(
+                        username=username, email=f"{username}@test.com",
+                        password='x'))
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            for bind_key in [None] + self.router.replicas:
+                db.get_engine(self.app, bind=bind_key).dispose()
+        self.data_dir.cleanup()
+
+
+class ReplicaRoutingTestCase(RoutingTestCase):
+    """Test which database pages read from."""
+
+    def test_read_only_views_use_replica(self):
+        """Do only read-only views read from the replica?"""
+
+        self.assertEqual(self.client.get('/users').data, b'replica')
+        self.assertEqual(self.client.get('/users/all').data, b'primary')
+        self.assertEqual(self.router.stats(), {'replica0': 1})
+
+    def test_writes_go_to_primary(self):
+        """Do writes go to the primary, and only there?"""
+
+        resp = self.client.post('/users/new')
+        self.assertEqual(resp.data, b'new,primary')
+
+        with self.app.app_context():
+            replica = db.get_engine(self.app, bind='replica0')
+            self.assertEqual(
+                replica.execute("SELECT count(*) FROM users").scalar(), 1)
+
+    def test_read_your_writes(self):
+        """After a write, does the user read from the primary until the lag is up?"""
+
+        self.client.post('/users/new')
+        with self.client.session_transaction() as session:
+            self.assertIn(CONSISTENCY_TOKEN_KEY, session)
+            written_at = session[CONSISTENCY_TOKEN_KEY]['at']
+
+        self.assertEqual(self.client.get('/users').data, b'new,primary')
+        self.assertEqual(self.router.stats(), {'primary': 1})
+
+        # other users aren't held to it
+        other_client = self.app.test_client()
+        self.assertEqual(other_client.get('/users').data, b'replica')
+
+        with patch('routing.time', return_value=written_at + 60):
+            self.assertEqual(self.client.get('/users').data, b'replica')
+
+        with self.client.session_transaction() as session:
+            self.assertNotIn(CONSISTENCY_TOKEN_KEY, session)
+
+    def test_no_replicas(self):
+        """Without replicas, does everything use the primary?"""
+
+        self.router.replicas = []
+
+        self.assertEqual(self.client.get('/users').data, b'primary')
+        self.client.post('/users/new')
+        with self.client.session_transaction() as session:
+            self.assertNotIn(CONSISTENCY_TOKEN_KEY, session)
+
+
+class LaggingReplicaTestCase(RoutingTestCase):
+    """Test read-your-writes with one replica behind the other."""
+
+    replicas = 2
+
+    def test_token_kept_for_lagging_replica(self):
+        """Is the token kept until every replica has replayed the write?"""
+
+        with self.client.session_transaction() as session:
+            session[CONSISTENCY_TOKEN_KEY] = {'at': 0, 'position': '0/100'}
+
+        lagging = {'replica1'}
+
+        def replayed(bind_key, position):
+            return bind_key not in lagging
+
+        with patch.object(self.router, 'replayed', replayed), \
+                patch('routing.random.choice') as choice:
+            choice.return_value = 'replica0'
+            self.assertEqual(self.client.get('/users').data, b'replica')
+            choice.return_value = 'replica1'
+            self.assertEqual(self.client.get('/users').data, b'primary')
+
+            lagging.clear()
+            self.assertEqual(self.client.get('/users').data, b'replica')
+
+        with self.client.session_transaction() as session:
+            self.assertNotIn(CONSISTENCY_TOKEN_KEY, session)
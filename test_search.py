@@ -0,0 +1,75 @@
+"""User search index tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_search.py
+
+
+from unittest import TestCase
+
+from search import MemoryUserSearch, similarity, trigrams
+
+
+class MemoryUserSearchTestCase(TestCase):
+    """Test the in-process trigram index."""
+
+    def setUp(self):
+        """Build an index over a few users."""
+
+        self.index = MemoryUserSearch()
+        self.index.build([
+            (1, "warbler", "I sing", "Oakland"),
+            (2, "bigwarblerfan", None, None),
+            (3, "warblerific", "Loves birds", "Boston"),
+            (4, "someone", "Warbles a lot", "Warbleton"),
+            (5, "nobody", "quiet", None),
+        ])
+
+    def search(self, query):
+        """The first page of results."""
+
+        return self.index.search(query, page=1, per_page=10)
+
+    def test_trigrams(self):
+        """Are trigrams lowercased three-character substrings?"""
+        self.assertEqual(trigrams("Abcd"), {"abc", "bcd"})
+        self.assertEqual(trigrams("ab"), set())
+
+    def test_similarity(self):
+        """Do closer strings score higher?"""
+        self.assertEqual(similarity("warbler", "warbler"), 1.0)
+        self.assertGreater(similarity("warbler", "warblers"),
+                           similarity("warbler", "bigwarblerfan"))
+
+    def test_search_ranking(self):
+        """Are exact, prefix, substring and bio/location matches ranked?"""
+        ids, has_more = self.search("Warble")
+        self.assertEqual(ids, [1, 3, 2, 4])
+        self.assertFalse(has_more)
+
+        ids, _ = self.search("warbler")
+        self.assertEqual(ids[0], 1)
+
+    def test_short_queries(self):
+        """Do queries shorter than a trigram still match?"""
+        ids, _ = self.search("qu")
+        self.assertEqual(ids, [5])
+
+    def test_pagination(self):
+        """Are results split into pages?"""
+        ids, has_more = self.index.search("warble", page=1, per_page=3)
+        self.assertEqual(ids, [1, 3, 2])
+        self.assertTrue(has_more)
+
+        ids, has_more = self.index.search("warble", page=2, per_page=3)
+        self.assertEqual(ids, [4])
+        self.assertFalse(has_more)
+
+    def test_add_and_remove(self):
+        """Do updates and deletes change what's found?"""
+        self.index.add(5, "warblette", None, None)
+        self.assertIn(5, self.search("warble")[0])
+        self.assertEqual(self.search("quiet")[0], [])
+
+        self.index.remove(1)
+        self.assertNotIn(1, self.search("warble")[0])
@@ -0,0 +1,108 @@
+"""Seed loading tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seeding.py
+
+
+import csv
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from seeding import load, progress
+
+
+def write_csv(path, header, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+class SeedingTestCase(TestCase):
+    """Test loading CSVs in chunks."""
+
+    def setUp(self):
+        """Write a small data set."""
+
+        self.dir = TemporaryDirectory()
+        self.reports = []
+
+        write_csv(os.path.join(self.dir.name, 'users.csv'),
+                  ['email', 'username', 'image_url', 'password', 'bio',
+                   'header_image_url', 'location'],
+                  [[f'u{n}@test.com', f'user{n}', '', 'HASHED', f'Bio {n}',
+                    '', ''] for n in range(1, 6)])
+        self.write_messages(3)
+        write_csv(os.path.join(self.dir.name, 'follows.csv'),
+                  ['user_being_followed_id', 'user_following_id'],
+                  [[1, 2], [1, 3], [2, 1]])
+
+    def tearDown(self):
+        """Put back empty tables for the tests after us."""
+
+        db.session.rollback()
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        progress.drop(db.engine, checkfirst=True)
+        self.dir.cleanup()
+
+    def write_messages(self, bad_user_id):
+        write_csv(os.path.join(self.dir.name, 'messages.csv'),
+                  ['text', 'timestamp', 'user_id'],
+                  [[f'Message {n}', f'2018-01-0{n} 12:00:00.000001', user_id]
+                   for n, user_id in enumerate([1, 2, 3, bad_user_id, 1],
+                                               start=1)])
+
+    def load(self, **kwargs):
+        load(self.dir.name, chunk_size=2, echo=self.reports.append, **kwargs)
+
+    def test_load(self):
+        """Are the CSVs loaded, derived tables built and sequences moved on?"""
+        self.load()
+
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(Message.query.count(), 5)
+        self.assertEqual(Follows.query.count(), 3)
+        self.assertEqual([m.user_id for m in Message.query.order_by('id')],
+                         [1, 2, 3, 3, 1])
+
+        user1 = User.query.get(1)
+        self.assertEqual(user1.username, 'user1')
+        self.assertEqual(user1.messages_count, 2)
+        self.assertEqual(user1.followers_count, 2)
+        # user 2 follows user 1, so sees their messages
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=2).count(), 3)
+
+        self.assertIn('messages: 4 rows', ' '.join(self.reports))
+
+        user = User.signup('newuser', 'new@test.com', 'password', None)
+        db.session.commit()
+        self.assertEqual(user.id, 6)
+
+        self.assertFalse(progress.exists(db.engine))
+
+    def test_resume(self):
+        """Does an interrupted load carry on where it stopped?"""
+        self.write_messages(99)
+        with self.assertRaises(Exception):
+            self.load()
+        db.session.rollback()
+
+        # the first chunk of messages made it
+        self.assertEqual(Message.query.count(), 2)
+
+        self.write_messages(3)
+        self.load(resume=True)
+
+        self.assertEqual([m.id for m in Message.query.order_by('id')],
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(User.query.count(), 5)
+        self.assertEqual(User.query.get(1).messages_count, 2)
@@ -0,0 +1,286 @@
+"""Sharding tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_sharding.py
+
+
+import os
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from flask import Flask
+
+from models import (db, shards, User, Message, Likes, Follows, UserShard,
+                    MessageId)
+from pagination import paginate, merge_pages, decode_cursor
+
+SHARD_KEYS = ['shard0', 'shard1', 'shard2']
+
+
+def make_app(data_dir):
+    """An app with a main database and three shards, all SQLite files."""
+
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f"sqlite:///{os.path.join(data_dir, 'main.db')}")
+    app.config['SQLALCHEMY_SHARDS'] = [
+        f"sqlite:///{os.path.join(data_dir, f'{key}.db')}"
+        for key in SHARD_KEYS]
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['TESTING'] = True
+
+    db.init_app(app)
+    shards.init_app(app)
+    return app
+
+
+def remove_sessions():
+    """Close this thread's main and shard sessions."""
+
+    db.session.remove()
+    shards.remove_sessions()
+
+
+class ShardingTestCase(TestCase):
+    """Test where sharded rows go, and finding them again."""
+
+    def setUp(self):
+        # the app's router is models.shards; put it back as it was after
+        saved = dict(vars(shards))
+        self.addCleanup(self.restore_shards, saved)
+        self.addCleanup(shards.placements.clear)
+
+        # scoped sessions are per thread, not per app: drop any bound to
+        # another app's databases before using ours
+        remove_sessions()
+
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.app = make_app(self.data_dir.name)
+        self.ctx = self.app.app_context()
+        self.ctx.push()
+
+        db.create_all()
+        shards.create_all()
+
+        # by id, users 1, 2 and 3 are on shard1, shard2 and shard0
+        self.users = [User(id=id, username=f"user{id}",
+                           email=f"user{id}@test.com", password='x')
+                      for id in [1, 2, 3]]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        shards.remove_sessions()
+        for key in [None] + SHARD_KEYS:
+            db.get_engine(self.app, bind=key).dispose()
+        self.ctx.pop()
+        self.data_dir.cleanup()
+
+    def restore_shards(self, saved):
+        """Put the app's router back, with no sessions left on ours."""
+
+        remove_sessions()
+        vars(shards).update(saved)
+        remove_sessions()
+
+    def count(self, key, model):
+        return shards.session(key).query(model).count()
+
+    def post(self, user_id, text, timestamp=None):
+        msg = Message(text=text, user_id=user_id, timestamp=timestamp)
+        shards.session_for(user_id).add(msg)
+        db.session.commit()
+        return msg.id
+
+    def test_placement(self):
+        """Are users on their default shards until moved?"""
+
+        self.assertEqual(shards.group([1, 2, 3, 4]),
+                         {'shard1': [1, 4], 'shard2': [2], 'shard0': [3]})
+
+        db.session.add(UserShard(user_id=2, shard='shard0'))
+        db.session.commit()
+        shards.placements.clear()
+
+        self.assertEqual(shards.shard_for(2), 'shard0')
+
+    def test_messages_on_authors_shard(self):
+        """Does each message go to its author's shard, with a unique id?"""
+
+        ids = [self.post(1, "one"), self.post(2, "two"), self.post(1, "three")]
+
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(db.session.query(MessageId).count(), 3)
+        self.assertEqual(self.count('shard1', Message), 2)
+        self.assertEqual(self.count('shard2', Message), 1)
+        self.assertEqual(self.count('shard0', Message), 0)
+        self.assertEqual(db.session.query(Message).count(), 0)
+
+        self.assertEqual(shards.get(Message, ids[1]).text, "two")
+        self.assertIsNone(shards.get(Message, 999))
+
+    def test_rollback_reaches_shards(self):
+        """Does rolling back db.session roll back the shards too?"""
+
+        shards.session_for(1).add(Message(text="oops", user_id=1))
+        shards.session_for(1).flush()
+        db.session.rollback()
+
+        self.assertEqual(self.count('shard1', Message), 0)
+
+    def test_merged_pages(self):
+        """Does paging across shards give one page, newest first?"""
+
+        start = datetime(2020, 1, 1)
+        for n in range(6):
+            self.post(n % 3 + 1, f"warble {n}", start + timedelta(minutes=n))
+
+        query = db.session.query(Message)
+
+        def page(cursor=None):
+            return merge_pages(shards.scatter(
+                lambda session: paginate(query.with_session(session),
+                                         Message.timestamp, Message.id,
+                                         cursor=cursor, per_page=4)),
+                per_page=4)
+
+        items, cursor = page()
+        self.assertEqual([msg.text for msg in items],
+                         ["warble 5", "warble 4", "warble 3", "warble 2"])
+        self.assertIsNotNone(cursor)
+
+        items, cursor = page(cursor)
+        self.assertEqual([msg.text for msg in items],
+                         ["warble 1", "warble 0"])
+        self.assertIsNone(cursor)
+
+    def test_follows_across_shards(self):
+        """Are follows on the follower's shard, and found from either side?"""
+
+        for follower_id in [1, 2]:
+            shards.session_for(follower_id).add(
+                Follows(user_following_id=follower_id,
+                        user_being_followed_id=3))
+        shards.session_for(3).add(
+            Follows(user_following_id=3, user_being_followed_id=1))
+        db.session.commit()
+
+        self.assertEqual(self.count('shard0', Follows), 1)
+        user1, user2, user3 = [User.query.get(id) for id in [1, 2, 3]]
+        self.assertEqual(user3.follower_ids(), {1, 2})
+        self.assertEqual(user3.following_ids(), {1})
+        self.assertTrue(user1.is_followed_by(user3))
+        self.assertFalse(user2.is_following(user1))
+
+    def test_like(self):
+        """Do likes go to the liker's shard, once, and come off again?"""
+
+        message_id = self.post(3, "likeable")
+        user1 = User.query.get(1)
+
+        self.assertTrue(user1.like(message_id))
+        self.assertFalse(user1.like(message_id))
+        db.session.commit()
+
+        self.assertEqual(self.count('shard1', Likes), 1)
+        self.assertEqual(self.count('shard0', Likes), 0)
+        self.assertEqual(user1.liked_message_ids([message_id]), {message_id})
+        self.assertEqual(User.query.get(1).likes_count, 1)
+
+        self.assertTrue(user1.unlike(message_id))
+        self.assertFalse(user1.unlike(message_id))
+        db.session.commit()
+
+        self.assertEqual(self.count('shard1', Likes), 0)
+        self.assertEqual(User.query.get(1).likes_count, 0)
+
+    def test_recount(self):
+        """Are counters recounted from every shard's rows?"""
+
+        message_id = self.post(3, "hello")
+        self.post(3, "again")
+        shards.session_for(1).add(Likes(user_id=1, message_id=message_id))
+        shards.session_for(2).add(Likes(user_id=2, message_id=message_id))
+        shards.session_for(1).add(
+            Follows(user_following_id=1, user_being_followed_id=3))
+        db.session.commit()
+
+        User.recount_counters()
+        db.session.commit()
+
+        counters = {user.id: (user.messages_count, user.following_count,
+                              user.followers_count, user.likes_count)
+                    for user in User.query}
+        self.assertEqual(counters, {1: (0, 1, 0, 1),
+                                    2: (0, 0, 0, 1),
+                                    3: (2, 0, 1, 0)})
+
+    def test_move_user(self):
+        """Does moving a user take all their rows and leave none behind?"""
+
+        message_id = self.post(1, "moving day")
+        session = shards.session_for(1)
+        session.add(Likes(user_id=1, message_id=message_id))
+        session.add(Follows(user_following_id=1, user_being_followed_id=2))
+        # likes go with the liker, wherever the message is
+        session.add(Likes(user_id=1, message_id=message_id + 1000))
+        db.session.commit()
+
+        self.assertEqual(shards.move_user(1, 'shard0'), 'shard1')
+
+        for model in [Message, Likes, Follows]:
+            self.assertEqual(self.count('shard1', model), 0)
+        self.assertEqual(self.count('shard0', Message), 1)
+        self.assertEqual(self.count('shard0', Likes), 2)
+        self.assertEqual(self.count('shard0', Follows), 1)
+
+        self.assertEqual(shards.shard_for(1), 'shard0')
+        self.assertEqual(db.session.query(UserShard.shard).scalar(), 'shard0')
+        self.assertEqual(User.query.get(1).following_ids(), {2})
+
+        # moving again is a no-op; to nowhere, an error
+        self.assertEqual(shards.move_user(1, 'shard0'), 'shard0')
+        with self.assertRaises(ValueError):
+            shards.move_user(1, 'shard9')
+
+
+Item = namedtuple('Item', 'timestamp id')
+
+
+class MergePagesTestCase(TestCase):
+    """Test combining pages from several shards."""
+
+    def test_merge(self):
+        """Are pages interleaved newest first, and cut to one page?"""
+
+        t = datetime(2020, 1, 1)
+        a = [Item(t, 5), Item(t, 2)]
+        b = [Item(t, 4), Item(t, 3)]
+
+        items, cursor = merge_pages([(a, None), (b, None)], per_page=3)
+        self.assertEqual([item.id for item in items], [5, 4, 3])
+        self.assertEqual(decode_cursor(cursor), (t, 3))
+
+        items, cursor = merge_pages([(a, None), (b, None)], per_page=4)
+        self.assertEqual([item.id for item in items], [5, 4, 3, 2])
+        self.assertIsNone(cursor)
+
+    def test_more_on_a_shard(self):
+        """If any shard had more, is there a next page?"""
+
+        t = datetime(2020, 1, 1)
+        items, cursor = merge_pages(
+            [([Item(t, 2)], 'more'), ([Item(t, 1)], None)], per_page=2)
+
+        self.assertEqual([item.id for item in items], [2, 1])
+        self.assertEqual(decode_cursor(cursor), (t, 1))
+
+    def test_no_pages(self):
+        """Are zero or one pages passed through?"""
+
+        self.assertEqual(merge_pages([]), ([], None))
+        self.assertEqual(merge_pages([([], 'x')]), ([], 'x'))
@@ -6,9 +6,11 @@
 
 
 import os
+from hashlib import sha1
 from unittest import TestCase
 
 from models import db, User, Message, Follows
+from passwords import hasher, hash_rounds
 from sqlalchemy.exc import IntegrityError
 
 # BEFORE we import our app, let's set an environmental variable
@@ -97,6 +99,17 @@ class UserModelTestCase(TestCase):
         self.assertEqual(repr(self.testuser2), 
             f"<User #{self.testuser2.id}: {self.testuser2.username}, {self.testuser2.email}>")
 
+    def test_profile_version(self):
+        """Is the profile version the same in every process, until edited?"""
+
+        self.testuser.image_url = "/pic.png"
+        self.assertEqual(self.testuser.profile_version,
+                         sha1(b"testuser\0/pic.png").hexdigest()[:16])
+
+        self.testuser.image_url = "/other.png"
+        self.assertNotEqual(self.testuser.profile_version,
+                            sha1(b"testuser\0/pic.png").hexdigest()[:16])
+
     def test_following(self):
         """Does is_following detect when a user is following another user?"""
         self.testuser.following.append(self.testuser2)
@@ -117,6 +130,26 @@ class UserModelTestCase(TestCase):
         """Does is_followed_by detect when a user is not followed by another user?"""
         self.assertFalse(self.testuser.is_followed_by(self.testuser2))
 
+    def test_like_and_unlike(self):
+        """Are likes idempotent and looked up as a set of message ids?"""
+        db.session.add_all([self.m1, self.m2])
+        db.session.commit()
+
+        self.assertTrue(self.testuser2.like(self.m1.id))
+        self.assertFalse(self.testuser2.like(self.m1.id))
+        db.session.commit()
+
+        self.assertEqual(
+            self.testuser2.liked_message_ids([self.m1.id, self.m2.id]),
+            {self.m1.id})
+        self.assertEqual(self.testuser2.liked_message_ids([]), set())
+        self.assertEqual(self.testuser2.likes_count, 1)
+
+        self.assertTrue(self.testuser2.unlike(self.m1.id))
+        self.assertFalse(self.testuser2.unlike(self.m1.id))
+        db.session.commit()
+        self.assertEqual(self.testuser2.likes_count, 0)
+
 
     def test_failed_creation(self):
         """Does user creation fail with bad data?"""
@@ -157,6 +190,18 @@ class UserModelTestCase(TestCase):
         user = User.authenticate(self.testuser.username, "testuser")
         self.assertEqual(user, self.testuser)
 
+    def test_user_authenticate_upgrades_hash(self):
+        """Does logging in re-hash passwords made with an old work factor?"""
+        old_rounds = hasher.rounds
+        hasher.rounds = 5
+        try:
+            user = User.authenticate(self.testuser.username, "testuser")
+            db.session.commit()
+            self.assertEqual(hash_rounds(user.password), 5)
+            self.assertTrue(User.authenticate(self.testuser.username, "testuser"))
+        finally:
+            hasher.rounds = old_rounds
+
     def test_user_authenticate_fail_invalid_username(self):
         """Does user authentication fail with invalid username?"""
         user = User.authenticate("testuser3", "testuser")
@@ -166,3 +211,20 @@ class UserModelTestCase(TestCase):
         """Does user authentication fail with invalid password?"""
         user = User.authenticate(self.testuser.username, "testuser3")
         self.assertFalse(user)
+
+    def test_recount_counters(self):
+        """Does recount_counters rebuild counts from the source tables?"""
+        self.testuser.following.append(self.testuser2)
+        self.testuser.likes.append(self.m3)
+        db.session.commit()
+
+        User.recount_counters()
+        db.session.commit()
+
+        testuser = User.query.get(self.testuser.id)
+        testuser2 = User.query.get(self.testuser2.id)
+        self.assertEqual(testuser.messages_count, 2)
+        self.assertEqual(testuser.following_count, 1)
+        self.assertEqual(testuser.followers_count, 0)
+        self.assertEqual(testuser.likes_count, 1)
+        self.assertEqual(testuser2.followers_count, 1)
@@ -6,9 +6,17 @@
 
 
 import os
+import re
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
 from unittest import TestCase
 
-from models import db, connect_db, Message, User
+from flask import session
+from sqlalchemy import event
+
+from models import (db, connect_db, Message, User, TimelineEntry, Follows,
+                    Likes)
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -20,7 +28,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, CURR_USER_KEY, delete_account, deletion_key
+from follow_graph import follow_graph
+from fragments import message_cards
+from jobs import Job
+from pagination import PER_PAGE
+from profiler import QueryBudgetExceeded, RequestProfile
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,6 +45,27 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs at the end of the request that queued them, so
+# tests can see what they did
+
+app.config['JOBS_EAGER'] = True
+
+
+@contextmanager
+def count_queries():
+    """Collect the SQL statements run inside this block."""
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
 
 class UserViewTestCase(TestCase):
     """Test views for users."""
@@ -78,6 +112,57 @@ class UserViewTestCase(TestCase):
             self.assertIn(b"testuser", resp.data)
             self.assertIn(b"testuser2", resp.data)
 
+    def test_search_users(self):
+        """Does search find substrings, rank them and pick up edits?"""
+        db.session.add(User(username="birdwatcher", email="bird@test.com",
+                            password="HASHED_PASSWORD", bio="I like testuser"))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=testuser")
+            self.assertEqual(resp.status_code, 200)
+            html = resp.data.decode()
+            self.assertLess(html.index("@testuser<"), html.index("@testuser2<"))
+            self.assertLess(html.index("@testuser2<"), html.index("@birdwatcher<"))
+
+            resp = c.get("/users?q=ser2")
+            self.assertIn(b"@testuser2<", resp.data)
+            self.assertNotIn(b"@testuser<", resp.data)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/users/profile",
+                   data={"username": "renamed",
+                         "password": "testuser",
+                         "email": "test@test.com"})
+
+            resp = c.get("/users?q=renam")
+            self.assertIn(b"@renamed<", resp.data)
+
+            c.post("/users/delete")
+            resp = c.get("/users?q=renam")
+            self.assertNotIn(b"@renamed<", resp.data)
+
+    def test_search_users_pages(self):
+        """Are search results paginated?"""
+        db.session.add_all([
+            User(username=f"pageduser{i:02}", email=f"paged{i}@test.com",
+                 password="HASHED_PASSWORD")
+            for i in range(30)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=pageduser")
+            self.assertIn(b"@pageduser00<", resp.data)
+            self.assertNotIn(b"@pageduser29<", resp.data)
+            self.assertIn(b"more-users", resp.data)
+
+            resp = c.get("/users?q=pageduser&page=2")
+            self.assertIn(b"@pageduser29<", resp.data)
+            self.assertNotIn(b"more-users", resp.data)
+
     def test_user_show_profile(self):
         """Can user show profile?"""
         with self.client as c:
@@ -85,6 +170,158 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn(b"testuser", resp.data)
 
+    def test_user_show_profile_pages(self):
+        """Can user page back through older messages on a profile?"""
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"Paged message {i}",
+                    timestamp=start + timedelta(minutes=i),
+                    user_id=self.testuser.id)
+            for i in range(PER_PAGE + 5)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}")
+            self.assertIn(b"Paged message 104<", resp.data)
+            self.assertNotIn(b"Paged message 4<", resp.data)
+
+            cursor = re.search(rb'href="\?before=([^"]+)"', resp.data).group(1)
+            resp = c.get(f"/users/{self.testuser.id}?before={cursor.decode()}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Paged message 4<", resp.data)
+            self.assertNotIn(b"Paged message 104<", resp.data)
+            self.assertNotIn(b"older-messages", resp.data)
+
+    def test_user_show_bad_cursor(self):
+        """Is a garbled pagination cursor rejected?"""
+        with self.client as c:
+            resp = c.get(f"/users/{self.testuser.id}?before=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def add_followed_authors(self, follower_id, usernames):
+        """Have a user follow new users who each post a message."""
+        for username in usernames:
+            author = User(username=username,
+                          email=f"{username}@test.com",
+                          password="HASHED_PASSWORD")
+            db.session.add(author)
+            db.session.flush()
+            db.session.add(Follows(user_being_followed_id=author.id,
+                                   user_following_id=follower_id))
+            msg = Message(text=f"By {username}", user_id=author.id)
+            db.session.add(msg)
+            db.session.flush()
+            TimelineEntry.fan_out(msg)
+        db.session.commit()
+
+    def test_homepage_query_count_is_fixed(self):
+        """Does the homepage cost the same queries for 1 or many authors?"""
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            self.add_followed_authors(testuser_id, ["author0"])
+            with count_queries() as one_author:
+                c.get("/")
+
+            self.add_followed_authors(
+                testuser_id, [f"author{i}" for i in range(1, 6)])
+            with count_queries() as many_authors:
+                resp = c.get("/")
+
+            self.assertIn(b"@author5", resp.data)
+            self.assertEqual(len(many_authors), len(one_author))
+            self.assertEqual(len(many_authors), 4)
+
+    def test_likes_query_count_is_fixed(self):
+        """Does the likes page cost the same queries for 1 or many authors?"""
+        testuser_id = self.testuser.id
+
+        def like_all():
+            for msg in Message.query.filter(Message.user_id != testuser_id):
+                if not Likes.query.filter_by(user_id=testuser_id,
+                                             message_id=msg.id).count():
+                    db.session.add(Likes(user_id=testuser_id,
+                                         message_id=msg.id))
+            db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            like_all()
+            with count_queries() as one_author:
+                c.get(f"/users/{testuser_id}/likes")
+
+            self.add_followed_authors(
+                testuser_id, [f"author{i}" for i in range(5)])
+            like_all()
+            with count_queries() as many_authors:
+                resp = c.get(f"/users/{testuser_id}/likes")
+
+            self.assertIn(b"@author4", resp.data)
+            self.assertEqual(len(many_authors), len(one_author))
+            self.assertEqual(len(many_authors), 4)
+
+    def test_profiler_headers(self):
+        """Are query counts and N+1 warnings reported on responses?"""
+        testuser_id = self.testuser.id
+        self.add_followed_authors(testuser_id, ["author0"])
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "4")
+            self.assertEqual(resp.headers["X-DB-N-Plus-One"], "0")
+            self.assertIn("X-DB-Time-Ms", resp.headers)
+
+    def test_profiler_flags_repeated_queries(self):
+        """Are repeats of the same query shape flagged as N+1?"""
+        profile = RequestProfile()
+        for user_id in range(5):
+            profile.record(f"SELECT * FROM users WHERE id = {user_id}", 0.001)
+        profile.record("SELECT * FROM messages WHERE id IN (%(a)s, %(b)s)", 0.001)
+        profile.record("SELECT * FROM messages WHERE id IN (%(a)s)", 0.001)
+
+        self.assertEqual(profile.count, 7)
+        self.assertEqual(profile.repeated(5),
+                         [("SELECT * FROM users WHERE id = ?", 5)])
+        self.assertEqual(len(profile.repeated(2)), 2)
+
+    def test_query_budgets(self):
+        """Do routes stay within their query budgets?"""
+        testuser_id = self.testuser.id
+        budgets = {"homepage": 4, "users_show": 4, "users_likes": 4}
+
+        app.config["SQL_QUERY_BUDGETS"] = budgets
+        app.config["SQL_QUERY_BUDGETS_ENFORCE"] = True
+        try:
+            self.add_followed_authors(
+                testuser_id, [f"author{i}" for i in range(5)])
+
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser_id
+
+                for url in ["/", f"/users/{testuser_id}",
+                            f"/users/{testuser_id}/likes"]:
+                    resp = c.get(url)
+                    self.assertEqual(resp.status_code, 200, url)
+
+                budgets["homepage"] = 3
+                app.config["PROPAGATE_EXCEPTIONS"] = True
+                with self.assertRaises(QueryBudgetExceeded):
+                    c.get("/")
+        finally:
+            app.config["SQL_QUERY_BUDGETS"] = {}
+            app.config["SQL_QUERY_BUDGETS_ENFORCE"] = False
+            app.config["PROPAGATE_EXCEPTIONS"] = None
+
     def test_user_add_follow(self):
         """Can user add follow?"""
         testuser2_id = self.testuser2.id
@@ -113,6 +350,130 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertNotIn(b"testuser2", resp.data)
 
+    def test_follow_updates_home_timeline(self):
+        """Do follows and unfollows add and remove messages on the homepage?"""
+        testuser2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get("/")
+            self.assertNotIn(b"Test message 2", resp.data)
+
+            c.post(f"/users/follow/{testuser2_id}")
+            resp = c.get("/")
+            self.assertIn(b"Test message 2", resp.data)
+
+            c.post(f"/users/stop-following/{testuser2_id}")
+            resp = c.get("/")
+            self.assertNotIn(b"Test message 2", resp.data)
+
+    def test_follow_updates_follow_graph(self):
+        """Do follows and unfollows reach the follow graph?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+
+        with TemporaryDirectory() as tmp:
+            follow_graph.path = os.path.join(tmp, "follows.graph")
+            follow_graph.rebuild([])
+
+            try:
+                with self.client as c:
+                    with c.session_transaction() as sess:
+                        sess[CURR_USER_KEY] = testuser_id
+
+                    c.post(f"/users/follow/{testuser2_id}")
+                    self.assertTrue(
+                        follow_graph.is_following(testuser_id, testuser2_id))
+
+                    resp = c.get(f"/users/{testuser2_id}")
+                    self.assertIn(b"Unfollow", resp.data)
+
+                    c.post(f"/users/stop-following/{testuser2_id}")
+                    self.assertFalse(
+                        follow_graph.is_following(testuser_id, testuser2_id))
+                    self.assertEqual(
+                        follow_graph.followers_count(testuser2_id), 0)
+
+            finally:
+                follow_graph.close()
+                follow_graph.path = None
+
+    def test_follow_and_like_update_counters(self):
+        """Do follows and likes keep the profile counters up to date?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+        testmsg2_id = self.testmsg2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/follow/{testuser2_id}")
+            c.post(f"/users/add_like/{testmsg2_id}")
+            c.post("/messages/new", data={"text": "Counted"})
+
+            testuser = User.query.get(testuser_id)
+            testuser2 = User.query.get(testuser2_id)
+            self.assertEqual(testuser.following_count, 1)
+            self.assertEqual(testuser.likes_count, 1)
+            self.assertEqual(testuser.messages_count, 1)
+            self.assertEqual(testuser2.followers_count, 1)
+
+            c.post(f"/users/stop-following/{testuser2_id}")
+            c.post(f"/users/add_like/{testmsg2_id}")
+
+            testuser = User.query.get(testuser_id)
+            testuser2 = User.query.get(testuser2_id)
+            self.assertEqual(testuser.following_count, 0)
+            self.assertEqual(testuser.likes_count, 0)
+            self.assertEqual(testuser2.followers_count, 0)
+
+    def test_user_delete_updates_counters(self):
+        """Are other users' counters fixed up when a user is deleted?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+        testmsg2_id = self.testmsg2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post(f"/users/follow/{testuser2_id}")
+            c.post(f"/users/add_like/{testmsg2_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser2_id
+
+            c.post("/users/delete")
+
+            testuser = User.query.get(testuser_id)
+            self.assertEqual(testuser.following_count, 0)
+            self.assertEqual(testuser.likes_count, 0)
+
+    def test_current_user_is_cached(self):
+        """Do logged-in requests skip looking up the current user?"""
+        with self.client as c:
+            c.post("/login", data={"username": "testuser",
+                                   "password": "testuser"})
+
+            c.get("/messages/new")
+            resp = c.get("/messages/new")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "0")
+            self.assertIn(b'alt="testuser"', resp.data)
+
+            c.post("/users/profile",
+                   data={"username": "renamed",
+                         "password": "testuser",
+                         "email": "test@test.com"})
+
+            resp = c.get("/messages/new")
+            self.assertIn(b'alt="renamed"', resp.data)
+
+            resp = c.get("/messages/new")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "0")
+
     def test_user_delete(self):
         """Can user delete themselves?"""
 
@@ -125,6 +486,50 @@ class UserViewTestCase(TestCase):
             resp = c.post(f"/users/delete", follow_redirects=True)
             self.assertEqual(resp.status_code, 200)
             self.assertEqual(User.query.get(testuser1_id), None)
+
+    def test_user_delete_takes_rows(self):
+        """Does deleting a user take their messages, likes and follows too?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+        testmsg1_id = self.testmsg1.id
+        testmsg2_id = self.testmsg2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser2_id
+            c.post(f"/users/follow/{testuser_id}")
+            c.post(f"/users/add_like/{testmsg1_id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+            c.post(f"/users/follow/{testuser2_id}")
+            c.post(f"/users/add_like/{testmsg2_id}")
+            c.post("/users/delete")
+
+        self.assertEqual(Message.query.filter_by(user_id=testuser_id).count(),
+                         0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        testuser2 = User.query.get(testuser2_id)
+        self.assertEqual((testuser2.followers_count, testuser2.following_count,
+                          testuser2.likes_count), (0, 0, 0))
+
+    def test_no_login_while_deleting(self):
+        """Is an account that's being deleted kept from logging back in?"""
+        delete_account.enqueue(self.testuser.id,
+                               key=deletion_key(self.testuser.id),
+                               delay=60 * 60)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.post("/login", data={"username": "testuser",
+                                          "password": "testuser"},
+                          follow_redirects=True)
+            self.assertIn(b"being deleted", resp.data)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+        Job.query.filter_by(key=deletion_key(self.testuser.id)).delete()
+        db.session.commit()
             
     def test_user_edit_profile(self):
         """Can user edit their profile?"""
@@ -147,6 +552,98 @@ class UserViewTestCase(TestCase):
             self.assertEqual(User.query.count(), 2)
             self.assertIn(b"testuser3", resp.data)
 
+    def test_message_cards_are_cached(self):
+        """Are message cards rendered once, and redrawn after profile edits?"""
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.get(f"/users/{testuser_id}")
+            hits = message_cards.cache.stats()["hits"]
+            resp = c.get(f"/users/{testuser_id}")
+            self.assertEqual(message_cards.cache.stats()["hits"], hits + 1)
+            self.assertIn(b"@testuser<", resp.data)
+
+            c.post("/users/profile",
+                   data={"username": "renamed",
+                         "password": "testuser",
+                         "email": "test@test.com"})
+
+            resp = c.get(f"/users/{testuser_id}")
+            self.assertIn(b"@renamed<", resp.data)
+            self.assertNotIn(b"@testuser<", resp.data)
+
+            metrics = c.get("/metrics").get_json()
+            self.assertIn("message_cards", metrics["caches"])
+
+    def test_profile_conditional_get(self):
+        """Do unchanged profiles get 304s, and changed ones a fresh page?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f"/users/{testuser2_id}")
+            etag = resp.headers["ETag"]
+            self.assertEqual(resp.headers["Cache-Control"], "private, no-cache")
+
+            resp = c.get(f"/users/{testuser2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers["ETag"], etag)
+            self.assertEqual(resp.data, b"")
+
+            c.post(f"/users/follow/{testuser2_id}")
+            resp = c.get(f"/users/{testuser2_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Unfollow", resp.data)
+
+    def test_homepage_conditional_get(self):
+        """Does a new warble on the timeline change the homepage's ETag?"""
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            etag = c.get("/").headers["ETag"]
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post("/messages/new", data={"text": "Something new"})
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Something new", resp.data)
+
+            resp = c.get("/users/profile")
+            self.assertEqual(resp.headers["Cache-Control"], "no-store")
+            self.assertNotIn("ETag", resp.headers)
+
+    def test_homepage_etag_follows_hearts(self):
+        """Does liking a different warble change the ETag, though the count doesn't?"""
+        testuser_id = self.testuser.id
+        self.add_followed_authors(testuser_id, ["author0", "author1"])
+        liked_first, liked_second = [
+            id for (id,) in db.session.query(Message.id)
+            .filter(Message.text.in_(["By author0", "By author1"]))]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.put(f"/users/likes/{liked_first}")
+            etag = c.get("/").headers["ETag"]
+
+            c.delete(f"/users/likes/{liked_first}")
+            c.put(f"/users/likes/{liked_second}")
+            resp = c.get("/", headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+
     def test_user_add_like(self):
         """Can user like another user's message?"""
         testmsg2_id = self.testmsg2.id
@@ -164,3 +661,72 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             testuser = User.query.get(self.testuser.id)
             self.assertNotIn(testmsg2_id, [m.id for m in testuser.likes])
+
+    def test_set_like_json(self):
+        """Can likes be set and cleared idempotently with JSON responses?"""
+        testuser_id = self.testuser.id
+        testmsg1_id = self.testmsg1.id
+        testmsg2_id = self.testmsg2.id
+
+        with self.client as c:
+            resp = c.put(f"/users/likes/{testmsg2_id}")
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            for _ in range(2):
+                resp = c.put(f"/users/likes/{testmsg2_id}")
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json(),
+                                 {"message_id": testmsg2_id, "liked": True})
+            self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+
+            resp = c.get(f"/users/{testuser_id}/likes")
+            self.assertIn(b"btn-primary", resp.data)
+
+            for _ in range(2):
+                resp = c.delete(f"/users/likes/{testmsg2_id}")
+                self.assertEqual(resp.get_json(),
+                                 {"message_id": testmsg2_id, "liked": False})
+            self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+            self.assertEqual(Likes.query.count(), 0)
+
+            resp = c.put(f"/users/likes/{testmsg1_id}")
+            self.assertEqual(resp.status_code, 403)
+
+    def test_api_users(self):
+        """Are users read in batches, in order, with the viewer's follows?"""
+        testuser_id = self.testuser.id
+        testuser2_id = self.testuser2.id
+        db.session.add(Follows(user_being_followed_id=testuser2_id,
+                               user_following_id=testuser_id))
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f"/api/users?ids={testuser2_id},0,{testuser_id},"
+                         f"{testuser2_id}")
+            self.assertEqual(resp.status_code, 200)
+            users = resp.get_json()["users"]
+            self.assertEqual([u["id"] for u in users],
+                             [testuser2_id, testuser_id])
+            self.assertEqual(users[0]["username"], "testuser2")
+            self.assertNotIn("following", users[0])
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            # the viewer, the users, and the viewer's follows both ways
+            resp = c.get(f"/api/users?ids={testuser2_id}")
+            self.assertEqual(resp.headers["X-DB-Query-Count"], "4")
+            user = resp.get_json()["users"][0]
+            self.assertTrue(user["following"])
+            self.assertFalse(user["follows_you"])
+
+            self.assertEqual(c.get("/api/users?ids=").get_json(),
+                             {"users": []})
+            resp = c.get("/api/users?ids=1,two")
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn("error", resp.get_json())
+            resp = c.get("/api/users?ids=" + ",".join(map(str, range(101))))
+            self.assertEqual(resp.status_code, 400)